@@ -1,60 +1,176 @@
 import os.path
+import threading
+import time
+from typing import Optional
 
 import gradio as gr
-import joblib
+import numpy as np
 import pandas as pd
-from config import RAW_DATA_PATH
-
-from scripts.utils import load_features_with_prefix
-
-up_features = load_features_with_prefix("up_", merge_on=['user_id', 'product_id'])
-up_features.fillna(0, inplace=True)
-u_features = load_features_with_prefix('u_', merge_on='user_id')
-p_features = load_features_with_prefix('p_', merge_on='product_id')
+from config import (
+	USER_FEATURES_CACHE_MB, PREDICTIONS_CACHE_MB, MODELS_CACHE_SIZE, MODELS_CACHE_MB, RETRIEVAL_INDEX_PATH,
+	RETRIEVAL_TOP_K, METRICS_PORT
+)
 
-products = pd.read_csv(os.path.join(RAW_DATA_PATH, "products.csv"))
+from scripts.basket import select_baskets
+from scripts.cache import LRUCache, file_hash
+from scripts.instrumentation import stage, start_metrics_server, timed
+from scripts.model_registry import ModelRegistry
+from scripts.recommender import Recommender, model_input
+from scripts.retrieval import CandidateIndex
+from scripts.tree_ensemble import compile_model
+from scripts.utils import load_model_file
+
+user_features_cache = LRUCache(max_bytes=USER_FEATURES_CACHE_MB * 1024 ** 2)  # user_id (, True) -> features
+# (model hash, user_id, new products) -> probabilities
+predictions_cache = LRUCache(max_bytes=PREDICTIONS_CACHE_MB * 1024 ** 2)
+# model hash -> model, weighted by the size of the model file
+models_cache = LRUCache(max_items=MODELS_CACHE_SIZE, max_bytes=MODELS_CACHE_MB * 1024 ** 2)
+model_hashes = LRUCache(max_items=64)  # (path, mtime, size) -> model hash
+candidate_index: Optional[CandidateIndex] = None  # opened on the first request for new products
+recommender: Optional[Recommender] = None  # opened on the first request, memory-mapped from the serving snapshot
+recommender_lock = threading.Lock()
+registry: Optional[ModelRegistry] = None  # models used when no model file is uploaded, reloaded when new ones appear
+registry_lock = threading.Lock()
+
+
+def get_recommender() -> Recommender:
+	global recommender
+	if recommender is None:
+		with recommender_lock:
+			if recommender is None:
+				with stage("app.open_features"):
+					recommender = Recommender.load()
+	return recommender
+
+
+def get_registry() -> ModelRegistry:
+	global registry
+	if registry is None:
+		with registry_lock:
+			if registry is None:
+				new_registry = ModelRegistry(get_recommender())
+				new_registry.refresh()
+				new_registry.start()
+				registry = new_registry
+	return registry
+
+
+def model_fingerprint(model_path: str) -> str:
+	"""
+	Returns the content hash of a model file. The file is only rehashed when its path, mtime or size changes.
+	"""
+	stat = os.stat(model_path)
+	return model_hashes.get_or_compute((model_path, stat.st_mtime_ns, stat.st_size), lambda: file_hash(model_path))
+
+
+def get_model(model_path: str):
+	model_hash = model_fingerprint(model_path)
+	return model_hash, models_cache.get_or_compute(
+		model_hash, lambda: compile_model(load_model_file(model_path)), size=os.path.getsize(model_path)
+	)
 
-current_user_id = None
-current_user_features = None
 
-current_model_path = None
-current_model = None
+def get_candidate_index() -> CandidateIndex:
+	global candidate_index
+	if candidate_index is None:
+		if not os.path.exists(RETRIEVAL_INDEX_PATH):
+			raise FileNotFoundError(
+				f"No retrieval index at {RETRIEVAL_INDEX_PATH}, build it with 'python scripts/build_retrieval_index.py'."
+			)
+		candidate_index = CandidateIndex.load()
+	return candidate_index
+
+
+def new_products_frame(user_id: int) -> pd.DataFrame:
+	"""
+	Features of the products retrieved for a user among the ones they have never bought, indexed by 'product_id'.
+	"""
+	feature_index = get_recommender().feature_index
+	product_ids, _ = get_candidate_index().search_user(user_id, RETRIEVAL_TOP_K)
+	features = feature_index.pairs_features(np.full(len(product_ids), user_id), product_ids)
+	return pd.DataFrame(
+		features, index=pd.Index(product_ids, name='product_id'), columns=feature_index.feature_names
+	)
 
 
-# Define the mock recommendation function
-def recommend(user_id, model_path, probability_threshold):
-	global current_user_id, current_user_features, current_model_path, current_model
-
-	if int(user_id) != current_user_id:
-		current_user_id = int(user_id)
-		current_user_features = up_features[up_features.user_id == current_user_id].merge(
-			u_features[u_features.user_id == current_user_id], on='user_id', how='left'
-		).merge(
-			p_features, on='product_id', how='left'
-		).drop(
-			'user_id', axis=1
-		).set_index(
-			'product_id'
+def get_user_features(user_id: int, new_products: bool = False) -> pd.DataFrame:
+	if new_products:
+		return user_features_cache.get_or_compute(
+			(user_id, True), lambda: pd.concat([get_user_features(user_id), new_products_frame(user_id)])
 		)
-		current_user_features.fillna(0, inplace=True)
+	return user_features_cache.get_or_compute(user_id, lambda: get_recommender().feature_index.user_frame(user_id))
+
+
+def predict_user(user_id: int, model_path: Optional[str], new_products: bool = False) -> pd.Series:
+	"""
+	Predicts the reorder probability of every candidate product of a user, indexed by 'product_id'.
+	Without a model file, the user is scored by the model the registry routes them to.
+	With `new_products`, the candidates include the products retrieved among the ones the user has never bought.
+	"""
+	with stage("app.model_lookup"):
+		version = None
+		if model_path:
+			model_hash, model = get_model(model_path)
+		else:
+			version = get_registry().route(user_id)
+			model_hash, model = version.version, version.model
+
+	def predict() -> pd.Series:
+		with stage("app.feature_lookup") as record:
+			user_features = get_user_features(user_id, new_products)
+			record.rows = len(user_features)
+		with stage("app.inference", rows=len(user_features)):
+			started = time.perf_counter()
+			features = model_input(model, user_features.to_numpy(), get_recommender().feature_index.feature_names)
+			probabilities = model.predict_proba(features)[:, 1]
+			if version is not None:
+				version.stats.observe(time.perf_counter() - started, 1, probabilities)
+			return pd.Series(probabilities, index=user_features.index, name="probability")
+
+	return predictions_cache.get_or_compute((model_hash, user_id, new_products), predict)
+
+
+def cache_stats() -> dict:
+	return {
+		"user_features": user_features_cache.stats(),
+		"predictions": predictions_cache.stats(),
+		"models": models_cache.stats(),
+	}
 
-	if model_path != current_model_path:
-		current_model_path = model_path
-		current_model = joblib.load(model_path)
 
-	predictions = pd.DataFrame()
-	predictions["product_id"] = current_user_features.index
-	predictions = predictions.merge(products[["product_id", "product_name"]], on="product_id", how="left")
-	predictions["probability"] = current_model.predict_proba(current_user_features)[:, 1].round(2)
-
-	return predictions[predictions.probability >= probability_threshold]
+# Define the mock recommendation function
+@timed("app.recommend", count_rows=True)
+def recommend(user_id, model_path, probability_threshold, f1_optimal=False, new_products=False):
+	probabilities = predict_user(int(user_id), model_path, new_products)
+
+	with stage("app.name_join", rows=len(probabilities)):
+		predictions = pd.DataFrame()
+		predictions["product_id"] = probabilities.index
+		predictions["product_name"] = get_recommender().names_of(probabilities.index.to_numpy())
+		predictions["probability"] = probabilities.to_numpy().round(2)
+
+	if not f1_optimal:
+		return predictions[predictions.probability >= probability_threshold]
+
+	# The basket with the highest expected F1 score, with 'None' when it is part of it
+	in_basket, add_none = select_baskets(probabilities.to_numpy(), [len(probabilities)])
+	basket = predictions[in_basket]
+	if add_none[0]:
+		basket = pd.concat([basket, pd.DataFrame({
+			"product_id": [None],
+			"product_name": ["None"],
+			"probability": [np.prod(1 - probabilities.to_numpy()).round(2)],
+		})], ignore_index=True)
+	return basket
 
 
 # Gradio Interface
 input_description = "Enter 'user_id':"
 output_description = "Recommended Products:"
-model_file_description = "Upload model file:"
+model_file_description = "Upload model file (leave empty to use the latest models):"
 probability_threshold_description = "Set probability threshold (0.0 to 1.0):"
+f1_optimal_description = "F1-optimal basket (ignores the threshold)"
+new_products_description = "Also consider products the user has never bought"
 
 interface = gr.Interface(
 	fn=recommend,
@@ -62,14 +178,19 @@ interface = gr.Interface(
 		gr.Textbox(label=input_description, placeholder="e.g., 123"),
 		gr.File(label=model_file_description, type="filepath"),
 		gr.Slider(label=probability_threshold_description, minimum=0.0, maximum=1.0, step=0.01, value=0.5),
+		gr.Checkbox(label=f1_optimal_description, value=False),
+		gr.Checkbox(label=new_products_description, value=False),
 	],
 	outputs=gr.Dataframe(label=output_description),
 	title="Instacart Product Recommendation Demo",
 	description=(
-		"Provide user ID to get personalized recommendations. Upload a model file and set a probability threshold."
+		"Provide user ID to get personalized recommendations. Upload a model file or use the latest trained models, "
+		"and set a probability threshold or pick the basket with the highest expected F1 score."
 	)
 )
 
 # Run the Gradio app
 if __name__ == "__main__":
+	if METRICS_PORT is not None:
+		start_metrics_server(METRICS_PORT)
 	interface.launch()
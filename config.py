@@ -1,4 +1,42 @@
 RAW_DATA_PATH = "data/raw/"
+RAW_CACHE_PATH = "data/cache/raw/"
 FEATURES_PATH = "data/features/"
+FEATURE_STORE_PATH = "data/features/store/"
+FEATURE_STATE_PATH = "data/features/state/"
+TRAINING_CACHE_PATH = "data/cache/training/"
+RETRIEVAL_INDEX_PATH = "data/features/retrieval.idx"
+INTERACTIONS_PATH = "data/features/interactions.idx"
+SERVING_SNAPSHOT_PATH = "data/features/serving.snapshot"
 MODELS_PATH = "models/"
+BENCHMARK_PATH = "benchmarks/"
+BENCHMARK_DATA_PATH = "data/benchmark/"
 SUBMIT_PATH = "submit/"
+
+# Serving caches of the Gradio app
+USER_FEATURES_CACHE_MB = 256
+PREDICTIONS_CACHE_MB = 64
+MODELS_CACHE_SIZE = 4
+MODELS_CACHE_MB = 2048  # models are weighted by their file size, keep it above the largest model
+
+# Model registry of the scoring service and the app: model type (follows its latest model) or model file under
+# MODELS_PATH (pinned) -> share of the users it scores
+MODEL_TRAFFIC_SPLIT = {"lightgbm": 1.0}
+MODEL_POLL_S = 10  # seconds between two scans of MODELS_PATH for new models, 0 to disable
+MODEL_SETTLE_S = 2  # model files modified less than this ago are still being written and are skipped
+MODEL_WARMUP_USERS = 64  # users scored by a new model before it receives traffic
+
+# Candidate retrieval of products a user has never bought
+RETRIEVAL_COMPONENTS = 64  # dimension of the user and product embeddings
+RETRIEVAL_TOP_K = 20  # new products per user scored by the model
+RETRIEVAL_N_PROBE = 8  # product lists searched per user
+
+# Training and hyperparameter tuning of scripts/train.py
+NEGATIVE_SAMPLE_RATE = 0.5  # fraction of the negative rows of every training user kept, 1 to train on all rows
+TUNING_TIME_BUDGET_S = None  # wall-clock budget of a search in seconds, None for no limit
+TUNING_N_JOBS = -1  # threads per model, -1 to use all cores
+
+# Stage instrumentation of scripts/instrumentation.py
+METRICS_LOG_PATH = None  # file the stage metrics are appended to as JSON lines, None to disable
+METRICS_PORT = None  # port of the Prometheus text endpoint of the Gradio app, None to disable
+PROFILE_STAGES = []  # stage names or glob patterns profiled with cProfile, e.g. ["feature.*", "app.inference"]
+PROFILE_PATH = "data/profiles/"
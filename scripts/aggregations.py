@@ -0,0 +1,45 @@
+from typing import Tuple
+
+import numpy as np
+
+
+def group_value_counts(keys: np.ndarray, values: np.ndarray, n_values: int) -> Tuple[np.ndarray, np.ndarray]:
+	"""
+	Counts the occurrences of each value within each group with a single bincount.
+
+	Args:
+		keys (np.ndarray): Group key of every row (e.g. 'user_id').
+		values (np.ndarray): Categorical value of every row, in [0, n_values) (e.g. 'order_dow').
+		n_values (int): Size of the value domain (e.g. 7 days of week, 24 hours of day).
+
+	Returns:
+		Tuple[np.ndarray, np.ndarray]: Sorted unique keys and a (n_groups, n_values) matrix of counts.
+	"""
+	values = np.asarray(values, dtype=np.int64)
+	if values.size and (values.min() < 0 or values.max() >= n_values):
+		raise ValueError(f"Values must be in [0, {n_values}).")
+
+	unique_keys, codes = np.unique(keys, return_inverse=True)
+	counts = np.bincount(
+		codes.astype(np.int64) * n_values + values,
+		minlength=len(unique_keys) * n_values
+	).reshape(len(unique_keys), n_values)
+	return unique_keys, counts
+
+
+def group_mode(keys: np.ndarray, values: np.ndarray, n_values: int) -> Tuple[np.ndarray, np.ndarray]:
+	"""
+	Vectorized mode of a small-domain categorical value per group.
+	Ties are broken towards the smallest value, like `scipy.stats.mode`.
+
+	Args:
+		keys (np.ndarray): Group key of every row (e.g. 'user_id').
+		values (np.ndarray): Categorical value of every row, in [0, n_values) (e.g. 'order_dow').
+		n_values (int): Size of the value domain (e.g. 7 days of week, 24 hours of day).
+
+	Returns:
+		Tuple[np.ndarray, np.ndarray]: Sorted unique keys and the mode of each group.
+	"""
+	unique_keys, counts = group_value_counts(keys, values, n_values)
+	# argmax returns the first maximum, i.e. the smallest of the tied values
+	return unique_keys, counts.argmax(axis=1)
@@ -0,0 +1,123 @@
+"""
+Per-order basket selection maximizing the expected F1 score.
+
+Instacart submissions are scored by the mean F1 of every order, where an empty order must be predicted as 'None'.
+Given independent reorder probabilities, the basket with the highest expected F1 is the top k products by probability
+for some k, optionally together with 'None'. The expectation of every k is computed with an O(n^2) dynamic program
+over the sorted probabilities, and the program runs on many zero-padded orders at once.
+"""
+from typing import Tuple
+
+import numpy as np
+
+# Bound of the number of floats of the per-chunk dynamic programming table (orders x (n + 1)^2)
+DP_BUDGET = 1 << 22
+
+
+def expected_f1(probabilities: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+	"""
+	Computes the expected F1 score of predicting the top k products of every order, for every k.
+
+	Args:
+		probabilities (np.ndarray): (orders, n) reorder probabilities, sorted in descending order within every row.
+			Shorter orders are padded with zeros.
+
+	Returns:
+		Tuple[np.ndarray, np.ndarray]: (orders, n + 1) expected F1 of predicting the top k products without
+		and with 'None'. Predicting nothing at all (k = 0 without 'None') has an expected F1 of 0.
+	"""
+	m, n = probabilities.shape
+	probabilities = probabilities.astype(np.float64)
+
+	# counts[k, :, a]: probability that a of the first k products are reordered (zero for a > k)
+	counts = np.zeros((n + 1, m, n + 1))
+	counts[0, :, 0] = 1
+	for k in range(1, n + 1):
+		p = probabilities[:, k - 1:k]
+		counts[k, :, :k] = counts[k - 1, :, :k] * (1 - p)
+		counts[k, :, 1:k + 1] += counts[k - 1, :, :k] * p
+
+	# inverse[:, i]: E[1 / (i + b)], where b is the number of reordered products after the first k.
+	# Starts at k = n (b = 0) and is updated while walking k down.
+	inverse = np.zeros((m, 2 * n + 2))
+	inverse[:, 1:] = 1 / np.arange(1, 2 * n + 2)
+
+	# With a reordered products among the k predicted ones, F1 = 2a / (k + a + b), or 2a / (k + 1 + a + b) with 'None'
+	twice_a = 2 * np.arange(n + 1, dtype=np.float64)
+	f1 = np.empty((m, n + 1))
+	f1_none = np.empty((m, n + 1))
+	for k in range(n, -1, -1):
+		weights = counts[k, :, :k + 1] * twice_a[:k + 1]
+		f1[:, k] = np.einsum("ij,ij->i", weights, inverse[:, k:2 * k + 1])
+		f1_none[:, k] = np.einsum("ij,ij->i", weights, inverse[:, k + 1:2 * k + 2])
+		if k:
+			# Only E[1 / (i + b)] for i <= 2k - 1 is needed from here on
+			p = probabilities[:, k - 1:k]
+			inverse[:, :2 * k] = (1 - p) * inverse[:, :2 * k] + p * inverse[:, 1:2 * k + 1]
+
+	# 'None' is right when nothing is reordered, which scores 2 / (k + 2) against the k + 1 predicted items
+	p_nothing = counts[n, :, 0]
+	f1_none += 2 * p_nothing[:, None] / (np.arange(n + 1) + 2)
+	return f1, f1_none
+
+
+def _best_baskets(probabilities: np.ndarray, lengths: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+	"""
+	Finds the expected-F1-optimal basket size and 'None' choice of zero-padded sorted orders.
+	"""
+	f1, f1_none = expected_f1(probabilities)
+	sizes = np.arange(f1.shape[1])
+	f1[:, 0] = -np.inf
+	f1[sizes > lengths[:, None]] = -np.inf
+	f1_none[sizes > lengths[:, None]] = -np.inf
+
+	best = np.concatenate([f1, f1_none], axis=1).argmax(axis=1)
+	return best % f1.shape[1], best >= f1.shape[1]
+
+
+def select_baskets(probabilities: np.ndarray, lengths: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+	"""
+	Selects the expected-F1-optimal basket of every order.
+
+	Args:
+		probabilities (np.ndarray): Reorder probability of every candidate, grouped by order.
+		lengths (np.ndarray): Number of candidates of every order.
+
+	Returns:
+		Tuple[np.ndarray, np.ndarray]: Whether every candidate is in its order's basket,
+		and whether 'None' is added to every order's basket.
+	"""
+	lengths = np.asarray(lengths, dtype=np.int64)
+	starts = np.cumsum(lengths) - lengths
+	order_of_row = np.repeat(np.arange(len(lengths)), lengths)
+
+	# Sort the candidates of every order by descending probability and rank them
+	by_probability = np.lexsort((-probabilities, order_of_row))
+	ranks = np.arange(len(probabilities)) - np.repeat(starts, lengths)
+	sorted_probabilities = probabilities[by_probability]
+
+	sizes = np.zeros(len(lengths), dtype=np.int64)
+	add_none = np.ones(len(lengths), dtype=bool)
+
+	# Orders of similar length are padded to the same width, in chunks that keep the table within DP_BUDGET
+	by_length = np.argsort(lengths, kind="stable")
+	by_length = by_length[lengths[by_length] > 0]
+	start = 0
+	while start < len(by_length):
+		window = lengths[by_length[start:start + max(1, DP_BUDGET // (int(lengths[by_length[start]]) + 1) ** 2)]]
+		fits = np.arange(1, len(window) + 1) * (window + 1) ** 2 <= DP_BUDGET
+		chunk = by_length[start:start + (len(fits) if fits.all() else max(1, int(fits.argmin())))]
+		width = lengths[chunk[-1]]
+
+		padded = np.zeros((len(chunk), width))
+		chunk_lengths = lengths[chunk]
+		rows = np.repeat(np.arange(len(chunk)), chunk_lengths)
+		columns = np.arange(chunk_lengths.sum()) - np.repeat(np.cumsum(chunk_lengths) - chunk_lengths, chunk_lengths)
+		padded[rows, columns] = sorted_probabilities[np.repeat(starts[chunk], chunk_lengths) + columns]
+
+		sizes[chunk], add_none[chunk] = _best_baskets(padded, chunk_lengths)
+		start += len(chunk)
+
+	in_basket = np.empty(len(probabilities), dtype=bool)
+	in_basket[by_probability] = ranks < sizes[order_of_row]
+	return in_basket, add_none
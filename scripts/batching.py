@@ -0,0 +1,205 @@
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import Executor
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+# Scores a batch of users: user_id -> (product ids, probabilities), optionally followed by a label, see `split_by_user`
+ScoreFn = Callable[[List[int]], Dict[int, tuple]]
+
+
+class LatencyStats:
+	"""
+	Request counter with latency quantiles over a sliding window of the most recent requests.
+	"""
+
+	def __init__(self, window: int = 10_000):
+		self.count = 0
+		self.total_seconds = 0.0
+		self._recent = deque(maxlen=window)
+
+	def observe(self, seconds: float) -> None:
+		self.count += 1
+		self.total_seconds += seconds
+		self._recent.append(seconds)
+
+	def summary(self) -> dict:
+		recent = np.fromiter(self._recent, dtype=np.float64)
+		quantiles = np.quantile(recent, [0.5, 0.95, 0.99]) * 1000 if len(recent) else [0.0, 0.0, 0.0]
+		return {
+			"count": self.count,
+			"mean_ms": self.total_seconds / self.count * 1000 if self.count else 0.0,
+			"p50_ms": float(quantiles[0]),
+			"p95_ms": float(quantiles[1]),
+			"p99_ms": float(quantiles[2]),
+		}
+
+
+def split_by_user(
+		row_user_ids: np.ndarray,
+		product_ids: np.ndarray,
+		probabilities: np.ndarray,
+		labels: Optional[Dict[int, object]] = None
+) -> Dict[int, tuple]:
+	"""
+	Splits scored candidate rows, grouped by user, into per-user (product ids, probabilities).
+	With `labels` (e.g. the model that scored every user), every user of `labels` gets
+	(product ids, probabilities, label), including the users without candidates.
+	"""
+	scores = {}
+	if len(row_user_ids):
+		boundaries = np.flatnonzero(row_user_ids[1:] != row_user_ids[:-1]) + 1
+		starts = np.r_[0, boundaries]
+		scores = {
+			int(row_user_ids[start]): (products, probabilities)
+			for start, products, probabilities in zip(
+				starts, np.split(product_ids, boundaries), np.split(probabilities, boundaries)
+			)
+		}
+	if labels is None:
+		return scores
+
+	empty = (np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.float32))
+	return {user_id: (*scores.get(user_id, empty), label) for user_id, label in labels.items()}
+
+
+class MicroBatcher:
+	"""
+	Collects concurrent scoring requests for up to `max_wait_ms` (or `max_batch_size` users)
+	and scores them together with a single vectorized call in a worker thread.
+	Up to `max_concurrent_batches` batches are scored at once; the next batch is only collected when one of them is
+	done, so requests keep joining it while all scorers are busy.
+	"""
+
+	def __init__(
+			self,
+			score_fn: ScoreFn,
+			max_batch_size: int = 256,
+			max_wait_ms: float = 5.0,
+			executor: Optional[Executor] = None,
+			max_concurrent_batches: int = 1
+	):
+		self.score_fn = score_fn
+		self.max_batch_size = max_batch_size
+		self.max_wait_ms = max_wait_ms
+		self.executor = executor
+		self.max_concurrent_batches = max_concurrent_batches
+
+		self._queue: Optional[asyncio.Queue] = None
+		self._worker: Optional[asyncio.Task] = None
+		self._batches: Set[asyncio.Task] = set()
+
+		self.request_latency = LatencyStats()
+		self.batch_latency = LatencyStats()
+		self.batched_users = 0
+		self.max_queue_depth = 0
+
+	@property
+	def queue_depth(self) -> int:
+		return self._queue.qsize() if self._queue is not None else 0
+
+	def start(self) -> None:
+		self._queue = asyncio.Queue()
+		self._worker = asyncio.get_running_loop().create_task(self._run())
+
+	async def stop(self) -> None:
+		if self._worker is not None:
+			self._worker.cancel()
+			try:
+				await self._worker
+			except asyncio.CancelledError:
+				pass
+			self._worker = None
+		if self._batches:
+			await asyncio.gather(*self._batches, return_exceptions=True)
+
+	async def submit(self, user_id: int) -> Tuple[np.ndarray, np.ndarray]:
+		"""
+		Scores all candidate products of a user as part of the next batch.
+
+		Args:
+			user_id (int): The user to score.
+
+		Returns:
+			Tuple[np.ndarray, np.ndarray]: Candidate product ids and their probabilities.
+		"""
+		started = time.perf_counter()
+		future = asyncio.get_running_loop().create_future()
+		await self._queue.put((user_id, future))
+		self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+		try:
+			return await future
+		finally:
+			self.request_latency.observe(time.perf_counter() - started)
+
+	async def submit_many(self, user_ids: List[int]) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+		"""
+		Scores several users; they join the batches of concurrent requests like single-user requests.
+		"""
+		user_ids = list(dict.fromkeys(user_ids))
+		results = await asyncio.gather(*(self.submit(user_id) for user_id in user_ids))
+		return dict(zip(user_ids, results))
+
+	async def _collect(self) -> List[Tuple[int, asyncio.Future]]:
+		batch = [await self._queue.get()]
+		deadline = time.perf_counter() + self.max_wait_ms / 1000
+
+		while len(batch) < self.max_batch_size:
+			timeout = deadline - time.perf_counter()
+			if timeout <= 0:
+				break
+			try:
+				batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+			except asyncio.TimeoutError:
+				break
+
+		return batch
+
+	async def _run(self) -> None:
+		loop = asyncio.get_running_loop()
+		slots = asyncio.Semaphore(self.max_concurrent_batches)
+		while True:
+			await slots.acquire()
+			try:
+				batch = await self._collect()
+			except asyncio.CancelledError:
+				slots.release()
+				raise
+			task = loop.create_task(self._score(batch))
+			self._batches.add(task)
+			task.add_done_callback(self._batches.discard)
+			task.add_done_callback(lambda _: slots.release())
+
+	async def _score(self, batch: List[Tuple[int, asyncio.Future]]) -> None:
+		user_ids = list(dict.fromkeys(user_id for user_id, _ in batch))
+
+		started = time.perf_counter()
+		try:
+			scores = await asyncio.get_running_loop().run_in_executor(self.executor, self.score_fn, user_ids)
+		except Exception as e:
+			for _, future in batch:
+				if not future.done():
+					future.set_exception(e)
+			return
+		self.batch_latency.observe(time.perf_counter() - started)
+		self.batched_users += len(user_ids)
+
+		empty = (np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.float32))
+		for user_id, future in batch:
+			if not future.done():
+				future.set_result(scores.get(user_id, empty))
+
+	def metrics(self) -> dict:
+		batches = self.batch_latency.summary()
+		return {
+			"queue_depth": self.queue_depth,
+			"max_queue_depth": self.max_queue_depth,
+			"requests": self.request_latency.summary(),
+			"batches": {
+				**batches,
+				"mean_size": self.batched_users / batches["count"] if batches["count"] else 0.0,
+			},
+		}
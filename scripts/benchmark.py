@@ -0,0 +1,128 @@
+import argparse
+import json
+import os
+import platform
+from datetime import datetime
+
+import autorootcwd  # noqa
+
+from config import BENCHMARK_DATA_PATH, BENCHMARK_PATH
+from scripts.benchmarking import STAGES, compare, format_report, run_stage
+from scripts.synthetic_data import SCALES, generate_raw_data
+
+
+def machine_info() -> dict:
+	"""
+	Describes the machine the benchmark runs on. Baselines are only comparable on the same machine.
+	"""
+	return {
+		"platform": platform.platform(),
+		"processor": platform.processor() or platform.machine(),
+		"cpus": os.cpu_count(),
+		"python": platform.python_version(),
+	}
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		description="Benchmark the pipeline on synthetic Instacart-shaped data and compare it with a baseline."
+	)
+	parser.add_argument("--scale", choices=list(SCALES), default="small", help="Number of synthetic users.")
+	parser.add_argument("--seed", type=int, default=42, help="Seed of the synthetic data.")
+	parser.add_argument(
+		"--stages", nargs="+", choices=list(STAGES), default=list(STAGES),
+		help="Stages to run, in pipeline order. 'submit' and 'app' need a trained model of --model-type."
+	)
+	parser.add_argument(
+		"--model-type", choices=["lightgbm", "xgboost", "random_forest"], default="lightgbm",
+		help="Model used by the 'submit' and 'app' stages."
+	)
+	parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Worker processes of 'submit'.")
+	parser.add_argument("--app-users", type=int, default=50, help="Users requested from the app.")
+	parser.add_argument(
+		"--time-budget-s", type=float, default=None, help="Wall-clock budget of every hyperparameter search."
+	)
+	parser.add_argument("--regenerate", action="store_true", help="Generate the synthetic data again.")
+	parser.add_argument(
+		"--tolerance", type=float, default=0.2, help="Relative increase of a time or memory metric that fails."
+	)
+	parser.add_argument(
+		"--save-baseline", action="store_true", help="Store the results as the baseline of the scale."
+	)
+	parser.add_argument("--quiet", action="store_true", help="Hide the output of the stages.")
+	args = parser.parse_args()
+
+	workdir = os.path.abspath(os.path.join(BENCHMARK_DATA_PATH, args.scale))
+	raw_path = os.path.join(workdir, "data", "raw")
+	settings = {"n_users": SCALES[args.scale], "seed": args.seed}
+	settings_path = os.path.join(workdir, "generated.json")
+
+	# Generate the data once per scale and seed
+	generated = None
+	if os.path.exists(settings_path):
+		with open(settings_path) as f:
+			generated = json.load(f)
+	if args.regenerate or generated != settings:
+		print(f"Generating {settings['n_users']} synthetic users in {raw_path}...")
+		if os.path.exists(settings_path):
+			os.remove(settings_path)
+		rows = generate_raw_data(raw_path, settings["n_users"], seed=args.seed)
+		print(f"Generated rows: {rows}")
+		with open(settings_path, "w") as f:
+			json.dump(settings, f)
+
+	options = {
+		"model_type": args.model_type,
+		"jobs": args.jobs,
+		"app_users": args.app_users,
+		"time_budget_s": args.time_budget_s,
+	}
+	results = {}
+	for name in [name for name in STAGES if name in args.stages]:
+		print(f"Running stage '{name}'...")
+		results.update(run_stage(name, workdir, options, quiet=args.quiet))
+
+	machine = machine_info()
+	results_path = os.path.join(workdir, f"results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+	with open(results_path, "w") as f:
+		json.dump({
+			"scale": args.scale, "settings": settings, "machine": machine, "options": options, "metrics": results
+		}, f, indent=2)
+	print(f"Results saved as {results_path}.")
+
+	baseline_path = os.path.join(BENCHMARK_PATH, f"{args.scale}.json")
+	if args.save_baseline:
+		# Stages that were not run keep their baseline metrics
+		baseline = {}
+		if os.path.exists(baseline_path):
+			with open(baseline_path) as f:
+				baseline = json.load(f)["metrics"]
+		os.makedirs(BENCHMARK_PATH, exist_ok=True)
+		with open(baseline_path, "w") as f:
+			json.dump({
+				"scale": args.scale,
+				"settings": settings,
+				"machine": machine,
+				"options": options,
+				"measured_at": datetime.now().isoformat(timespec="seconds"),
+				"metrics": {**baseline, **results},
+			}, f, indent=2)
+		print(f"Baseline saved as {baseline_path}.")
+	elif os.path.exists(baseline_path):
+		with open(baseline_path) as f:
+			baseline = json.load(f)
+		if baseline["settings"] != settings:
+			parser.exit(2, f"The baseline {baseline_path} was measured on other data: {baseline['settings']}.\n")
+		if baseline.get("options", options) != options:
+			parser.exit(2, f"The baseline {baseline_path} was measured with other options: {baseline['options']}.\n")
+		if baseline.get("machine") != machine:
+			print(
+				f"Warning: the baseline {baseline_path} was measured on another machine ({baseline.get('machine')}), "
+				"the times are not comparable. Store a baseline of this machine with --save-baseline."
+			)
+		rows, regressed = compare(results, baseline["metrics"], args.tolerance)
+		print(format_report(rows))
+		if regressed:
+			parser.exit(1, "Performance regressed against the baseline.\n")
+	else:
+		parser.exit(2, f"No baseline at {baseline_path}, store one with --save-baseline.\n")
@@ -0,0 +1,322 @@
+"""
+End-to-end benchmark of the pipeline on synthetic data.
+
+Every stage runs in its own Python process, with the benchmark directory as working directory, so the relative
+data, feature, model and submission paths of `config.py` point into it and each stage starts cold like the scripts
+do. The parent process reaps the stage with `os.wait4`, which reports the peak resident set size of the stage and
+of the worker processes it waited for. Results are flat {metric: value} dicts that are compared with a stored
+baseline: a time or memory metric regresses when it grows by more than a relative tolerance and an absolute noise
+floor.
+
+A stage process is started as `python -m scripts.benchmarking STAGE RESULT_FILE OPTIONS_JSON`.
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+STAGES: Dict[str, Callable[[dict], dict]] = {}
+
+# Smallest increase that counts as a regression, by metric unit suffix, so noise on fast stages is ignored
+NOISE_FLOORS = {"_s": 0.05, "_ms": 1.0, "_mb": 32.0}
+# Rows scored at once by the 'engines' stage: about one user as in the app, one micro-batch of users, and a large block
+ENGINE_BATCH_ROWS = (256, 4096, 100_000)
+ENGINE_REPEAT = 3
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def stage(name: str):
+	"""
+	Registers a benchmark stage. The function gets the options dict and returns its own metrics.
+	"""
+	def decorator(func: Callable[[dict], dict]) -> Callable[[dict], dict]:
+		STAGES[name] = func
+		return func
+
+	return decorator
+
+
+def _latest_model(model_type: str, extension: Optional[str] = None) -> str:
+	"""
+	Returns the model file that serving loads for a model type, or the latest file with the given extension.
+	"""
+	from config import MODELS_PATH
+	from scripts.utils import model_files
+
+	files = [path for path in model_files(model_type) if extension is None or path.endswith(extension)]
+	if not files:
+		raise FileNotFoundError(f"No {model_type} model in {os.path.abspath(MODELS_PATH)}, run its training stage first.")
+	return files[-1]
+
+
+def _best_of_ms(func: Callable[[], object], repeat: int) -> float:
+	func()
+	times = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		func()
+		times.append(time.perf_counter() - start)
+	return min(times) * 1000
+
+
+def _percentiles_ms(prefix: str, seconds: List[float]) -> Dict[str, float]:
+	milliseconds = np.asarray(seconds) * 1000
+	return {
+		f"{prefix}_p50_ms": float(np.percentile(milliseconds, 50)),
+		f"{prefix}_p95_ms": float(np.percentile(milliseconds, 95)),
+	}
+
+
+@stage("extract_features")
+def extract_features(options: dict) -> dict:
+	import scripts.features  # noqa: registers the features
+	from config import FEATURE_STORE_PATH
+	from scripts.feature_registry import REGISTRY, feature_names, run
+	from scripts.feature_store import GRAIN_KEYS, drop_table, write_features
+
+	# Time every node of the DAG. Nodes run in this process, so the timings are not hidden in worker processes
+	timings = {}
+
+	def timed(name: str, func: Callable) -> Callable:
+		def wrapper(*args):
+			start = time.perf_counter()
+			result = func(*args)
+			timings[f"{name}_s"] = time.perf_counter() - start
+			return result
+
+		return wrapper
+
+	for node in REGISTRY.values():
+		node.func = timed(node.name, node.func)
+
+	os.makedirs(FEATURE_STORE_PATH, exist_ok=True)
+	features = run(feature_names(), jobs=1, reuse_store=False)
+	start = time.perf_counter()
+	for grain in GRAIN_KEYS:
+		drop_table(grain)
+	for name, df in features.items():
+		write_features(REGISTRY[name].grain, df)
+	return {**{f"node.{name}": seconds for name, seconds in timings.items()}, "write_s": time.perf_counter() - start}
+
+
+@stage("load_features")
+def load_features(options: dict) -> dict:
+	from scripts.utils import load_features as load
+
+	return {"rows": len(load())}
+
+
+@stage("load_train_dataset")
+def load_train_dataset(options: dict) -> dict:
+	from scripts.utils import load_train_dataset as load
+
+	return {"rows": len(load())}
+
+
+@stage("prepare_training_data")
+def prepare_training_data(options: dict) -> dict:
+	from scripts.training import prepare_training_data as prepare
+
+	data = prepare(refresh=True)
+	return {f"{split}_rows": len(data.y(split)) for split in ("train", "valid", "test")}
+
+
+def _train(model_type: str) -> Callable[[dict], dict]:
+	def train(options: dict) -> dict:
+		from scripts.training import train_models
+
+		train_models([model_type], time_budget_s=options.get("time_budget_s"))
+		return {}
+
+	return train
+
+
+for _model_type in ("lightgbm", "xgboost", "random_forest"):
+	stage(f"train_{_model_type}")(_train(_model_type))
+
+
+@stage("engines")
+def engines(options: dict) -> dict:
+	"""
+	Scoring time of the latest model of every type with its native predictor and with its flattened trees, one thread
+	each as in a scoring worker, on a serving batch and on a large block of test rows. The input is arranged by
+	`model_input` as for serving. The results decide which models `compile_model` flattens (FLATTENED_MODELS).
+	"""
+	from scripts.boosters import BoosterClassifier
+	from scripts.recommender import model_input
+	from scripts.training import TrainingData
+	from scripts.tree_ensemble import TreeEnsemble
+	from scripts.utils import load_model_file
+
+	data = TrainingData()
+	X_test = data.X("test")
+	metrics = {}
+	for model_type in ("lightgbm", "xgboost", "random_forest"):
+		try:
+			model = load_model_file(_latest_model(model_type, ".pkl"))
+		except FileNotFoundError:
+			continue
+		# Pickles of older training runs hold the bare Booster
+		native = BoosterClassifier(model) if type(model).__name__ == "Booster" else model
+		native.set_params(n_jobs=1)
+		flattened = TreeEnsemble.from_model(native).set_params(n_jobs=1)
+		for rows in ENGINE_BATCH_ROWS:
+			X = np.ascontiguousarray(X_test[:rows])
+			for engine, predictor in (("native", native), ("flattened", flattened)):
+				features = model_input(predictor, X, data.feature_names)
+				metrics[f"{model_type}.{engine}_{len(X)}_rows_ms"] = _best_of_ms(
+					lambda: predictor.predict_proba(features), ENGINE_REPEAT
+				)
+	return metrics
+
+
+@stage("submit")
+def submit(options: dict) -> dict:
+	from config import SUBMIT_PATH
+	from scripts.raw_data import load_raw
+	from scripts.recommender import Recommender
+	from scripts.submission import write_submission
+	from scripts.tree_ensemble import compile_model
+	from scripts.utils import load_model_file
+
+	os.makedirs(SUBMIT_PATH, exist_ok=True)
+	start = time.perf_counter()
+	orders = load_raw('orders', columns=['order_id', 'user_id', 'eval_set'])
+	recommender = Recommender.load()
+	model = compile_model(load_model_file(_latest_model(options["model_type"])))
+	load_s = time.perf_counter() - start
+
+	start = time.perf_counter()
+	path = os.path.join(SUBMIT_PATH, "submission_benchmark.csv")
+	n_orders = write_submission(path, recommender, model, orders[orders.eval_set == 'test'], jobs=options["jobs"])
+	return {"load_s": load_s, "write_s": time.perf_counter() - start, "orders": n_orders}
+
+
+@stage("app")
+def app(options: dict) -> dict:
+	"""
+	Startup of the Gradio app, then the latency of `app.recommend`: the first request (which also loads the model),
+	cold requests of users seen for the first time and warm requests of the same users again.
+	"""
+	start = time.perf_counter()
+	import app as gradio_app
+	startup_s = time.perf_counter() - start
+
+	from scripts.raw_data import load_raw
+
+	model_path = _latest_model(options["model_type"])
+	user_ids = load_raw('orders', columns=['user_id']).user_id.unique()
+	rng = np.random.default_rng(0)
+	user_ids = rng.choice(user_ids, size=min(len(user_ids), options["app_users"] + 1), replace=False)
+
+	def request(user_id) -> float:
+		start = time.perf_counter()
+		gradio_app.recommend(int(user_id), model_path, 0.5)
+		return time.perf_counter() - start
+
+	first_request_ms = request(user_ids[0]) * 1000
+	cold = [request(user_id) for user_id in user_ids[1:]]
+	warm = [request(user_id) for user_id in user_ids[1:]]
+	return {
+		"startup_s": startup_s,
+		"first_request_ms": first_request_ms,
+		**_percentiles_ms("cold", cold),
+		**_percentiles_ms("warm", warm),
+	}
+
+
+def run_stage(name: str, workdir: str, options: dict, quiet: bool = False) -> dict:
+	"""
+	Runs a stage in a new Python process and measures it.
+
+	Args:
+		name (str): Stage name, see `STAGES`.
+		workdir (str): Benchmark directory, with the raw data in 'data/raw/'.
+		options (dict): Options of the stages: 'model_type', 'jobs', 'app_users' and 'time_budget_s'.
+		quiet (bool): Hide the output of the stage.
+
+	Returns:
+		dict: '{name}.wall_s' (whole process), '{name}.peak_rss_mb', '{name}.stage_s' (the stage itself, without the
+		interpreter startup) and the metrics returned by the stage, prefixed by the stage name.
+	"""
+	result_path = os.path.join(workdir, f".benchmark_{name}.json")
+	env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")])))
+	start = time.perf_counter()
+	process = subprocess.Popen(
+		[sys.executable, "-m", "scripts.benchmarking", name, result_path, json.dumps(options)],
+		cwd=workdir, env=env, stdout=subprocess.DEVNULL if quiet else None
+	)
+	_, status, usage = os.wait4(process.pid, 0)
+	process.returncode = os.waitstatus_to_exitcode(status)
+	wall_s = time.perf_counter() - start
+	if process.returncode != 0:
+		raise RuntimeError(f"Benchmark stage '{name}' failed with exit code {process.returncode}.")
+
+	with open(result_path) as f:
+		metrics = json.load(f)
+	os.remove(result_path)
+	# ru_maxrss is in kilobytes on Linux
+	metrics.update({"wall_s": wall_s, "peak_rss_mb": usage.ru_maxrss / 1024})
+	return {f"{name}.{metric}": value for metric, value in metrics.items()}
+
+
+def compare(
+		results: Dict[str, float],
+		baseline: Dict[str, float],
+		tolerance: float = 0.2
+) -> Tuple[List[Tuple[str, Optional[float], float, Optional[float], str]], bool]:
+	"""
+	Compares benchmark results with a baseline. Only time ('_s', '_ms') and memory ('_mb') metrics can regress,
+	other metrics (row counts) are reported when they differ.
+
+	Args:
+		results (Dict[str, float]): Current metrics.
+		baseline (Dict[str, float]): Baseline metrics.
+		tolerance (float): Allowed relative increase.
+
+	Returns:
+		Tuple[List[Tuple[str, Optional[float], float, Optional[float], str]], bool]: (metric, baseline, current,
+		relative change, status) rows, and whether any metric regressed.
+	"""
+	rows = []
+	regressed = False
+	for metric, value in results.items():
+		base = baseline.get(metric)
+		change = (value - base) / base if base else None
+		floor = next((floor for suffix, floor in NOISE_FLOORS.items() if metric.endswith(suffix)), None)
+		if base is None:
+			status = "new"
+		elif floor is None:
+			status = "ok" if value == base else "changed"
+		elif value > base * (1 + tolerance) and value - base > floor:
+			status = "REGRESSION"
+			regressed = True
+		elif value < base * (1 - tolerance) and base - value > floor:
+			status = "improved"
+		else:
+			status = "ok"
+		rows.append((metric, base, value, change, status))
+	return rows, regressed
+
+
+def format_report(rows: List[Tuple[str, Optional[float], float, Optional[float], str]]) -> str:
+	width = max([len(row[0]) for row in rows] + [len("metric")])
+	lines = [f"{'metric':<{width}}  {'baseline':>12}  {'current':>12}  {'change':>8}  status"]
+	for metric, base, value, change, status in rows:
+		base_text = "-" if base is None else f"{base:.4g}"
+		change_text = "-" if change is None else f"{change:+.1%}"
+		lines.append(f"{metric:<{width}}  {base_text:>12}  {value:>12.4g}  {change_text:>8}  {status}")
+	return "\n".join(lines)
+
+
+if __name__ == "__main__":
+	stage_name, output_path, stage_options = sys.argv[1], sys.argv[2], json.loads(sys.argv[3])
+	stage_start = time.perf_counter()
+	stage_metrics = STAGES[stage_name](stage_options)
+	stage_metrics["stage_s"] = time.perf_counter() - stage_start
+	with open(output_path, "w") as output:
+		json.dump(stage_metrics, output)
@@ -0,0 +1,80 @@
+"""
+Scikit-learn style classifier around the native LightGBM and XGBoost boosters.
+
+The training driver fits `lgb.Booster` and `xgb.Booster` objects directly, on its cached binned datasets. They are
+pickled inside a BoosterClassifier, which gives them the interface of LGBMClassifier and XGBClassifier that the app,
+the notebooks and `joblib.load(...).predict_proba` rely on, and predicts with the native boosters on float32 arrays.
+"""
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+
+def is_lightgbm(booster) -> bool:
+	# LightGBM and XGBoost both name their native model class Booster
+	return type(booster).__module__.startswith("lightgbm")
+
+
+class BoosterClassifier:
+	"""
+	Binary classifier around a trained LightGBM or XGBoost Booster.
+	"""
+
+	def __init__(self, booster, n_jobs: Optional[int] = None):
+		"""
+		Args:
+			booster: Trained `lgb.Booster` or `xgb.Booster` with the binary logistic objective and feature names.
+			n_jobs (Optional[int]): Prediction threads. None or -1 for all cores.
+		"""
+		self.booster_ = booster
+		self.n_jobs = n_jobs
+		names = booster.feature_name() if is_lightgbm(booster) else booster.feature_names
+		self.feature_names_in_ = np.array(names, dtype=object)
+		self.n_features_in_ = len(names)
+		self.classes_ = np.array([0, 1])
+
+	@property
+	def feature_importances_(self) -> np.ndarray:
+		"""
+		Importance of every feature, as LGBMClassifier (number of splits) and XGBClassifier (normalized gain) report it.
+		"""
+		if is_lightgbm(self.booster_):
+			return self.booster_.feature_importance(importance_type="split")
+		gain = self.booster_.get_score(importance_type="gain")
+		importances = np.array([gain.get(name, 0.0) for name in self.feature_names_in_], dtype=np.float32)
+		total = importances.sum()
+		return importances / total if total > 0 else importances
+
+	def get_params(self, deep: bool = True) -> dict:
+		return {"n_jobs": self.n_jobs}
+
+	def set_params(self, **params) -> "BoosterClassifier":
+		for name, value in params.items():
+			if name != "n_jobs":
+				raise ValueError(f"Unknown parameter '{name}'.")
+			self.n_jobs = value
+		return self
+
+	def _features(self, X) -> np.ndarray:
+		if isinstance(X, pd.DataFrame):
+			X = X[list(self.feature_names_in_)].to_numpy(dtype=np.float32)
+		X = np.asarray(X, dtype=np.float32)
+		if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+			raise ValueError(f"Expected a matrix with {self.n_features_in_} features, got shape {X.shape}.")
+		return X
+
+	def predict_proba(self, X) -> np.ndarray:
+		X = self._features(X)
+		# Both libraries use all cores for 0 threads
+		n_jobs = 0 if self.n_jobs in (None, -1) else self.n_jobs
+		if is_lightgbm(self.booster_):
+			# Predicts with the trees up to the best iteration of early stopping
+			scores = self.booster_.predict(X, num_threads=n_jobs)
+		else:
+			self.booster_.set_param({"nthread": n_jobs})
+			scores = self.booster_.inplace_predict(X)
+		return np.column_stack([1 - scores, scores])
+
+	def predict(self, X) -> np.ndarray:
+		return (self.predict_proba(X)[:, 1] > 0.5).astype(np.int64)
@@ -0,0 +1,22 @@
+import argparse
+
+import autorootcwd  # noqa
+
+from config import RETRIEVAL_COMPONENTS, RETRIEVAL_INDEX_PATH
+from scripts.retrieval import build_retrieval_index
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		description="Build the retrieval index of products users have never bought, from the prior orders."
+	)
+	parser.add_argument(
+		"--components", type=int, default=RETRIEVAL_COMPONENTS, help="Dimension of the user and product embeddings."
+	)
+	parser.add_argument(
+		"--lists", type=int, default=None,
+		help="Number of k-means lists of products. Defaults to the square root of the number of products."
+	)
+	parser.add_argument("--output", default=RETRIEVAL_INDEX_PATH, help="Path of the index file.")
+	args = parser.parse_args()
+
+	build_retrieval_index(n_components=args.components, n_lists=args.lists, path=args.output)
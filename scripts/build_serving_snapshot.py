@@ -0,0 +1,20 @@
+import argparse
+
+import autorootcwd  # noqa
+
+from config import SERVING_SNAPSHOT_PATH
+from scripts.feature_index import FeatureIndex
+from scripts.recommender import load_product_names
+from scripts.serving_snapshot import build_serving_snapshot
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		description="Pack the serving feature index and the product names into one memory-mappable snapshot."
+	)
+	parser.add_argument("--output", default=SERVING_SNAPSHOT_PATH, help="Path of the snapshot file.")
+	args = parser.parse_args()
+
+	print("Building the feature index...")
+	feature_index = FeatureIndex.load()
+	build_serving_snapshot(feature_index, load_product_names(), path=args.output)
+	print(f"Serving snapshot saved as {args.output}.")
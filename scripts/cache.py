@@ -0,0 +1,146 @@
+import hashlib
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+import numpy as np
+import pandas as pd
+
+
+def estimate_size(value: Any) -> int:
+	"""
+	Estimates the memory footprint of a cached value in bytes.
+
+	Args:
+		value (Any): A NumPy array, a pandas object, or a tuple/list of them.
+
+	Returns:
+		int: Approximate size in bytes.
+	"""
+	if isinstance(value, np.ndarray):
+		return value.nbytes
+	if isinstance(value, pd.DataFrame):
+		return int(value.memory_usage(index=True, deep=True).sum())
+	if isinstance(value, (pd.Series, pd.Index)):
+		return int(value.memory_usage(deep=True))
+	if isinstance(value, (tuple, list)):
+		return sum(estimate_size(item) for item in value)
+	return sys.getsizeof(value)
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+	"""
+	Computes the SHA-256 hash of a file's content.
+
+	Args:
+		path (str): Path to the file.
+		chunk_size (int): Number of bytes read at once.
+
+	Returns:
+		str: Hex digest of the file content.
+	"""
+	digest = hashlib.sha256()
+	with open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(chunk_size), b""):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+
+class LRUCache:
+	"""
+	Thread-safe least-recently-used cache bounded by item count and/or estimated size in bytes.
+	"""
+
+	def __init__(
+			self,
+			max_items: Optional[int] = None,
+			max_bytes: Optional[int] = None,
+			sizeof: Callable[[Any], int] = estimate_size
+	):
+		"""
+		Args:
+			max_items (Optional[int]): Maximum number of cached values. None for no limit.
+			max_bytes (Optional[int]): Maximum total size of cached values. None for no limit.
+			sizeof (Callable[[Any], int]): Size estimator used when `put` is not given a size.
+		"""
+		self.max_items = max_items
+		self.max_bytes = max_bytes
+		self.sizeof = sizeof
+
+		self._lock = threading.Lock()
+		self._items = OrderedDict()  # key -> (value, size)
+		self._bytes = 0
+
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __len__(self) -> int:
+		return len(self._items)
+
+	def __contains__(self, key: Hashable) -> bool:
+		with self._lock:
+			return key in self._items
+
+	def get(self, key: Hashable, default: Any = None) -> Any:
+		with self._lock:
+			if key not in self._items:
+				self.misses += 1
+				return default
+
+			self._items.move_to_end(key)
+			self.hits += 1
+			return self._items[key][0]
+
+	def put(self, key: Hashable, value: Any, size: Optional[int] = None) -> None:
+		size = self.sizeof(value) if size is None else size
+
+		with self._lock:
+			if key in self._items:
+				self._bytes -= self._items.pop(key)[1]
+
+			# Values larger than the whole budget are not cached at all
+			if self.max_bytes is not None and size > self.max_bytes:
+				return
+
+			self._items[key] = (value, size)
+			self._bytes += size
+			self._evict()
+
+	def get_or_compute(self, key: Hashable, compute: Callable[[], Any], size: Optional[int] = None) -> Any:
+		"""
+		Returns the cached value of key, computing and caching it on a miss.
+		The value is computed outside the lock, so slow computations don't block other keys.
+		`size` is the size of the computed value, estimated with `sizeof` if None.
+		"""
+		sentinel = object()
+		value = self.get(key, sentinel)
+		if value is sentinel:
+			value = compute()
+			self.put(key, value, size)
+		return value
+
+	def clear(self) -> None:
+		with self._lock:
+			self._items.clear()
+			self._bytes = 0
+
+	def stats(self) -> dict:
+		with self._lock:
+			return {
+				"items": len(self._items),
+				"bytes": self._bytes,
+				"hits": self.hits,
+				"misses": self.misses,
+				"evictions": self.evictions,
+			}
+
+	def _evict(self) -> None:
+		while self._items and (
+				(self.max_items is not None and len(self._items) > self.max_items)
+				or (self.max_bytes is not None and self._bytes > self.max_bytes)
+		):
+			_, (_, size) = self._items.popitem(last=False)
+			self._bytes -= size
+			self.evictions += 1
@@ -0,0 +1,282 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from config import FEATURE_STORE_PATH
+from scripts.feature_store import read_arrays, store_exists
+from scripts.utils import load_features_with_prefix
+
+
+def _dense_by_id(ids: np.ndarray, values: np.ndarray, size: int) -> np.ndarray:
+	"""
+	Scatters per-id feature rows into a dense array addressed by id. Unknown ids get zero features.
+	"""
+	dense = np.zeros((size, values.shape[1]), dtype=np.float32)
+	dense[ids] = values
+	return dense
+
+
+def _stack(columns: Dict[str, np.ndarray], names: List[str]) -> np.ndarray:
+	"""
+	Stacks feature columns into a float32 matrix, replacing missing values with 0.
+	"""
+	matrix = np.empty((len(next(iter(columns.values()))), len(names)), dtype=np.float32)
+	for i, name in enumerate(names):
+		matrix[:, i] = columns[name]
+	np.nan_to_num(matrix, copy=False, nan=0.0)
+	return matrix
+
+
+class FeatureIndex:
+	"""
+	Serving index over the feature tables.
+
+	The user-product rows are sorted by user with per-user offsets, and user and product features
+	are dense arrays addressed by id, so the feature block of one user is a slice plus two gathers.
+	"""
+
+	def __init__(
+			self,
+			up_user_ids: np.ndarray,
+			up_product_ids: np.ndarray,
+			up_values: np.ndarray,
+			u_ids: np.ndarray,
+			u_values: np.ndarray,
+			p_ids: np.ndarray,
+			p_values: np.ndarray,
+			up_names: List[str],
+			u_names: List[str],
+			p_names: List[str],
+	):
+		order = np.lexsort((up_product_ids, up_user_ids))
+		if not np.array_equal(order, np.arange(len(order))):
+			up_user_ids, up_product_ids, up_values = up_user_ids[order], up_product_ids[order], up_values[order]
+
+		n_users = int(max(up_user_ids.max(initial=0), u_ids.max(initial=0))) + 1
+		n_products = int(max(up_product_ids.max(initial=0), p_ids.max(initial=0))) + 1
+
+		self.offsets = np.zeros(n_users + 1, dtype=np.int64)
+		np.cumsum(np.bincount(up_user_ids, minlength=n_users), out=self.offsets[1:])
+
+		self.up_product_ids = np.ascontiguousarray(up_product_ids, dtype=np.uint32)
+		self.up_values = up_values
+		self.u_values = _dense_by_id(u_ids, u_values, n_users)
+		self.p_values = _dense_by_id(p_ids, p_values, n_products)
+
+		self.up_names = up_names
+		self.u_names = u_names
+		self.p_names = p_names
+		self.feature_names = up_names + u_names + p_names
+
+	@classmethod
+	def from_arrays(
+			cls,
+			offsets: np.ndarray,
+			up_product_ids: np.ndarray,
+			up_values: np.ndarray,
+			u_values: np.ndarray,
+			p_values: np.ndarray,
+			up_names: List[str],
+			u_names: List[str],
+			p_names: List[str],
+	):
+		"""
+		Wraps the arrays of a built index, e.g. memory-mapped from a serving snapshot, without copying them.
+		"""
+		index = cls.__new__(cls)
+		index.offsets = offsets
+		index.up_product_ids = up_product_ids
+		index.up_values = up_values
+		index.u_values = u_values
+		index.p_values = p_values
+		index.up_names = list(up_names)
+		index.u_names = list(u_names)
+		index.p_names = list(p_names)
+		index.feature_names = index.up_names + index.u_names + index.p_names
+		return index
+
+	def arrays(self) -> Dict[str, np.ndarray]:
+		"""
+		Returns the arrays of the index, as accepted by `from_arrays`.
+		"""
+		return {
+			"offsets": self.offsets,
+			"up_product_ids": self.up_product_ids,
+			"up_values": self.up_values,
+			"u_values": self.u_values,
+			"p_values": self.p_values,
+		}
+
+	@classmethod
+	def from_frames(cls, up_features: pd.DataFrame, u_features: pd.DataFrame, p_features: pd.DataFrame):
+		"""
+		Builds the index from the feature DataFrames returned by `load_features_with_prefix`.
+		"""
+		up_names = [c for c in up_features.columns if c not in ('user_id', 'product_id')]
+		u_names = [c for c in u_features.columns if c != 'user_id']
+		p_names = [c for c in p_features.columns if c != 'product_id']
+
+		return cls(
+			up_user_ids=up_features['user_id'].to_numpy(np.int64),
+			up_product_ids=up_features['product_id'].to_numpy(np.int64),
+			up_values=_stack({c: up_features[c].to_numpy() for c in up_names}, up_names),
+			u_ids=u_features['user_id'].to_numpy(np.int64),
+			u_values=_stack({c: u_features[c].to_numpy() for c in u_names}, u_names),
+			p_ids=p_features['product_id'].to_numpy(np.int64),
+			p_values=_stack({c: p_features[c].to_numpy() for c in p_names}, p_names),
+			up_names=up_names,
+			u_names=u_names,
+			p_names=p_names,
+		)
+
+	@classmethod
+	def from_store(cls, store_path: str = FEATURE_STORE_PATH):
+		"""
+		Builds the index straight from the memory-mapped feature store columns, without DataFrames.
+		"""
+		up = read_arrays('up', store_path=store_path)
+		u = read_arrays('u', store_path=store_path)
+		p = read_arrays('p', store_path=store_path)
+
+		up_names = [c for c in up if c not in ('user_id', 'product_id')]
+		u_names = [c for c in u if c != 'user_id']
+		p_names = [c for c in p if c != 'product_id']
+
+		return cls(
+			up_user_ids=np.asarray(up['user_id'], dtype=np.int64),
+			up_product_ids=np.asarray(up['product_id'], dtype=np.int64),
+			up_values=_stack(up, up_names),
+			u_ids=np.asarray(u['user_id'], dtype=np.int64),
+			u_values=_stack(u, u_names),
+			p_ids=np.asarray(p['product_id'], dtype=np.int64),
+			p_values=_stack(p, p_names),
+			up_names=up_names,
+			u_names=u_names,
+			p_names=p_names,
+		)
+
+	@classmethod
+	def load(cls):
+		"""
+		Builds the index from the feature store, or from the per-feature CSV files if there is no store.
+		"""
+		if store_exists():
+			return cls.from_store()
+
+		return cls.from_frames(
+			load_features_with_prefix('up_', merge_on=['user_id', 'product_id']),
+			load_features_with_prefix('u_', merge_on='user_id'),
+			load_features_with_prefix('p_', merge_on='product_id'),
+		)
+
+	@property
+	def n_features(self) -> int:
+		return len(self.feature_names)
+
+	def user_rows(self, user_id: int) -> Tuple[int, int]:
+		"""
+		Returns the [start, end) range of the user's rows in the user-product arrays.
+		"""
+		if user_id < 0 or user_id + 1 >= len(self.offsets):
+			return 0, 0
+		return int(self.offsets[user_id]), int(self.offsets[user_id + 1])
+
+	def user_features(self, user_id: int, out: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+		"""
+		Builds the feature matrix of all candidate products of a user.
+
+		Args:
+			user_id (int): The user to build the features for.
+			out (Optional[np.ndarray]): Preallocated float32 matrix to write the features into.
+
+		Returns:
+			Tuple[np.ndarray, np.ndarray]: Candidate product ids and their float32 feature matrix.
+		"""
+		start, end = self.user_rows(user_id)
+		product_ids = self.up_product_ids[start:end]
+		if start == end:
+			return product_ids, np.empty((0, self.n_features), dtype=np.float32)
+
+		n_up, n_u = len(self.up_names), len(self.u_names)
+		features = np.empty((end - start, self.n_features), dtype=np.float32) if out is None else out
+		features[:, :n_up] = self.up_values[start:end]
+		features[:, n_up:n_up + n_u] = self.u_values[user_id]
+		features[:, n_up + n_u:] = self.p_values[product_ids]
+		return product_ids, features
+
+	def users_features(self, user_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+		"""
+		Builds one stacked feature matrix with the candidate products of several users.
+
+		Args:
+			user_ids (np.ndarray): The users to build the features for. Unknown users get no rows.
+
+		Returns:
+			Tuple[np.ndarray, np.ndarray, np.ndarray]: User id and product id of every row, and the float32 feature matrix.
+		"""
+		user_ids = np.asarray(user_ids, dtype=np.int64)
+		known = (user_ids >= 0) & (user_ids + 1 < len(self.offsets))
+
+		starts = np.zeros(len(user_ids), dtype=np.int64)
+		ends = np.zeros(len(user_ids), dtype=np.int64)
+		starts[known] = self.offsets[user_ids[known]]
+		ends[known] = self.offsets[user_ids[known] + 1]
+		lengths = ends - starts
+
+		# Concatenate the [start, end) row ranges of all users without a Python loop
+		row_user_ids = np.repeat(user_ids, lengths)
+		rows = np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+		product_ids = self.up_product_ids[rows]
+
+		n_up, n_u = len(self.up_names), len(self.u_names)
+		features = np.empty((len(rows), self.n_features), dtype=np.float32)
+		features[:, :n_up] = self.up_values[rows]
+		features[:, n_up:n_up + n_u] = self.u_values[row_user_ids]
+		features[:, n_up + n_u:] = self.p_values[product_ids]
+		return row_user_ids, product_ids, features
+
+	def pairs_features(self, user_ids: np.ndarray, product_ids: np.ndarray) -> np.ndarray:
+		"""
+		Builds the feature rows of any (user, product) pairs, including products the user has never bought.
+		Pairs without user-product features get 0 for them, as a product that was never bought would,
+		and unknown users and products get 0 for their features.
+
+		Args:
+			user_ids (np.ndarray): User id of every pair.
+			product_ids (np.ndarray): Product id of every pair.
+
+		Returns:
+			np.ndarray: float32 feature matrix with a row per pair.
+		"""
+		user_ids = np.asarray(user_ids, dtype=np.int64)
+		product_ids = np.asarray(product_ids, dtype=np.int64)
+		n_up, n_u = len(self.up_names), len(self.u_names)
+		features = np.zeros((len(user_ids), self.n_features), dtype=np.float32)
+
+		# Group the pairs by user once. The products of a user are sorted, so every pair is a binary search in its
+		# user's rows
+		order = np.argsort(user_ids, kind="stable")
+		unique_user_ids, firsts, counts = np.unique(user_ids[order], return_index=True, return_counts=True)
+		for user_id, first, count in zip(unique_user_ids, firsts, counts):
+			start, end = self.user_rows(int(user_id))
+			if start == end:
+				continue
+			pairs = order[first:first + count]
+			positions = start + np.searchsorted(self.up_product_ids[start:end], product_ids[pairs])
+			found = positions < end
+			found[found] = self.up_product_ids[positions[found]] == product_ids[pairs[found]]
+			features[pairs[found], :n_up] = self.up_values[positions[found]]
+
+		known_users = (user_ids >= 0) & (user_ids < len(self.u_values))
+		features[known_users, n_up:n_up + n_u] = self.u_values[user_ids[known_users]]
+		known_products = (product_ids >= 0) & (product_ids < len(self.p_values))
+		features[known_products, n_up + n_u:] = self.p_values[product_ids[known_products]]
+		return features
+
+	def user_frame(self, user_id: int) -> pd.DataFrame:
+		"""
+		Same as `user_features`, as a DataFrame indexed by 'product_id' with named feature columns.
+		"""
+		product_ids, features = self.user_features(user_id)
+		return pd.DataFrame(features, index=pd.Index(product_ids, name='product_id'), columns=self.feature_names)
@@ -0,0 +1,196 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+
+from scripts.feature_store import feature_grain, read_manifest, read_table
+from scripts.instrumentation import stage
+
+
+@dataclass
+class Node:
+	"""
+	A step of the extraction DAG: either a feature written to the feature store,
+	or an intermediate result (raw table, join, shared aggregate) that is only passed to other nodes.
+	"""
+	name: str
+	func: Callable
+	inputs: List[str] = field(default_factory=list)
+	grain: Optional[str] = None  # None for intermediates
+
+	@property
+	def is_feature(self) -> bool:
+		return self.grain is not None
+
+
+REGISTRY: Dict[str, Node] = {}
+
+# Results of the nodes computed so far. Worker processes are forked after each level is ready,
+# so they read their inputs from here instead of receiving pickled copies.
+_results: Dict[str, object] = {}
+
+
+def _register(node: Node) -> None:
+	if node.name in REGISTRY:
+		raise ValueError(f"Node '{node.name}' is already registered.")
+	missing = [name for name in node.inputs if name not in REGISTRY]
+	if missing:
+		raise ValueError(f"Inputs of '{node.name}' must be registered first: {missing}")
+	REGISTRY[node.name] = node
+
+
+def intermediate(inputs: Sequence[str] = ()):
+	"""
+	Registers a function computing an intermediate result. The node is named after the function,
+	and the results of `inputs` are passed to it as positional arguments.
+	"""
+	def decorator(func: Callable) -> Callable:
+		_register(Node(name=func.__name__, func=func, inputs=list(inputs)))
+		return func
+
+	return decorator
+
+
+def feature(grain: str, inputs: Sequence[str] = ()):
+	"""
+	Registers a function computing a feature of the given grain ('u', 'p' or 'up'). The feature is named after
+	the function and must return a DataFrame with the grain keys and a column with the feature name.
+	"""
+	def decorator(func: Callable) -> Callable:
+		if feature_grain(func.__name__) != grain:
+			raise ValueError(f"Feature '{func.__name__}' must be prefixed with '{grain}_'.")
+		_register(Node(name=func.__name__, func=func, inputs=list(inputs), grain=grain))
+		return func
+
+	return decorator
+
+
+def feature_names() -> List[str]:
+	return [name for name, node in REGISTRY.items() if node.is_feature]
+
+
+def plan(targets: Iterable[str], stored: Iterable[str] = ()) -> List[List[str]]:
+	"""
+	Resolves the nodes needed to compute the targets and groups them into levels.
+	Nodes of a level only depend on nodes of earlier levels, so they can run in parallel.
+
+	Args:
+		targets (Iterable[str]): Features to compute.
+		stored (Iterable[str]): Features available in the feature store. They are read instead of recomputed
+			when another target depends on them.
+
+	Returns:
+		List[List[str]]: Levels of node names, in registry order within each level.
+	"""
+	targets, stored = set(targets), set(stored)
+	unknown = [name for name in targets if name not in REGISTRY or not REGISTRY[name].is_feature]
+	if unknown:
+		raise KeyError(f"Unknown features: {sorted(unknown)}")
+
+	needed = set()
+
+	def visit(name: str) -> None:
+		if name in needed:
+			return
+		needed.add(name)
+		if name in stored and name not in targets:
+			return
+		for input_name in REGISTRY[name].inputs:
+			visit(input_name)
+
+	for name in targets:
+		visit(name)
+
+	# Registry order is a topological order, since inputs must be registered before their consumers
+	levels: Dict[str, int] = {}
+	for name in REGISTRY:
+		if name in needed:
+			loaded = name in stored and name not in targets
+			levels[name] = 0 if loaded else 1 + max((levels[i] for i in REGISTRY[name].inputs), default=-1)
+
+	return [
+		[name for name in levels if levels[name] == level]
+		for level in range(max(levels.values(), default=-1) + 1)
+	]
+
+
+def _compute(name: str):
+	node = REGISTRY[name]
+	if node.is_feature:
+		print(f"Extracting '{name}'")
+	with stage(f"{'feature' if node.is_feature else 'intermediate'}.{name}") as record:
+		result = node.func(*(_results[input_name] for input_name in node.inputs))
+		record.rows = len(result) if hasattr(result, "__len__") else None
+	return result
+
+
+def run(targets: Iterable[str], jobs: int = 1, reuse_store: bool = True) -> Dict[str, object]:
+	"""
+	Computes the target features. Each intermediate is computed once and shared by all its consumers,
+	and is released as soon as its last consumer is done.
+	Independent features of a level are computed in a pool of forked worker processes.
+
+	Args:
+		targets (Iterable[str]): Features to compute.
+		jobs (int): Number of worker processes. 1 computes everything in the current process.
+		reuse_store (bool): Read non-target features from the feature store instead of recomputing them.
+
+	Returns:
+		Dict[str, object]: The target features, in registry order.
+	"""
+	targets = set(targets)
+	stored = set()
+	if reuse_store:
+		for grain, table in read_manifest()["tables"].items():
+			stored.update(name for name in table["columns"] if name not in table["keys"])
+
+	levels = plan(targets, stored)
+	needed = {name for level in levels for name in level}
+
+	# Number of nodes still waiting for each result
+	consumers = {name: 0 for name in needed}
+	for name in needed:
+		if name in stored and name not in targets:
+			continue
+		for input_name in REGISTRY[name].inputs:
+			consumers[input_name] += 1
+
+	# Process pools need 'fork' to share the computed inputs with the workers
+	parallel = jobs > 1 and "fork" in multiprocessing.get_all_start_methods()
+
+	_results.clear()
+	try:
+		for level in levels:
+			loaded = [name for name in level if name in stored and name not in targets]
+			features = [name for name in level if name not in loaded and REGISTRY[name].is_feature]
+			intermediates = [name for name in level if name not in loaded and name not in features]
+
+			for name in loaded:
+				print(f"Loading '{name}' from the feature store")
+				grain = REGISTRY[name].grain
+				_results[name] = read_table(grain, columns=[name])
+
+			if parallel and len(features) > 1:
+				context = multiprocessing.get_context("fork")
+				with ProcessPoolExecutor(max_workers=min(jobs, len(features)), mp_context=context) as pool:
+					futures = {name: pool.submit(_compute, name) for name in features}
+					for name in intermediates:
+						_results[name] = _compute(name)
+					for name, future in futures.items():
+						_results[name] = future.result()
+			else:
+				for name in features + intermediates:
+					_results[name] = _compute(name)
+
+			# Release results that are no longer needed
+			for name in level:
+				if name in loaded:
+					continue
+				for input_name in REGISTRY[name].inputs:
+					consumers[input_name] -= 1
+					if consumers[input_name] == 0 and input_name not in targets:
+						del _results[input_name]
+
+		return {name: _results[name] for name in REGISTRY if name in targets}
+	finally:
+		_results.clear()
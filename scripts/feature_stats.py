@@ -0,0 +1,244 @@
+"""
+Sufficient statistics of the features.
+
+Every feature is a decomposable aggregate (count, sum, min, max) or a function of such aggregates, so statistics
+computed on separate chunks of orders can be combined and finalized into the same values as a full extraction.
+"""
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+
+from config import FEATURE_STATE_PATH, FEATURE_STORE_PATH
+from scripts.aggregations import group_value_counts
+from scripts.feature_store import GRAIN_KEYS, read_manifest, read_table, write_table
+from scripts.raw_data import load_raw, read_csv_typed
+
+Stats = Dict[str, pd.DataFrame]
+
+N_DOW = 7
+N_HOD = 24
+LAST_N = 5  # window of up_last_five
+
+DOW_COLUMNS = [f"dow_{i}" for i in range(N_DOW)]
+HOD_COLUMNS = [f"hod_{i}" for i in range(N_HOD)]
+
+# Number of set bits of every possible last-five bitmask
+_POPCOUNT = np.array([bin(mask).count("1") for mask in range(1 << LAST_N)], dtype=np.int64)
+
+
+def partial_stats(orders_prior: pd.DataFrame) -> Stats:
+	"""
+	Computes the sufficient statistics of a set of prior orders joined with their products.
+
+	Args:
+		orders_prior (pd.DataFrame): Join of 'orders' and 'order_products__prior'.
+
+	Returns:
+		Stats: Statistics by grain ('u', 'p', 'up'), keyed by the grain keys.
+	"""
+	u = orders_prior.groupby('user_id').agg(
+		total_orders=('order_number', 'max'),
+		n_orders=('order_id', 'nunique'),
+		n_products=('product_id', 'size'),
+		reordered_sum=('reordered', 'sum'),
+	)
+	user_ids = orders_prior['user_id'].to_numpy()
+	_, dow_counts = group_value_counts(user_ids, orders_prior['order_dow'].to_numpy(), N_DOW)
+	_, hod_counts = group_value_counts(user_ids, orders_prior['order_hour_of_day'].to_numpy(), N_HOD)
+	u[DOW_COLUMNS] = dow_counts
+	u[HOD_COLUMNS] = hod_counts
+
+	p = orders_prior.groupby('product_id').agg(
+		n=('order_id', 'size'),
+		reordered_sum=('reordered', 'sum'),
+		cart_sum=('add_to_cart_order', 'sum'),
+	)
+
+	# Bit i of the last-five mask is set if the product is in the user's i-th order counted from the last one (0).
+	# A product appears at most once per order, so summing the bits of a group is the same as OR-ing them.
+	orders_back = (
+			orders_prior['user_id'].map(u['total_orders']).to_numpy(np.int64)
+			- orders_prior['order_number'].to_numpy(np.int64)
+	)
+	last_five = np.where(orders_back < LAST_N, 1 << np.minimum(orders_back, LAST_N), 0)
+	up = orders_prior[['user_id', 'product_id', 'order_id', 'order_number']].assign(last_five=last_five).groupby(
+		['user_id', 'product_id']
+	).agg(
+		n=('order_id', 'size'),
+		first_order=('order_number', 'min'),
+		last_five=('last_five', 'sum'),
+	)
+
+	return {grain: stats.reset_index().astype(np.int64) for grain, stats in {'u': u, 'p': p, 'up': up}.items()}
+
+
+def combine_stats(old: Stats, new: Stats) -> Stats:
+	"""
+	Combines the statistics of two sets of orders. Orders in `new` of a user present in `old` must come after
+	the user's orders in `old`, which holds for disjoint users and for newly arrived orders.
+
+	Args:
+		old (Stats): Statistics of the earlier orders.
+		new (Stats): Statistics of the later orders.
+
+	Returns:
+		Stats: Statistics of all orders.
+	"""
+	u = pd.concat([old['u'], new['u']]).groupby('user_id', sort=True).agg(
+		{'total_orders': 'max', **{c: 'sum' for c in old['u'].columns if c not in ('user_id', 'total_orders')}}
+	).reset_index()
+
+	p = pd.concat([old['p'], new['p']]).groupby('product_id', sort=True).sum().reset_index()
+
+	# Age the last-five masks of the earlier orders by the number of orders the user made since
+	old_totals = old['u'].set_index('user_id')['total_orders']
+	# Over the users of the earlier orders only: users new in `new` would be NaN and turn the shift into floats
+	shift = (
+		(u.set_index('user_id')['total_orders'].reindex(old_totals.index) - old_totals)
+		.reindex(old['up'].user_id).to_numpy().astype(np.int64)
+	)
+	if (new['up'].user_id.isin(old_totals.index)).any():
+		new_first = new['up'].groupby('user_id')['first_order'].min()
+		overlap = new_first.index.intersection(old_totals.index)
+		if (new_first[overlap] <= old_totals[overlap]).any():
+			raise ValueError("New orders must come after the already aggregated orders of the same user.")
+
+	old_up = old['up'].copy()
+	aged = np.left_shift(old_up['last_five'].to_numpy(), np.minimum(shift, LAST_N)) & ((1 << LAST_N) - 1)
+	old_up['last_five'] = np.where(shift < LAST_N, aged, 0)
+
+	up = pd.concat([old_up, new['up']]).groupby(['user_id', 'product_id'], sort=True).agg(
+		n=('n', 'sum'),
+		first_order=('first_order', 'min'),
+		last_five=('last_five', 'sum'),
+	).reset_index()
+
+	return {'u': u, 'p': p, 'up': up}
+
+
+def finalize(stats: Stats) -> Dict[str, pd.DataFrame]:
+	"""
+	Computes the features from their sufficient statistics.
+
+	Args:
+		stats (Stats): Statistics by grain.
+
+	Returns:
+		Dict[str, pd.DataFrame]: Feature DataFrames by feature name, as returned by the registered features.
+	"""
+	u, p, up = stats['u'], stats['p'], stats['up']
+
+	u_total_orders = up.user_id.map(u.set_index('user_id')['total_orders'])
+
+	return {
+		'u_total_orders': u[['user_id']].assign(u_total_orders=u.total_orders),
+		'u_avg_prd': u[['user_id']].assign(u_avg_prd=u.n_products / u.n_orders),
+		'u_dow_mode': u[['user_id']].assign(u_dow_mode=u[DOW_COLUMNS].to_numpy().argmax(axis=1)),
+		'u_hod_mode': u[['user_id']].assign(u_hod_mode=u[HOD_COLUMNS].to_numpy().argmax(axis=1)),
+		'u_reorder_ratio': u[['user_id']].assign(
+			u_reorder_ratio=(u.reordered_sum / u.n_products).astype(np.float16)
+		),
+		'p_total_orders': p[['product_id']].assign(p_total_orders=p.n),
+		'p_reorder_ratio': p[['product_id']].assign(p_reorder_ratio=p.reordered_sum / p.n),
+		'p_avg_cart_position': p[['product_id']].assign(p_avg_cart_position=p.cart_sum / p.n),
+		'up_total_orders': up[['user_id', 'product_id']].assign(up_total_orders=up.n),
+		'up_reorder_ratio': up[['user_id', 'product_id']].assign(
+			up_reorder_ratio=up.n / (u_total_orders - up.first_order + 1)
+		),
+		'up_last_five': up[['user_id', 'product_id']].assign(
+			up_last_five=_POPCOUNT[up.last_five.to_numpy()].astype(np.float64)
+		),
+	}
+
+
+def join_orders_prior(orders: pd.DataFrame, order_products: pd.DataFrame) -> pd.DataFrame:
+	return orders[orders.eval_set == 'prior'].merge(order_products, on='order_id', how='inner')
+
+
+def save_state(stats: Stats, state_path: str = FEATURE_STATE_PATH) -> None:
+	for grain, df in stats.items():
+		write_table(grain, df, store_path=state_path)
+
+
+def load_state(state_path: str = FEATURE_STATE_PATH) -> Stats:
+	if not read_manifest(state_path)["tables"]:
+		raise FileNotFoundError(f"No feature state found at {state_path}. Build it with --save-state first.")
+	# Counts are stored with compact dtypes, widen them before adding to them
+	return {grain: read_table(grain, store_path=state_path).astype(np.int64) for grain in GRAIN_KEYS}
+
+
+def build_state(state_path: str = FEATURE_STATE_PATH) -> Stats:
+	"""
+	Computes the statistics of all prior orders in RAW_DATA_PATH and saves them as the incremental state.
+	"""
+	print("Building feature state...")
+	stats = partial_stats(join_orders_prior(load_raw('orders'), load_raw('order_products__prior')))
+	save_state(stats, state_path)
+	return stats
+
+
+def _split(df: pd.DataFrame, column: str, values: np.ndarray):
+	affected = df[column].isin(values)
+	return df[affected], df[~affected]
+
+
+def apply_delta(
+		orders_path: str,
+		order_products_path: str,
+		state_path: str = FEATURE_STATE_PATH,
+		store_path: str = FEATURE_STORE_PATH
+) -> Dict[str, pd.DataFrame]:
+	"""
+	Folds new prior orders into the saved state and updates the features of the affected users and products.
+	Only rows of the affected users and products are recomputed; the other rows are copied from the feature store.
+
+	Args:
+		orders_path (str): CSV with the new orders, in the format of 'orders.csv'. Only 'prior' orders are used.
+		order_products_path (str): CSV with the products of the new orders, like 'order_products__prior.csv'.
+		state_path (str): Directory of the saved state.
+		store_path (str): Root directory of the feature store to update.
+
+	Returns:
+		Dict[str, pd.DataFrame]: The recomputed rows of every feature.
+	"""
+	print("Loading feature state...")
+	state = load_state(state_path)
+	delta = partial_stats(join_orders_prior(
+		read_csv_typed(orders_path, 'orders'),
+		read_csv_typed(order_products_path, 'order_products__prior'),
+	))
+
+	user_ids = delta['u'].user_id.to_numpy()
+	product_ids = delta['p'].product_id.to_numpy()
+	print(f"Folding in orders of {len(user_ids)} users and {len(product_ids)} products...")
+
+	# Combine only the statistics of the affected users and products.
+	# The up features of a user depend on the user's total orders, so all rows of an affected user are recomputed.
+	affected_u, other_u = _split(state['u'], 'user_id', user_ids)
+	affected_p, other_p = _split(state['p'], 'product_id', product_ids)
+	affected_up, other_up = _split(state['up'], 'user_id', user_ids)
+	combined = combine_stats({'u': affected_u, 'p': affected_p, 'up': affected_up}, delta)
+	features = finalize(combined)
+
+	print("Saving feature state...")
+	save_state({
+		'u': pd.concat([other_u, combined['u']]),
+		'p': pd.concat([other_p, combined['p']]),
+		'up': pd.concat([other_up, combined['up']]),
+	}, state_path)
+
+	print("Updating features...")
+	affected_keys = {'u': ('user_id', user_ids), 'p': ('product_id', product_ids), 'up': ('user_id', user_ids)}
+	for grain, (column, ids) in affected_keys.items():
+		table = read_table(grain, store_path=store_path)
+		_, table = _split(table, column, ids)
+
+		updated = None
+		for name, df in features.items():
+			if name in table.columns:
+				updated = df if updated is None else updated.merge(df, on=GRAIN_KEYS[grain])
+
+		write_table(grain, pd.concat([table, updated[table.columns]]), store_path=store_path)
+
+	return features
@@ -0,0 +1,260 @@
+import json
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from config import FEATURE_STORE_PATH
+
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+
+# Key columns of every feature grain, in sort order.
+GRAIN_KEYS = {
+	"u": ["user_id"],
+	"p": ["product_id"],
+	"up": ["user_id", "product_id"],
+}
+
+KEY_DTYPE = np.uint32
+
+
+def feature_grain(feature_name: str) -> str:
+	"""
+	Returns the grain ('u', 'p' or 'up') of a feature from its name prefix.
+
+	Args:
+		feature_name (str): Feature name, e.g. 'up_last_five'.
+
+	Returns:
+		str: The grain of the feature.
+	"""
+	grain = feature_name.split("_", 1)[0]
+	if grain not in GRAIN_KEYS:
+		raise ValueError(f"Unknown grain for feature '{feature_name}'.")
+	return grain
+
+
+def compact_dtype(values: np.ndarray) -> np.dtype:
+	"""
+	Picks the smallest lossless dtype for integer columns and float32 for float64 columns.
+
+	Args:
+		values (np.ndarray): Column values.
+
+	Returns:
+		np.dtype: The dtype to store the column with.
+	"""
+	if values.dtype == np.bool_ or values.dtype == np.float16 or values.dtype == np.float32:
+		return values.dtype
+	if np.issubdtype(values.dtype, np.integer):
+		if values.size == 0:
+			return np.dtype(np.uint8)
+		return np.result_type(np.min_scalar_type(values.min()), np.min_scalar_type(values.max()))
+	if np.issubdtype(values.dtype, np.floating):
+		return np.dtype(np.float32)
+	raise TypeError(f"Unsupported feature dtype: {values.dtype}")
+
+
+def store_exists(store_path: str = FEATURE_STORE_PATH) -> bool:
+	return os.path.exists(os.path.join(store_path, MANIFEST_FILE))
+
+
+def read_manifest(store_path: str = FEATURE_STORE_PATH) -> dict:
+	"""
+	Reads the manifest of the feature store. An empty manifest is returned if the store does not exist yet.
+
+	Args:
+		store_path (str): Root directory of the feature store.
+
+	Returns:
+		dict: Manifest with the keys, row count and column dtypes of every table.
+	"""
+	if not store_exists(store_path):
+		return {"version": MANIFEST_VERSION, "tables": {}}
+
+	with open(os.path.join(store_path, MANIFEST_FILE)) as f:
+		manifest = json.load(f)
+
+	if manifest.get("version") != MANIFEST_VERSION:
+		raise ValueError(f"Unsupported feature store version: {manifest.get('version')}")
+	return manifest
+
+
+def _write_manifest(manifest: dict, store_path: str) -> None:
+	tmp_path = os.path.join(store_path, MANIFEST_FILE + ".tmp")
+	with open(tmp_path, "w") as f:
+		json.dump(manifest, f, indent=2)
+	os.replace(tmp_path, os.path.join(store_path, MANIFEST_FILE))
+
+
+def _write_column(table_dir: str, name: str, values: np.ndarray) -> None:
+	# Write next to the target and swap it in, so readers never see a half-written column
+	tmp_path = os.path.join(table_dir, f"{name}.tmp.npy")
+	np.save(tmp_path, values)
+	os.replace(tmp_path, os.path.join(table_dir, f"{name}.npy"))
+
+
+def feature_names(grain: str, store_path: str = FEATURE_STORE_PATH) -> List[str]:
+	"""
+	Lists the feature columns of a table in their stored order.
+
+	Args:
+		grain (str): Table grain: 'u', 'p' or 'up'.
+		store_path (str): Root directory of the feature store.
+
+	Returns:
+		List[str]: Feature names, without the key columns.
+	"""
+	table = read_manifest(store_path)["tables"].get(grain)
+	if table is None:
+		return []
+	return [name for name in table["columns"] if name not in table["keys"]]
+
+
+def write_table(grain: str, df: pd.DataFrame, store_path: str = FEATURE_STORE_PATH) -> None:
+	"""
+	Writes (or replaces) a whole table of the feature store. Rows are sorted by the grain keys.
+
+	Args:
+		grain (str): Table grain: 'u', 'p' or 'up'.
+		df (pd.DataFrame): Key columns and feature columns.
+		store_path (str): Root directory of the feature store.
+	"""
+	keys = GRAIN_KEYS[grain]
+	table_dir = os.path.join(store_path, grain)
+	os.makedirs(table_dir, exist_ok=True)
+
+	df = df.sort_values(keys, kind="stable")
+	manifest = read_manifest(store_path)
+
+	# Drop columns of the previous version of the table
+	for file in os.listdir(table_dir):
+		if file.endswith(".npy"):
+			os.remove(os.path.join(table_dir, file))
+
+	columns = {}
+	for name in keys + [c for c in df.columns if c not in keys]:
+		values = df[name].to_numpy()
+		values = values.astype(KEY_DTYPE if name in keys else compact_dtype(values), copy=False)
+		_write_column(table_dir, name, values)
+		columns[name] = values.dtype.name
+
+	manifest["tables"][grain] = {"keys": keys, "rows": len(df), "columns": columns}
+	_write_manifest(manifest, store_path)
+
+
+def drop_table(grain: str, store_path: str = FEATURE_STORE_PATH) -> None:
+	"""
+	Removes a table and its columns from the feature store, if it exists.
+
+	Args:
+		grain (str): Table grain: 'u', 'p' or 'up'.
+		store_path (str): Root directory of the feature store.
+	"""
+	manifest = read_manifest(store_path)
+	if grain not in manifest["tables"]:
+		return
+
+	del manifest["tables"][grain]
+	_write_manifest(manifest, store_path)
+
+	table_dir = os.path.join(store_path, grain)
+	for file in os.listdir(table_dir):
+		if file.endswith(".npy"):
+			os.remove(os.path.join(table_dir, file))
+
+
+def write_features(grain: str, df: pd.DataFrame, store_path: str = FEATURE_STORE_PATH) -> None:
+	"""
+	Adds (or overwrites) feature columns of an existing table, aligned to the table keys.
+	Rows of df whose keys are not in the table are dropped, missing rows become NaN.
+	If the table does not exist yet, it is created from df.
+
+	Args:
+		grain (str): Table grain: 'u', 'p' or 'up'.
+		df (pd.DataFrame): Key columns and feature columns.
+		store_path (str): Root directory of the feature store.
+	"""
+	manifest = read_manifest(store_path)
+	if grain not in manifest["tables"]:
+		write_table(grain, df, store_path)
+		return
+
+	keys = GRAIN_KEYS[grain]
+	table = manifest["tables"][grain]
+	table_keys = read_table(grain, columns=[], store_path=store_path)
+
+	df = df.sort_values(keys, kind="stable")
+	same_keys = len(df) == len(table_keys) and all(
+		np.array_equal(df[key].to_numpy(), table_keys[key].to_numpy()) for key in keys
+	)
+	if not same_keys:
+		df = table_keys.merge(df, on=keys, how="left")
+
+	table_dir = os.path.join(store_path, grain)
+	for name in [c for c in df.columns if c not in keys]:
+		values = df[name].to_numpy()
+		values = values.astype(compact_dtype(values), copy=False)
+		_write_column(table_dir, name, values)
+		table["columns"][name] = values.dtype.name
+
+	_write_manifest(manifest, store_path)
+
+
+def read_arrays(
+		grain: str,
+		columns: Optional[List[str]] = None,
+		mmap_mode: Optional[str] = "r",
+		store_path: str = FEATURE_STORE_PATH
+) -> Dict[str, np.ndarray]:
+	"""
+	Opens the key columns and the requested feature columns of a table as (memory-mapped) arrays.
+
+	Args:
+		grain (str): Table grain: 'u', 'p' or 'up'.
+		columns (Optional[List[str]]): Feature columns to open. If None, open all features.
+		mmap_mode (Optional[str]): Passed to np.load. Use None to read the columns into memory.
+		store_path (str): Root directory of the feature store.
+
+	Returns:
+		Dict[str, np.ndarray]: Arrays by column name, keys first.
+	"""
+	table = read_manifest(store_path)["tables"].get(grain)
+	if table is None:
+		raise FileNotFoundError(f"Table '{grain}' not found in the feature store at {store_path}.")
+
+	if columns is None:
+		columns = [name for name in table["columns"] if name not in table["keys"]]
+
+	missing = [name for name in columns if name not in table["columns"]]
+	if missing:
+		raise KeyError(f"Features not found in table '{grain}': {missing}")
+
+	table_dir = os.path.join(store_path, grain)
+	return {
+		name: np.load(os.path.join(table_dir, f"{name}.npy"), mmap_mode=mmap_mode)
+		for name in table["keys"] + [c for c in columns if c not in table["keys"]]
+	}
+
+
+def read_table(
+		grain: str,
+		columns: Optional[List[str]] = None,
+		store_path: str = FEATURE_STORE_PATH
+) -> pd.DataFrame:
+	"""
+	Reads the key columns and the requested feature columns of a table into a DataFrame.
+	Only the requested columns are read from disk.
+
+	Args:
+		grain (str): Table grain: 'u', 'p' or 'up'.
+		columns (Optional[List[str]]): Feature columns to read. If None, read all features.
+		store_path (str): Root directory of the feature store.
+
+	Returns:
+		pd.DataFrame: The table, sorted by its keys.
+	"""
+	arrays = read_arrays(grain, columns, mmap_mode="r", store_path=store_path)
+	return pd.DataFrame({name: np.asarray(values) for name, values in arrays.items()})
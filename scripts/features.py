@@ -0,0 +1,126 @@
+"""
+Feature definitions. Every function is registered as a node of the extraction DAG:
+its inputs are the results of the nodes it names, and features are named after their function.
+"""
+import numpy as np
+import pandas as pd
+
+from scripts.aggregations import group_mode
+from scripts.feature_registry import feature, intermediate
+from scripts.interactions import InteractionMatrix, load_interactions
+from scripts.raw_data import load_raw
+
+
+# # raw data
+
+@intermediate()
+def orders() -> pd.DataFrame:
+	print("Loading 'orders'")
+	return load_raw('orders')
+
+
+@intermediate()
+def order_products_prior() -> pd.DataFrame:
+	print("Loading 'order_products_prior'")
+	return load_raw('order_products__prior')
+
+
+@intermediate(inputs=['orders', 'order_products_prior'])
+def orders_prior(orders: pd.DataFrame, order_products_prior: pd.DataFrame) -> pd.DataFrame:
+	return orders.merge(order_products_prior, on='order_id', how='inner')
+
+
+# # user features
+
+@feature('u', inputs=['orders_prior'])
+def u_total_orders(orders_prior: pd.DataFrame) -> pd.DataFrame:
+	return orders_prior.groupby('user_id')['order_number'].max().to_frame('u_total_orders').reset_index()
+
+
+@intermediate(inputs=['orders_prior'])
+def total_prd_per_order(orders_prior: pd.DataFrame) -> pd.DataFrame:
+	# The total number of products in each order
+	return orders_prior.groupby(by=['user_id', 'order_id'])['product_id'].aggregate('count').to_frame(
+		'total_products_per_order').reset_index()
+
+
+@feature('u', inputs=['total_prd_per_order'])
+def u_avg_prd(total_prd_per_order: pd.DataFrame) -> pd.DataFrame:
+	# The average products purchased by each user
+	return total_prd_per_order.groupby(by=['user_id'])['total_products_per_order'].mean().to_frame(
+		'u_avg_prd').reset_index()
+
+
+@feature('u', inputs=['orders_prior'])
+def u_dow_mode(orders_prior: pd.DataFrame) -> pd.DataFrame:
+	user_ids, dow_mode = group_mode(
+		orders_prior['user_id'].to_numpy(), orders_prior['order_dow'].to_numpy(), n_values=7
+	)
+	return pd.DataFrame({'user_id': user_ids, 'u_dow_mode': dow_mode})
+
+
+@feature('u', inputs=['orders_prior'])
+def u_hod_mode(orders_prior: pd.DataFrame) -> pd.DataFrame:
+	user_ids, hod_mode = group_mode(
+		orders_prior['user_id'].to_numpy(), orders_prior['order_hour_of_day'].to_numpy(), n_values=24
+	)
+	return pd.DataFrame({'user_id': user_ids, 'u_hod_mode': hod_mode})
+
+
+@feature('u', inputs=['orders_prior'])
+def u_reorder_ratio(orders_prior: pd.DataFrame) -> pd.DataFrame:
+	u_reorder_ratio = orders_prior.groupby(by='user_id')['reordered'].aggregate('mean').to_frame(
+		'u_reorder_ratio').reset_index()
+	u_reorder_ratio['u_reorder_ratio'] = u_reorder_ratio['u_reorder_ratio'].astype(np.float16)
+	return u_reorder_ratio
+
+
+# # product features
+
+@feature('p', inputs=['orders_prior'])
+def p_total_orders(orders_prior: pd.DataFrame) -> pd.DataFrame:
+	return orders_prior.groupby('product_id')['order_id'].count().to_frame('p_total_orders').reset_index()
+
+
+@feature('p', inputs=['orders_prior'])
+def p_reorder_ratio(orders_prior: pd.DataFrame) -> pd.DataFrame:
+	return orders_prior.groupby(by='product_id')['reordered'].mean().to_frame('p_reorder_ratio').reset_index()
+
+
+@feature('p', inputs=['orders_prior'])
+def p_avg_cart_position(orders_prior: pd.DataFrame) -> pd.DataFrame:
+	return orders_prior.groupby(by='product_id')['add_to_cart_order'].mean().to_frame(
+		'p_avg_cart_position').reset_index()
+
+
+# # user-product features
+
+@intermediate()
+def interactions() -> InteractionMatrix:
+	print("Loading 'interactions'")
+	return load_interactions()
+
+
+def _up_frame(interactions: InteractionMatrix, name: str, values: np.ndarray) -> pd.DataFrame:
+	# One row per (user, product) pair, sorted by user and product
+	return pd.DataFrame({'user_id': interactions.pair_user_ids(), 'product_id': interactions.products, name: values})
+
+
+@feature('up', inputs=['interactions'])
+def up_total_orders(interactions: InteractionMatrix) -> pd.DataFrame:
+	return _up_frame(interactions, 'up_total_orders', interactions.counts.astype(np.int64))
+
+
+@feature('up', inputs=['interactions'])
+def up_reorder_ratio(interactions: InteractionMatrix) -> pd.DataFrame:
+	# Calculating the order range between the first order with the product and the user's last order.
+	# The +1 includes in the difference the first order were the product has been purchased
+	user_total_orders = interactions.user_total_orders[interactions.pair_user_ids()].astype(np.int64)
+	order_range = user_total_orders - interactions.first_order + 1
+	return _up_frame(interactions, 'up_reorder_ratio', interactions.counts / order_range)
+
+
+@feature('up', inputs=['interactions'])
+def up_last_five(interactions: InteractionMatrix) -> pd.DataFrame:
+	# Orders with the product among the user's last 5 orders, from the recency bitmask
+	return _up_frame(interactions, 'up_last_five', interactions.recent_counts(5).astype(np.float64))
@@ -0,0 +1,307 @@
+"""
+Lightweight stage instrumentation: wall time, memory deltas and row counts of the steps of the pipeline.
+
+A stage is timed with the `stage` context manager or the `timed` decorator. Every finished stage is
+- aggregated in memory per stage name (count, total and maximum time, rows, latency histogram), for `summary()`
+  and the Prometheus text format of `render_prometheus()`;
+- appended as one JSON line to the metrics log, when one is configured;
+- profiled with cProfile, when its name matches one of the configured profile patterns.
+Stages nest: a stage started inside another one records the outer stage as its parent. Stages of forked worker
+processes are written to the same log, their in-memory aggregates stay in the worker.
+"""
+import cProfile
+import fnmatch
+import functools
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+from config import METRICS_LOG_PATH, PROFILE_PATH, PROFILE_STAGES
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+_lock = threading.Lock()
+_local = threading.local()
+_settings = {"log_path": METRICS_LOG_PATH, "profile": list(PROFILE_STAGES), "profile_path": PROFILE_PATH}
+_aggregates: Dict[str, dict] = {}
+
+
+def _after_fork() -> None:
+	# The lock may have been held by another thread at fork time
+	global _lock
+	_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+	os.register_at_fork(after_in_child=_after_fork)
+
+
+def configure(
+		log_path: Optional[str] = None,
+		profile: Optional[Sequence[str]] = None,
+		profile_path: Optional[str] = None
+) -> None:
+	"""
+	Sets where the stages are logged and which stages are profiled. Arguments left to None keep their setting.
+
+	Args:
+		log_path (Optional[str]): File the JSON lines of the stages are appended to. "" to disable the log.
+		profile (Optional[Sequence[str]]): Stage names or glob patterns (e.g. "feature.*") profiled with cProfile.
+		profile_path (Optional[str]): Directory of the '.prof' files, readable with `pstats` or snakeviz.
+	"""
+	if log_path is not None:
+		_settings["log_path"] = log_path or None
+	if profile is not None:
+		_settings["profile"] = list(profile)
+	if profile_path is not None:
+		_settings["profile_path"] = profile_path
+
+
+def rss_mb() -> Optional[float]:
+	"""
+	Returns the current resident set size of the process in MB, None where /proc is not available.
+	"""
+	try:
+		with open("/proc/self/statm") as f:
+			return int(f.read().split()[1]) * _PAGE_SIZE / 1024 ** 2
+	except OSError:
+		return None
+
+
+def peak_rss_mb() -> float:
+	"""
+	Returns the peak resident set size of the process in MB.
+	"""
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StageRecord:
+	"""
+	A running stage. Set `rows` (or add attributes with `set`) inside the `with` block to have them recorded.
+	"""
+
+	def __init__(self, name: str, parent: Optional[str], rows: Optional[int] = None):
+		self.name = name
+		self.parent = parent
+		self.rows = rows
+		self.attributes = {}
+
+	def set(self, **attributes) -> None:
+		self.attributes.update(attributes)
+
+
+def _profiled(name: str) -> bool:
+	return any(fnmatch.fnmatchcase(name, pattern) for pattern in _settings["profile"])
+
+
+def _aggregate(name: str, seconds: float, rows: Optional[int]) -> None:
+	with _lock:
+		aggregate = _aggregates.get(name)
+		if aggregate is None:
+			aggregate = _aggregates[name] = {
+				"count": 0, "seconds": 0.0, "max_seconds": 0.0, "rows": 0, "buckets": [0] * len(LATENCY_BUCKETS)
+			}
+		aggregate["count"] += 1
+		aggregate["seconds"] += seconds
+		aggregate["max_seconds"] = max(aggregate["max_seconds"], seconds)
+		aggregate["rows"] += rows or 0
+		for i, bound in enumerate(LATENCY_BUCKETS):
+			if seconds <= bound:
+				aggregate["buckets"][i] += 1
+				break
+
+
+def _log(entry: dict) -> None:
+	log_path = _settings["log_path"]
+	if log_path is None:
+		return
+	line = json.dumps(entry, default=str) + "\n"
+	# One write per line in append mode, so lines of concurrent threads and processes do not interleave
+	with _lock, open(log_path, "a") as f:
+		f.write(line)
+
+
+@contextmanager
+def stage(name: str, rows: Optional[int] = None) -> Iterator[StageRecord]:
+	"""
+	Times a block of code as a stage.
+
+	Args:
+		name (str): Stage name, dotted by component (e.g. "feature.u_avg_prd", "app.inference").
+		rows (Optional[int]): Number of rows processed, if known upfront. Can also be set on the record.
+
+	Yields:
+		StageRecord: The running stage.
+	"""
+	stack = getattr(_local, "stack", None)
+	if stack is None:
+		stack = _local.stack = []
+	record = StageRecord(name, stack[-1] if stack else None, rows)
+	stack.append(name)
+
+	profiler = cProfile.Profile() if _profiled(name) else None
+	rss_before = rss_mb()
+	started_at = time.time()
+	start = time.perf_counter()
+	if profiler is not None:
+		profiler.enable()
+	try:
+		yield record
+	finally:
+		if profiler is not None:
+			profiler.disable()
+		seconds = time.perf_counter() - start
+		rss_after = rss_mb()
+		stack.pop()
+
+		entry = {
+			"stage": name,
+			"parent": record.parent,
+			"start": datetime.fromtimestamp(started_at).isoformat(timespec="milliseconds"),
+			"seconds": round(seconds, 6),
+			"rows": record.rows,
+			"rss_mb": None if rss_after is None else round(rss_after, 1),
+			"rss_delta_mb": None if rss_before is None or rss_after is None else round(rss_after - rss_before, 1),
+			"peak_rss_mb": round(peak_rss_mb(), 1),
+			"pid": os.getpid(),
+			**record.attributes,
+		}
+		if profiler is not None:
+			os.makedirs(_settings["profile_path"], exist_ok=True)
+			profile_file = os.path.join(
+				_settings["profile_path"], f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{os.getpid()}.prof"
+			)
+			profiler.dump_stats(profile_file)
+			entry["profile"] = profile_file
+		_aggregate(name, seconds, record.rows)
+		_log(entry)
+
+
+def timed(name: Optional[str] = None, count_rows: bool = False) -> Callable:
+	"""
+	Decorator timing every call of a function as a stage.
+
+	Args:
+		name (Optional[str]): Stage name. Defaults to the module and qualified name of the function.
+		count_rows (bool): Record the length of the return value as the number of rows.
+	"""
+	def decorator(func: Callable) -> Callable:
+		stage_name = name or f"{func.__module__}.{func.__qualname__}"
+
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			with stage(stage_name) as record:
+				result = func(*args, **kwargs)
+				if count_rows:
+					record.rows = len(result)
+				return result
+
+		return wrapper
+
+	return decorator
+
+
+def summary() -> Dict[str, dict]:
+	"""
+	Returns the aggregates of the stages finished in this process: count, total, mean and maximum seconds, rows.
+	"""
+	with _lock:
+		return {
+			name: {
+				"count": aggregate["count"],
+				"seconds": aggregate["seconds"],
+				"mean_seconds": aggregate["seconds"] / aggregate["count"],
+				"max_seconds": aggregate["max_seconds"],
+				"rows": aggregate["rows"],
+			}
+			for name, aggregate in _aggregates.items()
+		}
+
+
+def reset() -> None:
+	with _lock:
+		_aggregates.clear()
+
+
+def _escape(value: str) -> str:
+	return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_prometheus(prefix: str = "grocery") -> str:
+	"""
+	Renders the stage aggregates and the process memory in the Prometheus text exposition format.
+	"""
+	with _lock:
+		aggregates = {
+			name: dict(aggregate, buckets=list(aggregate["buckets"])) for name, aggregate in _aggregates.items()
+		}
+
+	lines: List[str] = [
+		f"# HELP {prefix}_stage_seconds Wall time of the pipeline stages.",
+		f"# TYPE {prefix}_stage_seconds histogram",
+	]
+	for name, aggregate in sorted(aggregates.items()):
+		label = f'stage="{_escape(name)}"'
+		cumulative = 0
+		for bound, count in zip(LATENCY_BUCKETS, aggregate["buckets"]):
+			cumulative += count
+			lines.append(f'{prefix}_stage_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+		lines.append(f'{prefix}_stage_seconds_bucket{{{label},le="+Inf"}} {aggregate["count"]}')
+		lines.append(f"{prefix}_stage_seconds_sum{{{label}}} {aggregate['seconds']}")
+		lines.append(f"{prefix}_stage_seconds_count{{{label}}} {aggregate['count']}")
+
+	lines += [
+		f"# HELP {prefix}_stage_rows_total Rows processed by the pipeline stages.",
+		f"# TYPE {prefix}_stage_rows_total counter",
+	] + [
+		f'{prefix}_stage_rows_total{{stage="{_escape(name)}"}} {aggregate["rows"]}'
+		for name, aggregate in sorted(aggregates.items())
+	]
+
+	current = rss_mb()
+	lines += [
+		f"# HELP {prefix}_process_peak_rss_bytes Peak resident set size of the process.",
+		f"# TYPE {prefix}_process_peak_rss_bytes gauge",
+		f"{prefix}_process_peak_rss_bytes {int(peak_rss_mb() * 1024 ** 2)}",
+	]
+	if current is not None:
+		lines += [
+			f"# HELP {prefix}_process_rss_bytes Resident set size of the process.",
+			f"# TYPE {prefix}_process_rss_bytes gauge",
+			f"{prefix}_process_rss_bytes {int(current * 1024 ** 2)}",
+		]
+	return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		if self.path.split("?")[0] != "/metrics":
+			self.send_error(404)
+			return
+		body = render_prometheus().encode()
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+
+def start_metrics_server(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+	"""
+	Serves `render_prometheus()` on http://host:port/metrics from a daemon thread.
+	"""
+	server = ThreadingHTTPServer((host, port), _MetricsHandler)
+	threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+	print(f"Metrics served on http://{host}:{port}/metrics")
+	return server
@@ -0,0 +1,273 @@
+"""
+User x product interaction matrix of the prior orders.
+
+The prior orders are stored once as two sparse structures in one packed arrays file:
+- the order x product matrix (CSR), with orders sorted by user and order number, so the orders of a user are a slice;
+- the user x product matrix (CSR) of the distinct pairs, with per-pair columns: the number of orders with the product,
+  the first and last order numbers, and a recency bitmask whose bit i is set if the product is in the user's i-th
+  order counted back from the last one (0).
+User-product features are then vectorized reductions over these columns instead of groupbys over all order rows.
+The file is rebuilt when the raw CSV files change.
+"""
+import os
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from config import INTERACTIONS_PATH, RAW_DATA_PATH
+from scripts.packed_arrays import read_header, read_packed, write_packed
+from scripts.raw_data import load_raw
+
+INTERACTIONS_FORMAT = "interactions"
+INTERACTIONS_VERSION = 1
+RECENCY_BITS = 64  # orders covered by the recency bitmask
+SOURCE_TABLES = ("orders", "order_products__prior")
+
+
+def _sources() -> Dict[str, dict]:
+	sources = {}
+	for table in SOURCE_TABLES:
+		stat = os.stat(os.path.join(RAW_DATA_PATH, f"{table}.csv"))
+		sources[table] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+	return sources
+
+
+def _group_starts(sorted_keys: np.ndarray) -> np.ndarray:
+	return np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]) if len(sorted_keys) else sorted_keys[:0]
+
+
+def _offsets(sorted_ids: np.ndarray, size: int) -> np.ndarray:
+	offsets = np.zeros(size + 1, dtype=np.int64)
+	np.cumsum(np.bincount(sorted_ids, minlength=size), out=offsets[1:])
+	return offsets
+
+
+def build_arrays(orders: pd.DataFrame, order_products: pd.DataFrame) -> Dict[str, np.ndarray]:
+	"""
+	Builds the arrays of the interaction matrix.
+
+	Args:
+		orders (pd.DataFrame): 'order_id', 'user_id', 'eval_set' and 'order_number' of the orders.
+		order_products (pd.DataFrame): 'order_id' and 'product_id' of the prior order products.
+
+	Returns:
+		Dict[str, np.ndarray]: Arrays by name, see `InteractionMatrix`.
+	"""
+	prior = orders[orders.eval_set == 'prior']
+	order_numbers = prior.order_number.to_numpy()
+	order_users = prior.user_id.to_numpy()
+	order_sort = np.lexsort((order_numbers, order_users))
+	order_ids = prior.order_id.to_numpy()[order_sort]
+	order_users, order_numbers = order_users[order_sort], order_numbers[order_sort]
+
+	# Order products sorted by order row, then product
+	row_of_order = np.full(int(order_ids.max(initial=0)) + 1, -1, dtype=np.int64)
+	row_of_order[order_ids] = np.arange(len(order_ids))
+	product_order_ids = order_products.order_id.to_numpy()
+	rows = np.full(len(product_order_ids), -1, dtype=np.int64)
+	known = product_order_ids < len(row_of_order)
+	rows[known] = row_of_order[product_order_ids[known]]
+	in_prior = rows >= 0
+	rows, products = rows[in_prior], order_products.product_id.to_numpy()[in_prior]
+	entry_sort = np.lexsort((products, rows))
+	rows, products = rows[entry_sort], products[entry_sort].astype(np.uint32)
+
+	n_users = int(order_users.max(initial=0)) + 1
+	n_products = int(products.max(initial=0)) + 1
+
+	# Rows are sorted by user and order number, so the last row of a user is their last order with products
+	entry_users = order_users[rows]
+	entry_numbers = order_numbers[rows]
+	user_total_orders = np.zeros(n_users, dtype=order_numbers.dtype)
+	last_rows = np.r_[_group_starts(entry_users)[1:] - 1, len(entry_users) - 1] if len(entry_users) else rows[:0]
+	user_total_orders[entry_users[last_rows]] = entry_numbers[last_rows]
+	recency = user_total_orders[entry_users].astype(np.int64) - entry_numbers
+
+	# Distinct (user, product) pairs
+	keys = (entry_users.astype(np.uint64) << np.uint64(32)) | products
+	pair_sort = np.argsort(keys, kind="stable")
+	keys = keys[pair_sort]
+	starts = _group_starts(keys)
+	pair_numbers = entry_numbers[pair_sort]
+	recency = recency[pair_sort]
+	bits = np.where(
+		recency < RECENCY_BITS, np.left_shift(np.uint64(1), np.minimum(recency, RECENCY_BITS - 1).astype(np.uint64)), 0
+	).astype(np.uint64)
+	reduce = (lambda ufunc, values: ufunc.reduceat(values, starts)) if len(starts) else (lambda ufunc, values: values)
+
+	pair_users = (keys[starts] >> np.uint64(32)).astype(np.uint32)
+	return {
+		"order_ids": order_ids.astype(np.uint32),
+		"order_users": order_users.astype(np.uint32),
+		"order_numbers": order_numbers,
+		"order_offsets": _offsets(rows, len(order_ids)),
+		"order_products": products,
+		"user_order_offsets": _offsets(order_users, n_users),
+		"user_total_orders": user_total_orders,
+		"user_offsets": _offsets(pair_users, n_users),
+		"products": (keys[starts] & np.uint64(0xFFFFFFFF)).astype(np.uint32),
+		"counts": np.diff(np.r_[starts, len(keys)]).astype(np.uint32),
+		"first_order": reduce(np.minimum, pair_numbers),
+		"last_order": reduce(np.maximum, pair_numbers),
+		"recency": reduce(np.bitwise_or, bits),
+		"n_products": np.array([n_products], dtype=np.int64),
+	}
+
+
+class InteractionMatrix:
+	"""
+	Memory-mapped interactions of the prior orders.
+
+	Orders (sorted by user and order number):
+		order_ids, order_users, order_numbers; order_offsets and order_products: the products of every order.
+		user_order_offsets: the orders of every user_id.
+	Pairs (sorted by user and product):
+		user_offsets: the pairs of every user_id. products, counts, first_order, last_order, recency (bitmask).
+	Users:
+		user_total_orders: number of the user's last prior order with products, by user_id.
+	"""
+
+	def __init__(self, arrays: Dict[str, np.ndarray]):
+		self.arrays = arrays
+		for name, values in arrays.items():
+			setattr(self, name, values)
+		self.n_users = len(self.user_offsets) - 1
+		self.n_products = int(arrays["n_products"][0])
+		self._orders_by_product = None
+
+	@classmethod
+	def build(cls, orders: Optional[pd.DataFrame] = None, order_products: Optional[pd.DataFrame] = None):
+		if orders is None:
+			orders = load_raw('orders', columns=['order_id', 'user_id', 'eval_set', 'order_number'])
+		if order_products is None:
+			order_products = load_raw('order_products__prior', columns=['order_id', 'product_id'])
+		return cls(build_arrays(orders, order_products))
+
+	def save(self, path: str = INTERACTIONS_PATH) -> None:
+		write_packed(path, {
+			"format": INTERACTIONS_FORMAT, "version": INTERACTIONS_VERSION, "sources": _sources()
+		}, self.arrays)
+
+	@classmethod
+	def load(cls, path: str = INTERACTIONS_PATH, mmap: bool = True) -> "InteractionMatrix":
+		header, arrays = read_packed(path, mmap=mmap)
+		if header.get("format") != INTERACTIONS_FORMAT:
+			raise ValueError(f"{path} is not an interactions file.")
+		return cls(arrays)
+
+	@property
+	def n_pairs(self) -> int:
+		return len(self.products)
+
+	def pair_user_ids(self) -> np.ndarray:
+		"""
+		Returns the user id of every pair.
+		"""
+		return np.repeat(np.arange(self.n_users, dtype=np.uint32), np.diff(self.user_offsets))
+
+	def recent_counts(self, n_orders: int) -> np.ndarray:
+		"""
+		Counts the orders with the product among the user's last `n_orders` prior orders, for every pair.
+		"""
+		if not 0 < n_orders <= RECENCY_BITS:
+			raise ValueError(f"n_orders must be in [1, {RECENCY_BITS}], got {n_orders}.")
+		counts = np.zeros(self.n_pairs, dtype=np.int64)
+		for bit in range(n_orders):
+			counts += ((self.recency >> np.uint64(bit)) & np.uint64(1)).astype(np.int64)
+		return counts
+
+	def csr(self, values: Optional[np.ndarray] = None, dtype=np.float32) -> sp.csr_matrix:
+		"""
+		Returns the user x product matrix of a per-pair column, addressed by user_id and product_id.
+
+		Args:
+			values (Optional[np.ndarray]): Value of every pair. Defaults to the number of orders with the product.
+			dtype: dtype of the matrix values.
+		"""
+		values = self.counts if values is None else values
+		return sp.csr_matrix(
+			(np.asarray(values, dtype=dtype), self.products, self.user_offsets), shape=(self.n_users, self.n_products)
+		)
+
+	def user_pairs(self, user_id: int) -> Dict[str, np.ndarray]:
+		"""
+		Returns the per-pair columns of the products a user has bought, as views.
+		"""
+		if not 0 <= user_id < self.n_users:
+			return {name: self.arrays[name][:0] for name in ("products", "counts", "first_order", "last_order", "recency")}
+		start, end = self.user_offsets[user_id], self.user_offsets[user_id + 1]
+		return {
+			name: self.arrays[name][start:end]
+			for name in ("products", "counts", "first_order", "last_order", "recency")
+		}
+
+	def user_orders(self, user_id: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+		"""
+		Returns the prior orders of a user, by order number.
+
+		Returns:
+			Tuple[np.ndarray, np.ndarray, np.ndarray]: Order ids, the offsets of their products and the product ids.
+		"""
+		if not 0 <= user_id < self.n_users:
+			return self.order_ids[:0], np.zeros(1, dtype=np.int64), self.order_products[:0]
+		first, last = self.user_order_offsets[user_id], self.user_order_offsets[user_id + 1]
+		offsets = self.order_offsets[first:last + 1]
+		return self.order_ids[first:last], offsets - offsets[0], self.order_products[offsets[0]:offsets[-1]]
+
+	def co_occurrence(self, product_id: int, top_k: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+		"""
+		Counts the prior orders that contain both a product and each other product.
+
+		Args:
+			product_id (int): The product.
+			top_k (Optional[int]): Keep only the products bought together most often. None to keep all.
+
+		Returns:
+			Tuple[np.ndarray, np.ndarray]: Product ids and number of shared orders, by descending count.
+		"""
+		if self._orders_by_product is None:
+			# Product -> orders index, built on the first query
+			order_rows = np.repeat(np.arange(len(self.order_ids), dtype=np.int64), np.diff(self.order_offsets))
+			product_sort = np.argsort(self.order_products, kind="stable")
+			self._orders_by_product = (_offsets(self.order_products[product_sort], self.n_products), order_rows[product_sort])
+		product_offsets, product_orders = self._orders_by_product
+		if not 0 <= product_id < self.n_products:
+			return self.products[:0], np.zeros(0, dtype=np.int64)
+
+		orders = product_orders[product_offsets[product_id]:product_offsets[product_id + 1]]
+		starts, ends = self.order_offsets[orders], self.order_offsets[orders + 1]
+		lengths = ends - starts
+		entries = np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+		counts = np.bincount(self.order_products[entries], minlength=self.n_products)
+		counts[product_id] = 0
+
+		others = np.flatnonzero(counts)
+		order = np.argsort(-counts[others], kind="stable")
+		if top_k is not None:
+			order = order[:top_k]
+		return others[order].astype(np.uint32), counts[others[order]]
+
+
+def load_interactions(path: str = INTERACTIONS_PATH, refresh: bool = False) -> InteractionMatrix:
+	"""
+	Opens the interaction matrix, building and saving it first if the raw CSV files changed since it was built.
+
+	Args:
+		path (str): Path of the interactions file.
+		refresh (bool): Rebuild it even if it is up to date.
+
+	Returns:
+		InteractionMatrix: The interactions, memory-mapped.
+	"""
+	if not refresh and os.path.exists(path):
+		header, _, _ = read_header(path)
+		if header.get("version") == INTERACTIONS_VERSION and header.get("sources") == _sources():
+			return InteractionMatrix.load(path)
+
+	print("Building the interaction matrix...")
+	interactions = InteractionMatrix.build()
+	os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+	interactions.save(path)
+	return InteractionMatrix.load(path)
@@ -0,0 +1,107 @@
+"""
+Versioned model artifacts.
+
+A model is exported as a flattened TreeEnsemble in one packed arrays file ('model_<timestamp>.trees'), whose header
+holds the format version, the model type and the feature order. Training metadata (parameters, metrics, dataset
+sizes, library versions) goes to a JSON sidecar with the same name. Loading maps the node arrays read-only,
+so it takes milliseconds, and it does not depend on the library versions the model was trained with.
+"""
+import json
+import os
+from datetime import datetime
+from typing import Optional
+
+from scripts.packed_arrays import read_packed, write_packed
+from scripts.tree_ensemble import TreeEnsemble
+
+ARTIFACT_FORMAT = "tree_ensemble"
+ARTIFACT_VERSION = 1
+ARTIFACT_EXTENSION = ".trees"
+
+
+def _library_versions() -> dict:
+	versions = {}
+	for name in ("numpy", "sklearn", "lightgbm", "xgboost"):
+		try:
+			versions[name] = __import__(name).__version__
+		except ImportError:
+			pass
+	return versions
+
+
+def metadata_path(artifact_path: str) -> str:
+	return os.path.splitext(artifact_path)[0] + ".json"
+
+
+def export_model(
+		model,
+		path: str,
+		model_type: str,
+		metadata: Optional[dict] = None
+) -> TreeEnsemble:
+	"""
+	Writes a fitted model as a versioned artifact and its training metadata as a JSON sidecar.
+
+	Args:
+		model: Fitted RandomForestClassifier, LGBMClassifier or XGBClassifier, a LightGBM or XGBoost Booster,
+			or a TreeEnsemble.
+		path (str): Path of the artifact, e.g. 'models/lightgbm/model_20250101_000000.trees'.
+		model_type (str): "random_forest", "lightgbm" or "xgboost".
+		metadata (Optional[dict]): Training metadata (parameters, metrics, ...), JSON-serializable.
+
+	Returns:
+		TreeEnsemble: The exported ensemble.
+	"""
+	ensemble = model if isinstance(model, TreeEnsemble) else TreeEnsemble.from_model(model)
+
+	write_packed(path, {
+		"format": ARTIFACT_FORMAT,
+		"version": ARTIFACT_VERSION,
+		"model_type": model_type,
+		**ensemble.params(),
+	}, ensemble.arrays())
+
+	with open(metadata_path(path), "w") as f:
+		json.dump({
+			"model_type": model_type,
+			"estimator": type(model).__name__,
+			"created_at": datetime.now().isoformat(timespec="seconds"),
+			"n_trees": ensemble.n_trees,
+			"n_nodes": int(ensemble.tree_offsets[-1]),
+			"feature_names": list(ensemble.feature_names_in_),
+			"libraries": _library_versions(),
+			**(metadata or {}),
+		}, f, indent=2, default=str)
+
+	return ensemble
+
+
+def load_artifact(path: str, mmap: bool = True) -> TreeEnsemble:
+	"""
+	Loads a model artifact written by `export_model`.
+
+	Args:
+		path (str): Path of the artifact.
+		mmap (bool): Map the node arrays read-only instead of reading them into memory.
+
+	Returns:
+		TreeEnsemble: The model.
+	"""
+	header, arrays = read_packed(path, mmap=mmap)
+	if header.get("format") != ARTIFACT_FORMAT:
+		raise ValueError(f"{path} is not a model artifact.")
+	if header["version"] > ARTIFACT_VERSION:
+		raise ValueError(
+			f"{path} has artifact version {header['version']}, this code reads versions up to {ARTIFACT_VERSION}."
+		)
+
+	return TreeEnsemble(
+		**arrays,
+		feature_names=header["feature_names"],
+		decision=header["decision"],
+		aggregation=header["aggregation"],
+		base_score=header["base_score"],
+		sigmoid_scale=header["sigmoid_scale"],
+		max_depth=header["max_depth"],
+		model_type=header["model_type"],
+	)
@@ -0,0 +1,348 @@
+"""
+Model registry: hot reload of new models and weighted traffic splits between several models.
+
+Every variant of the traffic split is either a model type, which follows the latest model of its directory under
+MODELS_PATH, or a model file, which stays pinned. The registry scans MODELS_PATH from a background thread. A new
+model file is loaded, compiled and warmed up by scoring a few users next to the current model, also where it will be
+scored (e.g. in every scoring worker, see `preloader`). Only then is it swapped in with a single reference assignment:
+batches in flight finish with the model they started with, and no request waits for a load. A model that fails to
+load or to score the warm-up users is skipped and the current one keeps serving. Users are assigned to a variant by
+a hash of their id, so a user stays on the same variant while the split does not change. Every loaded model keeps
+its own latency and score statistics.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from config import MODEL_POLL_S, MODEL_SETTLE_S, MODEL_TRAFFIC_SPLIT, MODEL_WARMUP_USERS, MODELS_PATH
+from scripts.batching import LatencyStats
+from scripts.cache import file_hash
+from scripts.instrumentation import stage
+from scripts.recommender import Recommender
+from scripts.tree_ensemble import compile_model
+from scripts.utils import load_model_file, model_files
+
+# Bins of the histogram of the returned probabilities, of width 1 / SCORE_BINS
+SCORE_BINS = 10
+# Number of replaced model versions whose statistics are still reported
+RETIRED_VERSIONS = 8
+
+
+def user_buckets(user_ids: Union[int, List[int], np.ndarray]) -> np.ndarray:
+	"""
+	Maps user ids to numbers uniformly spread over [0, 1) with Fibonacci hashing. A user always gets the same number.
+	"""
+	hashed = np.atleast_1d(np.asarray(user_ids, dtype=np.uint64)) * np.uint64(0x9E3779B97F4A7C15)
+	return (hashed >> np.uint64(11)).astype(np.float64) / 2.0 ** 53
+
+
+class ScoreStats:
+	"""
+	Latency of the scoring calls of a model and distribution of the probabilities it returned.
+	"""
+
+	def __init__(self):
+		self.latency = LatencyStats()
+		self.users = 0
+		self.rows = 0
+		self.probability_sum = 0.0
+		self.histogram = np.zeros(SCORE_BINS, dtype=np.int64)
+		self._lock = threading.Lock()
+
+	def observe(self, seconds: float, n_users: int, probabilities: np.ndarray) -> None:
+		bins = np.minimum((np.asarray(probabilities) * SCORE_BINS).astype(np.int64), SCORE_BINS - 1)
+		counts = np.bincount(bins, minlength=SCORE_BINS)
+		with self._lock:
+			self.latency.observe(seconds)
+			self.users += n_users
+			self.rows += len(bins)
+			self.probability_sum += float(np.sum(probabilities, dtype=np.float64))
+			self.histogram += counts
+
+	def summary(self) -> dict:
+		with self._lock:
+			return {
+				"calls": self.latency.summary(),
+				"users": self.users,
+				"rows": self.rows,
+				"mean_probability": self.probability_sum / self.rows if self.rows else 0.0,
+				"probability_histogram": self.histogram.tolist(),
+			}
+
+
+class ModelVersion:
+	"""
+	A model file loaded for a variant, with its statistics.
+	"""
+
+	def __init__(self, variant: str, path: str, fingerprint: Tuple[str, int, int], model):
+		self.variant = variant
+		self.path = path
+		self.fingerprint = fingerprint  # (path, mtime, size) of the loaded file
+		self.model = model
+		self.version = file_hash(path)  # content hash, e.g. to key cached predictions
+		self.loaded_at = datetime.now()
+		self.stats = ScoreStats()
+
+	def summary(self) -> dict:
+		return {
+			"variant": self.variant,
+			"model": os.path.basename(self.path),
+			"version": self.version[:12],
+			"loaded_at": self.loaded_at.isoformat(timespec="seconds"),
+			**self.stats.summary(),
+		}
+
+
+# Scores users with a model version: (user ids, product ids, probabilities) of the candidates, grouped by user
+Scorer = Callable[[ModelVersion, np.ndarray], Tuple[np.ndarray, np.ndarray, np.ndarray]]
+# Loads a new model version where the scorer runs and scores warm-up users with it, raises if it fails
+Preloader = Callable[[ModelVersion, np.ndarray], None]
+
+
+class ModelRegistry:
+	"""
+	The models serving traffic, reloaded when new model files appear. See the module docstring.
+	"""
+
+	def __init__(
+			self,
+			recommender: Recommender,
+			split: Optional[Dict[str, float]] = None,
+			scorer: Optional[Scorer] = None,
+			preloader: Optional[Preloader] = None,
+			warmup_users: int = MODEL_WARMUP_USERS,
+			settle_seconds: float = MODEL_SETTLE_S,
+			models_path: str = MODELS_PATH
+	):
+		"""
+		Args:
+			recommender (Recommender): Feature index used to score, and to warm up new models.
+			split (Optional[Dict[str, float]]): Variant -> weight. A variant is a model type (e.g. "lightgbm") or a
+				model file relative to `models_path` (e.g. "lightgbm/model_20240101_120000.trees").
+				Defaults to MODEL_TRAFFIC_SPLIT.
+			scorer (Optional[Scorer]): Scores users with a model version, e.g. in a `ScoringPool`.
+				Defaults to `recommender.score` in this process.
+			preloader (Optional[Preloader]): Loads and warms up a new model version where `scorer` runs, e.g. in
+				every worker of a `ScoringPool`, before it is swapped in. A failure rejects the new version.
+			warmup_users (int): Users scored by a new model before it is swapped in.
+			settle_seconds (float): Model files modified less than this ago are skipped, they may still be written.
+			models_path (str): Directory with one subdirectory of models per type.
+		"""
+		self.recommender = recommender
+		self.scorer = scorer or (lambda version, user_ids: recommender.score(version.model, user_ids))
+		self.preloader = preloader
+		self.warmup_users = warmup_users
+		self.settle_seconds = settle_seconds
+		self.models_path = models_path
+		self.swaps = 0
+
+		# Replaced as a whole on every change, so readers take a consistent view without locking
+		self._state: Tuple[Dict[str, float], Dict[str, ModelVersion]] = ({}, {})
+		self._retired: List[ModelVersion] = []
+		self._failed: Dict[str, Tuple[str, int, int]] = {}  # variant -> fingerprint of the file that failed to load
+		self._lock = threading.Lock()  # serializes the changes of the state
+		self._refresh_lock = threading.Lock()  # serializes the scans of the model files
+		self._stop = threading.Event()
+		self._watcher: Optional[threading.Thread] = None
+
+		self.set_split(MODEL_TRAFFIC_SPLIT if split is None else split)
+
+	def set_split(self, split: Dict[str, float]) -> None:
+		"""
+		Changes the traffic split. Models of removed variants are unloaded, new variants are loaded by `refresh`.
+		"""
+		if not split or any(weight < 0 for weight in split.values()) or sum(split.values()) <= 0:
+			raise ValueError(f"Invalid traffic split {split}: the weights must be positive or 0, and not all 0.")
+		with self._lock:
+			_, versions = self._state
+			self._retire([version for variant, version in versions.items() if variant not in split])
+			self._state = (dict(split), {variant: version for variant, version in versions.items() if variant in split})
+
+	def _retire(self, versions: List[ModelVersion]) -> None:
+		self._retired = (versions + self._retired)[:RETIRED_VERSIONS]
+
+	def _settled(self, path: str) -> bool:
+		try:
+			return time.time() - os.stat(path).st_mtime >= self.settle_seconds
+		except FileNotFoundError:
+			return False
+
+	def resolve(self, variant: str) -> Optional[str]:
+		"""
+		Returns the model file a variant should serve: the pinned file, or the latest settled model of the type.
+		"""
+		pinned = os.path.join(self.models_path, variant)
+		if os.path.isfile(pinned):
+			return pinned
+		files = [path for path in model_files(variant, self.models_path) if self._settled(path)]
+		return files[-1] if files else None
+
+	def _warmup_user_ids(self) -> np.ndarray:
+		users = np.flatnonzero(np.diff(self.recommender.feature_index.offsets))
+		if not len(users) or self.warmup_users <= 0:
+			return users[:0]
+		return users[np.linspace(0, len(users) - 1, min(self.warmup_users, len(users))).astype(np.int64)]
+
+	def _load(self, variant: str, path: str, fingerprint: Tuple[str, int, int]) -> ModelVersion:
+		with stage("registry.load") as record:
+			record.set(variant=variant, path=path)
+			version = ModelVersion(variant, path, fingerprint, compile_model(load_model_file(path)))
+		with stage("registry.warmup") as record:
+			# Also checks that the model accepts the serving features before it gets traffic
+			user_ids = self._warmup_user_ids()
+			record.rows = len(user_ids)
+			if len(user_ids):
+				self.recommender.score(version.model, user_ids)
+			if self.preloader is not None:
+				self.preloader(version, user_ids)
+		return version
+
+	def refresh(self) -> List[str]:
+		"""
+		Loads the new model files of the variants, warms them up and swaps them in.
+
+		Returns:
+			List[str]: The variants whose model was swapped.
+		"""
+		with self._refresh_lock:
+			swapped = []
+			split, versions = self._state
+			for variant in split:
+				path = self.resolve(variant)
+				if path is None:
+					continue
+				stat = os.stat(path)
+				fingerprint = (path, stat.st_mtime_ns, stat.st_size)
+				current = versions.get(variant)
+				if current is not None and current.fingerprint == fingerprint:
+					continue
+				if self._failed.get(variant) == fingerprint:
+					continue
+
+				try:
+					version = self._load(variant, path, fingerprint)
+				except Exception as e:
+					self._failed[variant] = fingerprint
+					print(f"Could not load {path} for the variant '{variant}', keeping its current model: {e}")
+					continue
+
+				with self._lock:
+					# The split may have changed during the load
+					current_split, current_versions = self._state
+					if variant not in current_split:
+						continue
+					if variant in current_versions:
+						self._retire([current_versions[variant]])
+					self._state = (current_split, {**current_versions, variant: version})
+					self._failed.pop(variant, None)
+					self.swaps += 1
+				swapped.append(variant)
+				print(f"The variant '{variant}' serves {path}.")
+			return swapped
+
+	def start(self, poll_seconds: float = MODEL_POLL_S) -> None:
+		"""
+		Scans for new model files every `poll_seconds` from a daemon thread.
+		"""
+		if poll_seconds <= 0 or self._watcher is not None:
+			return
+
+		def watch():
+			while not self._stop.wait(poll_seconds):
+				try:
+					self.refresh()
+				except Exception as e:
+					print(f"Scanning {self.models_path} for new models failed: {e}")
+
+		self._stop.clear()
+		self._watcher = threading.Thread(target=watch, name="model-registry", daemon=True)
+		self._watcher.start()
+
+	def stop(self) -> None:
+		if self._watcher is not None:
+			self._stop.set()
+			self._watcher.join()
+			self._watcher = None
+
+	def _assign(
+			self,
+			user_ids: np.ndarray,
+			split: Dict[str, float],
+			versions: Dict[str, ModelVersion]
+	) -> Tuple[List[str], np.ndarray]:
+		variants = [variant for variant, weight in split.items() if variant in versions and weight > 0]
+		if not variants:
+			raise RuntimeError(f"No model is loaded for the variants {list(split)} under {self.models_path}.")
+		bounds = np.cumsum([split[variant] for variant in variants])
+		assigned = np.searchsorted(bounds, user_buckets(user_ids) * bounds[-1], side="right")
+		return variants, np.minimum(assigned, len(variants) - 1)
+
+	def route(self, user_id: int) -> ModelVersion:
+		"""
+		Returns the model version serving a user.
+		"""
+		split, versions = self._state
+		variants, assigned = self._assign(np.array([user_id]), split, versions)
+		return versions[variants[assigned[0]]]
+
+	def score(
+			self,
+			user_ids: Union[List[int], np.ndarray]
+	) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Dict[int, str]]:
+		"""
+		Scores every user with the model of its variant, see `Recommender.score`.
+
+		Returns:
+			Tuple[np.ndarray, np.ndarray, np.ndarray, Dict[int, str]]: User id, product id and probability of every
+			candidate, grouped by user, and the variant that scored every user.
+		"""
+		user_ids = np.asarray(user_ids, dtype=np.int64)
+		split, versions = self._state
+		variants, assigned = self._assign(user_ids, split, versions)
+		user_variants = {int(user_id): variants[i] for user_id, i in zip(user_ids, assigned)}
+
+		parts = []
+		for i, variant in enumerate(variants):
+			variant_user_ids = user_ids[assigned == i]
+			if not len(variant_user_ids):
+				continue
+			version = versions[variant]
+			started = time.perf_counter()
+			rows = self.scorer(version, variant_user_ids)
+			version.stats.observe(time.perf_counter() - started, len(variant_user_ids), rows[2])
+			parts.append(rows)
+
+		if not parts:
+			return (
+				np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.float32), user_variants
+			)
+		return (*(np.concatenate(columns) for columns in zip(*parts)), user_variants)
+
+	def versions(self) -> Dict[str, ModelVersion]:
+		"""
+		Returns the loaded model version of every variant.
+		"""
+		return dict(self._state[1])
+
+	def metrics(self) -> dict:
+		split, versions = self._state
+		total = sum(split.values())
+		with self._lock:
+			retired = list(self._retired)
+		return {
+			"split": {variant: weight / total for variant, weight in split.items()},
+			"swaps": self.swaps,
+			"variants": {variant: version.summary() for variant, version in versions.items()},
+			"retired": [version.summary() for version in retired],
+		}
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.stop()
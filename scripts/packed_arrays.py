@@ -0,0 +1,90 @@
+"""
+Single-file container of named numpy arrays with a JSON header.
+
+The file starts with a magic string, the length of the JSON header and the header itself. The raw array data
+follows, every array aligned to ALIGNMENT bytes, so a reader maps the file once and views the arrays in place.
+"""
+import json
+import os
+import struct
+from typing import Dict, Tuple
+
+import numpy as np
+
+MAGIC = b"PKDARRS1"
+ALIGNMENT = 64
+
+
+def _aligned(offset: int) -> int:
+	return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_packed(path: str, header: dict, arrays: Dict[str, np.ndarray]) -> None:
+	"""
+	Writes arrays and a JSON-serializable header to a single file, atomically.
+
+	Args:
+		path (str): Output file.
+		header (dict): Metadata stored with the arrays.
+		arrays (Dict[str, np.ndarray]): Arrays by name. They are stored C-contiguous, in native byte order.
+	"""
+	arrays = {name: np.ascontiguousarray(values) for name, values in arrays.items()}
+
+	layout = {}
+	offset = 0
+	for name, values in arrays.items():
+		offset = _aligned(offset)
+		layout[name] = {"dtype": values.dtype.str, "shape": list(values.shape), "offset": offset}
+		offset += values.nbytes
+
+	header_bytes = json.dumps({"header": header, "arrays": layout}).encode()
+	data_start = _aligned(len(MAGIC) + 8 + len(header_bytes))
+
+	tmp_path = path + ".tmp"
+	with open(tmp_path, "wb") as f:
+		f.write(MAGIC)
+		f.write(struct.pack("<Q", len(header_bytes)))
+		f.write(header_bytes)
+		for name, values in arrays.items():
+			f.seek(data_start + layout[name]["offset"])
+			values.tofile(f)
+		f.truncate(data_start + offset)
+	os.replace(tmp_path, path)
+
+
+def read_header(path: str) -> Tuple[dict, dict, int]:
+	"""
+	Reads the header of a packed file.
+
+	Returns:
+		Tuple[dict, dict, int]: The user header, the array layout and the offset of the array data.
+	"""
+	with open(path, "rb") as f:
+		if f.read(len(MAGIC)) != MAGIC:
+			raise ValueError(f"{path} is not a packed arrays file.")
+		(header_length,) = struct.unpack("<Q", f.read(8))
+		content = json.loads(f.read(header_length))
+	return content["header"], content["arrays"], _aligned(len(MAGIC) + 8 + header_length)
+
+
+def read_packed(path: str, mmap: bool = True) -> Tuple[dict, Dict[str, np.ndarray]]:
+	"""
+	Opens a packed file.
+
+	Args:
+		path (str): File written by `write_packed`.
+		mmap (bool): Map the file read-only instead of reading it into memory.
+
+	Returns:
+		Tuple[dict, Dict[str, np.ndarray]]: The header and the arrays by name.
+	"""
+	header, layout, data_start = read_header(path)
+	data = np.memmap(path, dtype=np.uint8, mode="r") if mmap else np.fromfile(path, dtype=np.uint8)
+
+	arrays = {}
+	for name, spec in layout.items():
+		dtype = np.dtype(spec["dtype"])
+		start = data_start + spec["offset"]
+		size = int(np.prod(spec["shape"], dtype=np.int64)) * dtype.itemsize
+		arrays[name] = data[start:start + size].view(dtype).reshape(spec["shape"])
+	return header, arrays
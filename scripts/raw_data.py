@@ -0,0 +1,248 @@
+"""
+Typed loading of the raw Instacart tables.
+
+Every table has an explicit schema with compact dtypes. CSV files are parsed in chunks, validated against the schema,
+and cached as one `.npy` file per column on first read, so repeated loads skip CSV parsing entirely.
+"""
+import json
+import os
+import shutil
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from config import RAW_CACHE_PATH, RAW_DATA_PATH
+from scripts.instrumentation import stage
+
+CACHE_VERSION = 1
+CSV_CHUNK_SIZE = 5_000_000
+
+SCHEMAS: Dict[str, Dict[str, str]] = {
+	'orders': {
+		'order_id': 'uint32',
+		'user_id': 'uint32',
+		'eval_set': 'category',
+		'order_number': 'uint8',
+		'order_dow': 'uint8',
+		'order_hour_of_day': 'uint8',
+		'days_since_prior_order': 'float32',
+	},
+	'order_products__prior': {
+		'order_id': 'uint32',
+		'product_id': 'uint32',
+		'add_to_cart_order': 'uint8',
+		'reordered': 'bool',
+	},
+	'order_products__train': {
+		'order_id': 'uint32',
+		'product_id': 'uint32',
+		'add_to_cart_order': 'uint8',
+		'reordered': 'bool',
+	},
+	'products': {
+		'product_id': 'uint32',
+		'product_name': 'category',
+		'aisle_id': 'uint8',
+		'department_id': 'uint8',
+	},
+}
+
+# Columns allowed to have missing values
+NULLABLE = {'days_since_prior_order'}
+
+# Inclusive value ranges, on top of the bounds of the column dtypes
+VALUE_RANGES = {
+	'order_dow': (0, 6),
+	'order_hour_of_day': (0, 23),
+	'reordered': (0, 1),
+}
+
+# Allowed values of categorical columns with a fixed domain
+CATEGORIES = {
+	'eval_set': ['prior', 'train', 'test'],
+}
+
+
+class SchemaError(ValueError):
+	pass
+
+
+def _validate_chunk(table: str, chunk: pd.DataFrame) -> pd.DataFrame:
+	"""
+	Checks a chunk parsed with default dtypes against the schema and converts it to the schema dtypes.
+	"""
+	schema = SCHEMAS[table]
+
+	missing = [column for column in schema if column not in chunk.columns]
+	if missing:
+		raise SchemaError(f"Table '{table}' is missing columns: {missing}")
+
+	converted = {}
+	for column, dtype in schema.items():
+		values = chunk[column]
+
+		if column not in NULLABLE and values.isna().any():
+			raise SchemaError(f"Column '{table}.{column}' has missing values.")
+
+		if dtype == 'category':
+			if column in CATEGORIES:
+				unknown = set(values.dropna().unique()) - set(CATEGORIES[column])
+				if unknown:
+					raise SchemaError(f"Column '{table}.{column}' has unexpected values: {sorted(unknown)}")
+			converted[column] = values.astype('category')
+			continue
+
+		if dtype != 'float32':
+			if not pd.api.types.is_integer_dtype(values):
+				raise SchemaError(f"Column '{table}.{column}' must be integer, got {values.dtype}.")
+
+			if column in VALUE_RANGES:
+				low, high = VALUE_RANGES[column]
+			else:
+				low, high = np.iinfo(dtype).min, np.iinfo(dtype).max
+			if len(values) and (values.min() < low or values.max() > high):
+				raise SchemaError(f"Column '{table}.{column}' has values outside of [{low}, {high}].")
+
+		converted[column] = values.astype(dtype)
+
+	return pd.DataFrame(converted)
+
+
+def _concat_chunks(chunks: List[pd.DataFrame]) -> pd.DataFrame:
+	if len(chunks) == 1:
+		return chunks[0]
+
+	df = pd.concat(chunks, ignore_index=True)
+	# Categories differ between chunks, so they are unified instead of falling back to object columns
+	for column in chunks[0].columns:
+		if isinstance(chunks[0][column].dtype, pd.CategoricalDtype):
+			df[column] = union_categoricals([chunk[column] for chunk in chunks])
+	return df
+
+
+def read_csv_typed(path: str, table: str, chunk_size: int = CSV_CHUNK_SIZE) -> pd.DataFrame:
+	"""
+	Parses a CSV file with the schema of a raw table, without caching. Useful for files outside RAW_DATA_PATH.
+
+	Args:
+		path (str): Path to the CSV file.
+		table (str): Name of the table whose schema the file follows, e.g. 'orders'.
+		chunk_size (int): Number of rows parsed at once. Bounds the memory used by default-typed columns.
+
+	Returns:
+		pd.DataFrame: The validated table with the schema dtypes.
+	"""
+	reader = pd.read_csv(path, usecols=lambda column: column in SCHEMAS[table], chunksize=chunk_size)
+	chunks = [_validate_chunk(table, chunk) for chunk in reader]
+	if not chunks:
+		return _validate_chunk(table, pd.read_csv(path, usecols=lambda column: column in SCHEMAS[table]))
+	return _concat_chunks(chunks)
+
+
+def iter_csv_typed(path: str, table: str, chunk_size: int = CSV_CHUNK_SIZE):
+	"""
+	Like `read_csv_typed`, but yields the validated chunks instead of concatenating them.
+	"""
+	for chunk in pd.read_csv(path, usecols=lambda column: column in SCHEMAS[table], chunksize=chunk_size):
+		yield _validate_chunk(table, chunk)
+
+
+def _source_fingerprint(path: str) -> dict:
+	stat = os.stat(path)
+	return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _read_cache_meta(cache_dir: str) -> Optional[dict]:
+	meta_path = os.path.join(cache_dir, "meta.json")
+	if not os.path.exists(meta_path):
+		return None
+	with open(meta_path) as f:
+		return json.load(f)
+
+
+def _write_cache(df: pd.DataFrame, table: str, source: dict, cache_dir: str) -> None:
+	# Build the cache next to its final location and swap it in, so readers never see a partial cache
+	tmp_dir = cache_dir.rstrip("/") + ".tmp"
+	shutil.rmtree(tmp_dir, ignore_errors=True)
+	os.makedirs(tmp_dir)
+
+	columns = {}
+	for column in df.columns:
+		values = df[column]
+		if isinstance(values.dtype, pd.CategoricalDtype):
+			np.save(os.path.join(tmp_dir, f"{column}.npy"), values.cat.codes.to_numpy())
+			columns[column] = {"categories": values.cat.categories.tolist()}
+		else:
+			np.save(os.path.join(tmp_dir, f"{column}.npy"), values.to_numpy())
+			columns[column] = values.dtype.name
+
+	with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+		json.dump({
+			"version": CACHE_VERSION, "schema": SCHEMAS[table], "source": source, "columns": columns
+		}, f)
+
+	shutil.rmtree(cache_dir, ignore_errors=True)
+	os.replace(tmp_dir, cache_dir)
+
+
+def _read_cache(cache_dir: str, meta: dict, columns: List[str]) -> pd.DataFrame:
+	data = {}
+	for column in columns:
+		values = np.load(os.path.join(cache_dir, f"{column}.npy"))
+		spec = meta["columns"][column]
+		if isinstance(spec, dict):
+			values = pd.Categorical.from_codes(values, categories=spec["categories"])
+		data[column] = values
+	return pd.DataFrame(data)
+
+
+def load_raw(table: str, columns: Optional[List[str]] = None, use_cache: bool = True) -> pd.DataFrame:
+	"""
+	Loads a raw Instacart table from RAW_DATA_PATH with its schema dtypes.
+	The first load parses and validates the CSV file and caches it in RAW_CACHE_PATH;
+	later loads read only the requested columns from the cache until the CSV file changes.
+
+	Args:
+		table (str): Table name, the CSV file name without extension (e.g. 'orders', 'order_products__prior').
+		columns (Optional[List[str]]): Columns to load. If None, load all columns of the schema.
+		use_cache (bool): Read from and write to the binary cache.
+
+	Returns:
+		pd.DataFrame: The table.
+	"""
+	if table not in SCHEMAS:
+		raise KeyError(f"Unknown table '{table}'. Known tables: {list(SCHEMAS)}")
+
+	columns = list(SCHEMAS[table]) if columns is None else columns
+	unknown = [column for column in columns if column not in SCHEMAS[table]]
+	if unknown:
+		raise KeyError(f"Unknown columns of table '{table}': {unknown}")
+
+	with stage(f"load_raw.{table}") as record:
+		df = _load_raw(table, columns, use_cache)
+		record.rows = len(df)
+	return df
+
+
+def _load_raw(table: str, columns: List[str], use_cache: bool) -> pd.DataFrame:
+	csv_path = os.path.join(RAW_DATA_PATH, f"{table}.csv")
+	if not use_cache:
+		return read_csv_typed(csv_path, table)[columns]
+
+	cache_dir = os.path.join(RAW_CACHE_PATH, table)
+	source = _source_fingerprint(csv_path)
+	meta = _read_cache_meta(cache_dir)
+	if (
+			meta is not None
+			and meta["version"] == CACHE_VERSION
+			and meta["schema"] == SCHEMAS[table]
+			and meta["source"] == source
+	):
+		return _read_cache(cache_dir, meta, columns)
+
+	df = read_csv_typed(csv_path, table)
+	os.makedirs(RAW_CACHE_PATH, exist_ok=True)
+	_write_cache(df, table, source, cache_dir)
+	return df[columns]
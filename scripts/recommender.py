@@ -0,0 +1,200 @@
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from config import RETRIEVAL_TOP_K, SERVING_SNAPSHOT_PATH
+from scripts.boosters import BoosterClassifier
+from scripts.feature_index import FeatureIndex
+from scripts.instrumentation import stage
+from scripts.raw_data import load_raw
+from scripts.retrieval import CandidateIndex
+from scripts.serving_snapshot import ProductNames, open_serving_snapshot
+from scripts.tree_ensemble import TreeEnsemble
+
+# Number of users whose candidates are stacked into one predict_proba call
+USERS_PER_CHUNK = 2048
+
+
+def load_product_names() -> np.ndarray:
+	"""
+	Loads product names into a dense array addressed by product_id.
+
+	Returns:
+		np.ndarray: Object array of product names, None for unknown ids.
+	"""
+	products = load_raw("products", columns=["product_id", "product_name"])
+	names = np.full(int(products.product_id.max()) + 1, None, dtype=object)
+	names[products.product_id.to_numpy()] = products.product_name.to_numpy()
+	return names
+
+
+def model_input(model, features: np.ndarray, feature_names: List[str]) -> Union[np.ndarray, pd.DataFrame]:
+	"""
+	Arranges a feature matrix in the column order the model was trained with.
+	Flattened tree ensembles and native boosters take the float32 matrix as is; other models get a DataFrame with named
+	columns.
+
+	Args:
+		model: Fitted classifier with `predict_proba`.
+		features (np.ndarray): Feature matrix with columns in `feature_names` order.
+		feature_names (List[str]): Names of the feature matrix columns.
+
+	Returns:
+		Union[np.ndarray, pd.DataFrame]: Model input.
+	"""
+	model_features = getattr(model, "feature_names_in_", None)
+	if model_features is not None and list(model_features) != feature_names:
+		features = features[:, [feature_names.index(name) for name in model_features]]
+		feature_names = list(model_features)
+
+	if isinstance(model, (TreeEnsemble, BoosterClassifier)):
+		return features
+	return pd.DataFrame(features, columns=feature_names, copy=False)
+
+
+class Recommender:
+	"""
+	Batch scoring of many users at once: one stacked feature matrix and one `predict_proba` call per chunk of users.
+	"""
+
+	def __init__(self, feature_index: FeatureIndex, product_names: Union[np.ndarray, ProductNames]):
+		self.feature_index = feature_index
+		self.product_names = product_names
+
+	@classmethod
+	def load(cls, snapshot_path: str = SERVING_SNAPSHOT_PATH):
+		"""
+		Opens the serving snapshot if it is up to date, otherwise builds the index from the features.
+		"""
+		snapshot = open_serving_snapshot(snapshot_path)
+		if snapshot is not None:
+			return cls(*snapshot)
+		return cls(FeatureIndex.load(), load_product_names())
+
+	def names_of(self, product_ids: np.ndarray) -> np.ndarray:
+		names = np.full(len(product_ids), None, dtype=object)
+		known = product_ids < len(self.product_names)
+		names[known] = self.product_names[product_ids[known]]
+		return names
+
+	def score(
+			self,
+			model,
+			user_ids: Union[List[int], np.ndarray],
+			users_per_chunk: int = USERS_PER_CHUNK,
+			candidates: Optional[CandidateIndex] = None,
+			n_candidates: int = RETRIEVAL_TOP_K
+	) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+		"""
+		Predicts the reorder probability of every candidate product of every user.
+		The candidates are the products the user has bought, plus the products retrieved from `candidates`.
+
+		Args:
+			model: Fitted classifier with `predict_proba`.
+			user_ids (Union[List[int], np.ndarray]): Users to score.
+			users_per_chunk (int): Number of users scored per `predict_proba` call.
+			candidates (Optional[CandidateIndex]): Retrieval index of products the users have never bought.
+			n_candidates (int): Number of retrieved products per user.
+
+		Returns:
+			Tuple[np.ndarray, np.ndarray, np.ndarray]: User id, product id and probability of every candidate,
+			grouped by user in input order.
+		"""
+		user_ids = np.asarray(user_ids, dtype=np.int64)
+		chunks = []
+		for start in range(0, len(user_ids), users_per_chunk):
+			chunk_user_ids = user_ids[start:start + users_per_chunk]
+			with stage("score.features") as record:
+				row_user_ids, product_ids, features = self.feature_index.users_features(chunk_user_ids)
+				if candidates is not None:
+					row_user_ids, product_ids, features = self._add_retrieved(
+						chunk_user_ids, row_user_ids, product_ids, features, candidates, n_candidates
+					)
+				record.rows = len(features)
+			with stage("score.inference", rows=len(features)):
+				probabilities = (
+					model.predict_proba(model_input(model, features, self.feature_index.feature_names))[:, 1]
+					if len(features) else np.empty(0, dtype=np.float32)
+				)
+			chunks.append((row_user_ids, product_ids, probabilities))
+
+		if not chunks:
+			return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.float32)
+		return tuple(np.concatenate(parts) for parts in zip(*chunks))
+
+	def _add_retrieved(
+			self,
+			user_ids: np.ndarray,
+			row_user_ids: np.ndarray,
+			product_ids: np.ndarray,
+			features: np.ndarray,
+			candidates: CandidateIndex,
+			n_candidates: int
+	) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+		"""
+		Appends the retrieved products of the users to their candidate rows, keeping the rows grouped by user.
+		"""
+		new_user_ids, new_product_ids, _ = candidates.search(user_ids, n_candidates)
+		row_user_ids = np.concatenate([row_user_ids, new_user_ids])
+		product_ids = np.concatenate([product_ids, new_product_ids]).astype(np.uint32)
+		features = np.concatenate([features, self.feature_index.pairs_features(new_user_ids, new_product_ids)])
+
+		# Stable sort by the position of the user in the input
+		sorter = np.argsort(user_ids, kind="stable")
+		positions = sorter[np.searchsorted(user_ids, row_user_ids, sorter=sorter)]
+		order = np.argsort(positions, kind="stable")
+		return row_user_ids[order], product_ids[order], features[order]
+
+	def recommend(
+			self,
+			model,
+			user_ids: Union[List[int], np.ndarray],
+			top_k: Optional[int] = None,
+			threshold: Optional[float] = None,
+			users_per_chunk: int = USERS_PER_CHUNK,
+			candidates: Optional[CandidateIndex] = None,
+			n_candidates: int = RETRIEVAL_TOP_K
+	) -> pd.DataFrame:
+		"""
+		Recommends products for many users at once.
+
+		Args:
+			model: Fitted classifier with `predict_proba`.
+			user_ids (Union[List[int], np.ndarray]): Users to recommend products for.
+			top_k (Optional[int]): Keep at most this many products per user. None to keep all.
+			threshold (Optional[float]): Keep only products with at least this probability. None to keep all.
+			users_per_chunk (int): Number of users scored per `predict_proba` call.
+			candidates (Optional[CandidateIndex]): Retrieval index of products the users have never bought.
+			n_candidates (int): Number of retrieved products per user.
+
+		Returns:
+			pd.DataFrame: Columns 'user_id', 'product_id', 'product_name', 'probability' and 'rank' (0-based),
+			sorted by user and descending probability.
+		"""
+		# A user listed twice would have its rows merged into one group and its products ranked twice
+		user_ids = np.fromiter(dict.fromkeys(np.asarray(user_ids, dtype=np.int64).tolist()), dtype=np.int64)
+		row_user_ids, product_ids, probabilities = self.score(
+			model, user_ids, users_per_chunk, candidates=candidates, n_candidates=n_candidates
+		)
+
+		# Sort by user, then by descending probability, and rank the products within each user
+		order = np.lexsort((-probabilities, row_user_ids))
+		row_user_ids, product_ids, probabilities = row_user_ids[order], product_ids[order], probabilities[order]
+		is_first = np.r_[True, row_user_ids[1:] != row_user_ids[:-1]] if len(order) else np.empty(0, dtype=bool)
+		group_starts = np.maximum.accumulate(np.where(is_first, np.arange(len(order)), 0))
+		rank = np.arange(len(order)) - group_starts
+
+		keep = np.ones(len(order), dtype=bool)
+		if top_k is not None:
+			keep &= rank < top_k
+		if threshold is not None:
+			keep &= probabilities >= threshold
+
+		return pd.DataFrame({
+			"user_id": row_user_ids[keep],
+			"product_id": product_ids[keep],
+			"product_name": self.names_of(product_ids[keep]),
+			"probability": probabilities[keep],
+			"rank": rank[keep],
+		})
@@ -0,0 +1,226 @@
+"""
+Candidate retrieval of products a user has never bought.
+
+Users and products are embedded by a truncated SVD of the user x product matrix of prior purchases, weighted by
+log(1 + count) and by the inverse user frequency of the product, so the dot product of a user and a product
+embedding approximates how much the user's basket history looks like that of the product's buyers. Products are
+grouped into k-means lists (an inverted file index): a query scores the list centroids first and then only the
+products of the best `n_probe` lists. Everything is stored in one packed arrays file that is memory-mapped on load.
+"""
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+import scipy.sparse as sp
+
+from config import RETRIEVAL_COMPONENTS, RETRIEVAL_INDEX_PATH, RETRIEVAL_N_PROBE, RETRIEVAL_TOP_K
+from scripts.interactions import load_interactions
+from scripts.packed_arrays import read_packed, write_packed
+from scripts.raw_data import load_raw
+
+INDEX_FORMAT = "retrieval_index"
+INDEX_VERSION = 1
+
+
+def purchase_matrix() -> sp.csr_matrix:
+	"""
+	Returns the user x product matrix of prior purchase counts, addressed by user_id and product_id.
+
+	Returns:
+		sp.csr_matrix: float32 counts, with sorted product ids in every user row.
+	"""
+	products = load_raw('products', columns=['product_id'])
+	matrix = load_interactions().csr()
+	n_products = max(matrix.shape[1], int(products.product_id.max()) + 1)
+	return sp.csr_matrix((matrix.data, matrix.indices, matrix.indptr), shape=(matrix.shape[0], n_products))
+
+
+def build_retrieval_index(
+		matrix: Optional[sp.csr_matrix] = None,
+		n_components: int = RETRIEVAL_COMPONENTS,
+		n_lists: Optional[int] = None,
+		path: str = RETRIEVAL_INDEX_PATH,
+		random_state: int = 42
+) -> "CandidateIndex":
+	"""
+	Computes the user and product embeddings and writes the retrieval index.
+
+	Args:
+		matrix (Optional[sp.csr_matrix]): User x product purchase counts. If None, built from the raw data.
+		n_components (int): Dimension of the embeddings.
+		n_lists (Optional[int]): Number of k-means lists of products. If None, about the square root of the
+			number of purchased products.
+		path (str): Output file.
+		random_state (int): Seed of the SVD and the k-means.
+
+	Returns:
+		CandidateIndex: The index.
+	"""
+	# Only needed to build the index, so serving processes that open it do not import them
+	from sklearn.cluster import MiniBatchKMeans
+	from sklearn.decomposition import TruncatedSVD
+
+	matrix = purchase_matrix() if matrix is None else matrix.tocsr()
+	n_users, n_products = matrix.shape
+
+	# log-scaled counts, weighted down for products that most users buy
+	buyers = np.bincount(matrix.indices, minlength=n_products)
+	idf = np.log((1 + n_users) / (1 + buyers)).astype(np.float32)
+	weighted = matrix.copy()
+	weighted.data = np.log1p(weighted.data) * idf[weighted.indices]
+
+	print(f"Embedding {n_users} users and {n_products} products in {n_components} dimensions...")
+	n_components = max(1, min(n_components, min(weighted.shape) - 1))
+	svd = TruncatedSVD(n_components=n_components, algorithm="randomized", random_state=random_state)
+	user_vectors = svd.fit_transform(weighted).astype(np.float32)
+	product_vectors = np.ascontiguousarray(svd.components_.T, dtype=np.float32)
+
+	# Inverted lists over the purchased products, clustered on direction since queries rank by dot product
+	purchased = np.flatnonzero(buyers)
+	n_lists = n_lists or max(1, int(np.sqrt(len(purchased))))
+	n_lists = max(1, min(n_lists, len(purchased)))
+	print(f"Clustering {len(purchased)} products into {n_lists} lists...")
+	norms = np.linalg.norm(product_vectors[purchased], axis=1, keepdims=True)
+	kmeans = MiniBatchKMeans(n_clusters=n_lists, random_state=random_state, n_init=3)
+	labels = kmeans.fit_predict(product_vectors[purchased] / np.maximum(norms, 1e-12))
+
+	order = np.argsort(labels, kind="stable")
+	list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+	np.cumsum(np.bincount(labels, minlength=n_lists), out=list_offsets[1:])
+	list_products = purchased[order].astype(np.uint32)
+	# Centroids of the unnormalized vectors, so a centroid score is the mean score of its list
+	centroids = np.zeros((n_lists, n_components), dtype=np.float32)
+	np.add.at(centroids, labels, product_vectors[purchased])
+	centroids /= np.maximum(np.diff(list_offsets), 1)[:, None]
+
+	write_packed(path, {
+		"format": INDEX_FORMAT,
+		"version": INDEX_VERSION,
+		"n_components": n_components,
+		"explained_variance_ratio": float(svd.explained_variance_ratio_.sum()),
+	}, {
+		"user_vectors": user_vectors,
+		"centroids": centroids,
+		"list_offsets": list_offsets,
+		"list_products": list_products,
+		"list_vectors": product_vectors[list_products],
+		"history_offsets": matrix.indptr.astype(np.int64),
+		"history_products": matrix.indices.astype(np.uint32),
+		"popular_products": np.argsort(-buyers, kind="stable")[:len(purchased)].astype(np.uint32),
+	})
+	print(f"Retrieval index saved as {path}.")
+	return CandidateIndex.load(path)
+
+
+class CandidateIndex:
+	"""
+	Approximate top-K search of products a user has not bought, by embedding dot product.
+	Users without purchases, or unknown to the index, get the products bought by the most users.
+	"""
+
+	def __init__(self, header: dict, arrays: dict):
+		self.header = header
+		self.user_vectors = arrays["user_vectors"]
+		self.centroids = arrays["centroids"]
+		self.list_offsets = arrays["list_offsets"]
+		self.list_products = arrays["list_products"]
+		self.list_vectors = arrays["list_vectors"]
+		self.history_offsets = arrays["history_offsets"]
+		self.history_products = arrays["history_products"]
+		self.popular_products = arrays["popular_products"]
+
+	@classmethod
+	def load(cls, path: str = RETRIEVAL_INDEX_PATH, mmap: bool = True) -> "CandidateIndex":
+		"""
+		Opens a retrieval index written by `build_retrieval_index`.
+		"""
+		header, arrays = read_packed(path, mmap=mmap)
+		if header.get("format") != INDEX_FORMAT:
+			raise ValueError(f"{path} is not a retrieval index.")
+		if header["version"] > INDEX_VERSION:
+			raise ValueError(f"{path} has index version {header['version']}, this code reads up to {INDEX_VERSION}.")
+		return cls(header, arrays)
+
+	def history(self, user_id: int) -> np.ndarray:
+		"""
+		Returns the sorted ids of the products the user has bought.
+		"""
+		if user_id < 0 or user_id + 1 >= len(self.history_offsets):
+			return self.history_products[:0]
+		return self.history_products[self.history_offsets[user_id]:self.history_offsets[user_id + 1]]
+
+	def _popular(self, history: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+		# Enough popular products to still have k after removing the bought ones
+		popular = self.popular_products[:k + len(history)]
+		popular = popular[~np.isin(popular, history)][:k]
+		return popular, np.zeros(len(popular), dtype=np.float32)
+
+	def search_user(
+			self,
+			user_id: int,
+			k: int = RETRIEVAL_TOP_K,
+			n_probe: int = RETRIEVAL_N_PROBE
+	) -> Tuple[np.ndarray, np.ndarray]:
+		"""
+		Finds the k products with the highest scores among the products the user has not bought.
+
+		Args:
+			user_id (int): The user.
+			k (int): Number of candidates.
+			n_probe (int): Number of product lists searched. More lists find more of the exact top k.
+
+		Returns:
+			Tuple[np.ndarray, np.ndarray]: Product ids and float32 scores, by descending score.
+		"""
+		history = self.history(user_id)
+		if user_id < 0 or user_id >= len(self.user_vectors) or not len(history):
+			return self._popular(history, k)
+
+		query = self.user_vectors[user_id]
+		n_lists = len(self.centroids)
+		n_probe = min(n_probe, n_lists)
+		list_order = np.argsort(-(self.centroids @ query), kind="stable")
+		while True:
+			# Rows of the probed lists, concatenated without a Python loop
+			lists = list_order[:n_probe]
+			starts, ends = self.list_offsets[lists], self.list_offsets[lists + 1]
+			lengths = ends - starts
+			rows = np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+
+			product_ids = self.list_products[rows]
+			novel = ~np.isin(product_ids, history, assume_unique=True)
+			rows, product_ids = rows[novel], product_ids[novel]
+			# Probe more lists when the probed ones have fewer than k products the user has not bought
+			if len(rows) >= k or n_probe == n_lists:
+				break
+			n_probe = min(2 * n_probe, n_lists)
+
+		scores = self.list_vectors[rows] @ query
+
+		if len(scores) > k:
+			top = np.argpartition(-scores, k - 1)[:k]
+			product_ids, scores = product_ids[top], scores[top]
+		order = np.argsort(-scores, kind="stable")
+		return product_ids[order], scores[order]
+
+	def search(
+			self,
+			user_ids: Union[List[int], np.ndarray],
+			k: int = RETRIEVAL_TOP_K,
+			n_probe: int = RETRIEVAL_N_PROBE
+	) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+		"""
+		Finds the top k products every user has not bought.
+
+		Returns:
+			Tuple[np.ndarray, np.ndarray, np.ndarray]: User id, product id and score of every candidate,
+			grouped by user in input order.
+		"""
+		results = [self.search_user(int(user_id), k, n_probe) for user_id in user_ids]
+		lengths = [len(product_ids) for product_ids, _ in results]
+		if not results:
+			return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.float32)
+		return (
+			np.repeat(np.asarray(user_ids, dtype=np.int64), lengths),
+			np.concatenate([product_ids for product_ids, _ in results]).astype(np.uint32),
+			np.concatenate([scores for _, scores in results]).astype(np.float32),
+		)
@@ -0,0 +1,122 @@
+"""
+User-grouped splits and negative subsampling of the training rows.
+
+All products of a user share the user's features, so rows of one user must not be split between training and
+evaluation: folds are drawn over users instead of rows. Most rows are negatives (products that are not reordered),
+so training can keep all positives and a stratified sample of every user's negatives, weighted by the inverse of the
+sampling rate, which keeps the weighted class totals and the per-user mix of the full data.
+"""
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+from sklearn.utils.class_weight import compute_sample_weight
+
+
+def user_fold_ids(user_ids: np.ndarray, n_folds: int, random_state: int = 42) -> np.ndarray:
+	"""
+	Assigns every user to one of `n_folds` folds of (almost) equal numbers of users, at random.
+
+	Args:
+		user_ids (np.ndarray): User id of every row.
+		n_folds (int): Number of folds.
+		random_state (int): Seed of the assignment.
+
+	Returns:
+		np.ndarray: Fold of every row, all rows of a user in the same fold.
+	"""
+	users, inverse = np.unique(user_ids, return_inverse=True)
+	user_folds = np.random.default_rng(random_state).permutation(len(users)) % n_folds
+	return user_folds[inverse].astype(np.int32)
+
+
+def user_folds(
+		user_ids: np.ndarray,
+		n_folds: int = 5,
+		random_state: int = 42
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+	"""
+	Cross-validation over users: the row indices of the training and validation rows of every fold.
+	Accepted by scikit-learn as `cv=list(user_folds(user_ids))`.
+
+	Args:
+		user_ids (np.ndarray): User id of every row.
+		n_folds (int): Number of folds.
+		random_state (int): Seed of the assignment of the users to the folds.
+
+	Yields:
+		Tuple[np.ndarray, np.ndarray]: Training rows and validation rows of a fold.
+	"""
+	fold_ids = user_fold_ids(user_ids, n_folds, random_state)
+	for fold in range(n_folds):
+		yield np.flatnonzero(fold_ids != fold), np.flatnonzero(fold_ids == fold)
+
+
+def sample_negatives(
+		user_ids: np.ndarray,
+		y: np.ndarray,
+		rate: float,
+		random_state: int = 42
+) -> Tuple[np.ndarray, np.ndarray]:
+	"""
+	Keeps all positive rows and a fraction of the negative rows of every user.
+	Every user keeps ceil(rate * n) of their n negatives, so users with few negatives keep at least one. Kept
+	negatives are weighted by n / kept, so the weighted negatives of every user add up to their full count.
+
+	Args:
+		user_ids (np.ndarray): User id of every row.
+		y (np.ndarray): Binary labels.
+		rate (float): Fraction of the negatives to keep, in (0, 1].
+		random_state (int): Seed of the sample.
+
+	Returns:
+		Tuple[np.ndarray, np.ndarray]: Sorted indices of the kept rows and their float32 weights.
+	"""
+	if not 0 < rate <= 1:
+		raise ValueError(f"The negative sampling rate must be in (0, 1], got {rate}.")
+
+	negatives = np.flatnonzero(y == 0)
+	if rate == 1 or not len(negatives):
+		return np.arange(len(y)), np.ones(len(y), dtype=np.float32)
+
+	# Rank the negatives of every user in a random order and keep the first ceil(rate * n) of them
+	noise = np.random.default_rng(random_state).random(len(negatives))
+	order = np.lexsort((noise, user_ids[negatives]))
+	users, starts, counts = np.unique(user_ids[negatives][order], return_index=True, return_counts=True)
+	ranks = np.arange(len(order)) - np.repeat(starts, counts)
+	kept_counts = np.ceil(rate * counts).astype(np.int64)
+	keep = ranks < np.repeat(kept_counts, counts)
+
+	weights = np.ones(len(y), dtype=np.float32)
+	weights[negatives[order]] = np.repeat(counts / kept_counts, counts)
+	kept = np.ones(len(y), dtype=bool)
+	kept[negatives[order]] = keep
+
+	rows = np.flatnonzero(kept)
+	return rows, weights[rows]
+
+
+def class_weights(y: np.ndarray, class_weight=None, weights: Optional[np.ndarray] = None) -> Optional[np.ndarray]:
+	"""
+	Combines row weights with a scikit-learn `class_weight`.
+	"balanced" is computed from the weighted class totals, so it balances the classes of the full data that
+	weighted samples stand for, and equals the scikit-learn weights without row weights.
+
+	Args:
+		y (np.ndarray): Binary labels.
+		class_weight: None, "balanced" or a {class: weight} dict.
+		weights (Optional[np.ndarray]): Row weights, e.g. from `sample_negatives`.
+
+	Returns:
+		Optional[np.ndarray]: float32 weights of the rows, None if all of them are 1.
+	"""
+	if class_weight is None:
+		return None if weights is None else np.asarray(weights, dtype=np.float32)
+
+	weights = np.ones(len(y), dtype=np.float64) if weights is None else np.asarray(weights, dtype=np.float64)
+	if class_weight == "balanced":
+		totals = np.bincount(y, weights=weights, minlength=2)
+		present = totals > 0
+		factors = np.zeros(len(totals))
+		factors[present] = weights.sum() / (present.sum() * totals[present])
+		return (weights * factors[y]).astype(np.float32)
+	return (weights * compute_sample_weight(class_weight, y)).astype(np.float32)
@@ -0,0 +1,135 @@
+"""
+Serving snapshot: the feature index and the product names in one memory-mappable file.
+
+Building the serving index from the feature store stacks and scatters every feature column into private arrays,
+so every serving process pays for the build and holds its own copy. The snapshot stores the finished arrays instead:
+opening it maps the file and views the arrays in place, in milliseconds, and processes serving the same snapshot
+share its pages through the OS page cache. Product names are stored as concatenated UTF-8 bytes and only the names
+of the returned products are decoded.
+"""
+import glob
+import os
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from config import FEATURE_STORE_PATH, FEATURES_PATH, RAW_DATA_PATH, SERVING_SNAPSHOT_PATH
+from scripts.feature_index import FeatureIndex
+from scripts.feature_store import MANIFEST_FILE, store_exists
+from scripts.packed_arrays import read_header, read_packed, write_packed
+
+SNAPSHOT_FORMAT = "serving_snapshot"
+SNAPSHOT_VERSION = 1
+
+
+def snapshot_sources() -> Dict[str, dict]:
+	"""
+	Sizes and modification times of the files the snapshot is built from.
+	"""
+	paths = [os.path.join(RAW_DATA_PATH, "products.csv")]
+	if store_exists():
+		paths.append(os.path.join(FEATURE_STORE_PATH, MANIFEST_FILE))
+	else:
+		paths.extend(sorted(glob.glob(os.path.join(FEATURES_PATH, "*.csv"))))
+
+	sources = {}
+	for path in paths:
+		stat = os.stat(path)
+		sources[path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+	return sources
+
+
+class ProductNames:
+	"""
+	Product names addressed by product_id, decoded on access from UTF-8 bytes.
+	Indexing with an array of ids returns an object array, like indexing the array of `load_product_names`.
+	"""
+
+	def __init__(self, offsets: np.ndarray, data: np.ndarray, has_name: np.ndarray):
+		self.offsets = offsets
+		self.data = data
+		self.has_name = has_name
+
+	@classmethod
+	def encode(cls, names: np.ndarray) -> "ProductNames":
+		"""
+		Packs an object array of names (None for unknown ids).
+		"""
+		encoded = [b"" if name is None else str(name).encode() for name in names]
+		offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+		np.cumsum([len(name) for name in encoded], out=offsets[1:])
+		data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+		return cls(offsets, data, np.array([name is not None for name in names], dtype=bool))
+
+	def __len__(self) -> int:
+		return len(self.has_name)
+
+	def __getitem__(self, product_ids: np.ndarray) -> np.ndarray:
+		product_ids = np.atleast_1d(np.asarray(product_ids, dtype=np.int64))
+		names = np.full(len(product_ids), None, dtype=object)
+		for i, product_id in enumerate(product_ids):
+			if self.has_name[product_id]:
+				names[i] = self.data[self.offsets[product_id]:self.offsets[product_id + 1]].tobytes().decode()
+		return names
+
+
+def build_serving_snapshot(
+		feature_index: FeatureIndex,
+		product_names: np.ndarray,
+		path: str = SERVING_SNAPSHOT_PATH
+) -> None:
+	"""
+	Writes the serving snapshot of a feature index and the product names.
+
+	Args:
+		feature_index (FeatureIndex): The index, e.g. `FeatureIndex.load()`.
+		product_names (np.ndarray): Object array of product names addressed by product_id, see `load_product_names`.
+		path (str): Output file.
+	"""
+	names = ProductNames.encode(product_names)
+	os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+	write_packed(path, {
+		"format": SNAPSHOT_FORMAT,
+		"version": SNAPSHOT_VERSION,
+		"sources": snapshot_sources(),
+		"up_names": feature_index.up_names,
+		"u_names": feature_index.u_names,
+		"p_names": feature_index.p_names,
+	}, {
+		**feature_index.arrays(),
+		"name_offsets": names.offsets,
+		"name_data": names.data,
+		"has_name": names.has_name,
+	})
+
+
+def open_serving_snapshot(
+		path: str = SERVING_SNAPSHOT_PATH,
+		check_sources: bool = True
+) -> Optional[Tuple[FeatureIndex, ProductNames]]:
+	"""
+	Opens a serving snapshot, memory-mapped.
+
+	Args:
+		path (str): Snapshot file.
+		check_sources (bool): Return None if the features or the products changed since the snapshot was built.
+
+	Returns:
+		Optional[Tuple[FeatureIndex, ProductNames]]: The feature index and the product names, None if the snapshot
+		does not exist or is out of date.
+	"""
+	if not os.path.exists(path):
+		return None
+	header, _, _ = read_header(path)
+	if header.get("format") != SNAPSHOT_FORMAT:
+		raise ValueError(f"{path} is not a serving snapshot.")
+	if header["version"] != SNAPSHOT_VERSION or (check_sources and header["sources"] != snapshot_sources()):
+		print(f"The serving snapshot {path} is out of date, rebuild it with 'python scripts/build_serving_snapshot.py'.")
+		return None
+
+	_, arrays = read_packed(path, mmap=True)
+	names = ProductNames(arrays.pop("name_offsets"), arrays.pop("name_data"), arrays.pop("has_name"))
+	feature_index = FeatureIndex.from_arrays(
+		**arrays, up_names=header["up_names"], u_names=header["u_names"], p_names=header["p_names"]
+	)
+	return feature_index, names
@@ -0,0 +1,147 @@
+"""
+Out-of-core feature extraction.
+
+'order_products__prior.csv' is read in chunks and partitioned by user on disk, so that only one partition
+of the orders-products join is in memory at a time. The user and user-product statistics of a partition are final,
+since partitions have disjoint users, and the product statistics of all partitions are combined at the end.
+"""
+import math
+import os
+import tempfile
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+from config import RAW_DATA_PATH
+from scripts.feature_stats import Stats, partial_stats
+from scripts.feature_store import compact_dtype
+from scripts.raw_data import iter_csv_typed, load_raw
+
+# Approximate peak memory per row of the orders-products join while its statistics are computed
+BYTES_PER_JOINED_ROW = 400
+# Approximate size of a row of 'order_products__prior.csv'
+CSV_BYTES_PER_ROW = 16
+
+PARTITION_COLUMNS = ['order_id', 'product_id', 'add_to_cart_order', 'reordered']
+
+
+def n_partitions_for(memory_budget_mb: int, order_products_path: str) -> int:
+	"""
+	Estimates the number of user partitions needed to keep each partition's join within the memory budget.
+	"""
+	estimated_rows = os.path.getsize(order_products_path) / CSV_BYTES_PER_ROW
+	return max(1, math.ceil(estimated_rows * BYTES_PER_JOINED_ROW / (memory_budget_mb * 1024 ** 2)))
+
+
+def _compact(df: pd.DataFrame) -> pd.DataFrame:
+	return df.astype({c: compact_dtype(df[c].to_numpy()) for c in df.columns})
+
+
+def partition_order_products(
+		order_products_path: str,
+		order_users: np.ndarray,
+		n_partitions: int,
+		partition_dir: str,
+		chunk_size: int
+) -> List[List[str]]:
+	"""
+	Splits the order products by user partition (user_id % n_partitions) into chunk files.
+
+	Args:
+		order_products_path (str): Path to 'order_products__prior.csv'.
+		order_users (np.ndarray): User of every order, addressed by order_id (-1 for orders to skip).
+		n_partitions (int): Number of partitions.
+		partition_dir (str): Directory to write the chunk files to.
+		chunk_size (int): Number of CSV rows read at once.
+
+	Returns:
+		List[List[str]]: Paths of the chunk files of every partition.
+	"""
+	partitions = [[] for _ in range(n_partitions)]
+
+	reader = iter_csv_typed(order_products_path, 'order_products__prior', chunk_size)
+	for i, chunk in enumerate(reader):
+		print(f"Partitioning chunk {i}...")
+		values = chunk[PARTITION_COLUMNS].to_numpy(np.int32)
+
+		order_ids = values[:, 0]
+		known = order_ids < len(order_users)
+		users = np.full(len(values), -1, dtype=np.int64)
+		users[known] = order_users[order_ids[known]]
+
+		values, users = values[users >= 0], users[users >= 0]
+		partition_of_row = users % n_partitions
+		for partition in np.unique(partition_of_row):
+			path = os.path.join(partition_dir, f"part_{partition:05d}_chunk_{i:06d}.npy")
+			np.save(path, values[partition_of_row == partition])
+			partitions[partition].append(path)
+
+	return partitions
+
+
+def combine_partitions(parts: List[Stats]) -> Stats:
+	"""
+	Combines the statistics of partitions with disjoint users.
+	"""
+	return {
+		'u': pd.concat([part['u'] for part in parts]).sort_values('user_id', ignore_index=True),
+		'up': pd.concat([part['up'] for part in parts]).sort_values(['user_id', 'product_id'], ignore_index=True),
+		'p': pd.concat([part['p'].astype(np.int64) for part in parts]).groupby(
+			'product_id', sort=True
+		).sum().reset_index(),
+	}
+
+
+def streaming_stats(
+		memory_budget_mb: int = 4096,
+		chunk_size: int = 5_000_000,
+		tmp_dir: Optional[str] = None
+) -> Stats:
+	"""
+	Computes the sufficient statistics of all prior orders in RAW_DATA_PATH within a bounded amount of memory.
+
+	Args:
+		memory_budget_mb (int): Approximate memory budget for the join of one partition.
+		chunk_size (int): Number of rows of 'order_products__prior.csv' read at once.
+		tmp_dir (Optional[str]): Directory for the partition files. Defaults to the system temporary directory.
+
+	Returns:
+		Stats: Statistics by grain, like `partial_stats` on the full join.
+	"""
+	order_products_path = os.path.join(RAW_DATA_PATH, 'order_products__prior.csv')
+
+	print("Loading orders...")
+	orders = load_raw('orders')
+	orders = orders[orders.eval_set == 'prior'].drop(columns='eval_set')
+
+	order_users = np.full(orders.order_id.max() + 1, -1, dtype=np.int64)
+	order_users[orders.order_id.to_numpy()] = orders.user_id.to_numpy()
+
+	n_partitions = n_partitions_for(memory_budget_mb, order_products_path)
+	print(f"Using {n_partitions} partitions...")
+
+	parts = []
+	with tempfile.TemporaryDirectory(dir=tmp_dir) as partition_dir:
+		partitions = partition_order_products(
+			order_products_path, order_users, n_partitions, partition_dir, chunk_size
+		)
+		del order_users
+
+		for partition, paths in enumerate(partitions):
+			if not paths:
+				continue
+			print(f"Aggregating partition {partition + 1}/{n_partitions}...")
+			order_products = pd.DataFrame(
+				np.concatenate([np.load(path) for path in paths]), columns=PARTITION_COLUMNS
+			)
+			orders_prior = orders[orders.user_id % n_partitions == partition].merge(
+				order_products, on='order_id', how='inner'
+			)
+			del order_products
+
+			# Keep the accumulated statistics small, they are widened again when combined
+			parts.append({grain: _compact(stats) for grain, stats in partial_stats(orders_prior).items()})
+			del orders_prior
+
+	return {grain: stats.astype(np.int64) for grain, stats in combine_partitions(parts).items()}
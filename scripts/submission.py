@@ -0,0 +1,158 @@
+"""
+Streaming generation of the Kaggle submission file.
+
+Test users are scored in fixed-size chunks across a pool of forked worker processes, and every chunk is formatted
+into CSV lines as soon as it is scored, so memory stays flat and only the lines of a chunk are in flight at once.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from scripts.basket import select_baskets
+from scripts.instrumentation import stage
+from scripts.recommender import Recommender
+
+USERS_PER_CHUNK = 4096
+
+# Model and feature index of the running submission. Worker processes are forked after they are set,
+# so they share them instead of receiving pickled copies with every chunk.
+_context: Dict[str, object] = {}
+
+
+def format_lines(
+		order_ids: np.ndarray,
+		counts: np.ndarray,
+		product_ids: np.ndarray,
+		add_none: Optional[np.ndarray] = None
+) -> str:
+	"""
+	Formats submission lines 'order_id,product_id product_id ...' with one string join, without a Python loop.
+
+	Args:
+		order_ids (np.ndarray): Orders, in output order.
+		counts (np.ndarray): Number of selected products of every order. Orders without products get 'None'.
+		product_ids (np.ndarray): Selected products of all orders, grouped by order in output order.
+		add_none (Optional[np.ndarray]): Whether to append 'None' to the products of every order.
+
+	Returns:
+		str: The CSV lines, each terminated by a newline.
+	"""
+	if len(order_ids) == 0:
+		return ""
+
+	# Every line is a slot for 'order_id,' followed by one slot per product and one for 'None' if needed
+	has_none = counts == 0 if add_none is None else (counts == 0) | add_none
+	line_sizes = counts + has_none + 1
+	line_ends = np.cumsum(line_sizes)
+	line_starts = line_ends - line_sizes
+
+	tokens = np.empty(line_ends[-1], dtype=object)
+	is_product = np.ones(len(tokens), dtype=bool)
+	is_product[line_starts] = False
+	tokens[line_starts] = np.char.add(order_ids.astype(str), ",").astype(object)
+
+	none_slots = line_ends[has_none] - 1
+	is_product[none_slots] = False
+	tokens[none_slots] = "None"
+	tokens[is_product] = product_ids.astype(str).astype(object)
+
+	separators = np.full(len(tokens), " ", dtype=object)
+	separators[line_starts] = ""
+	separators[line_ends - 1] = "\n"
+	return "".join(tokens + separators)
+
+
+def _limit_threads() -> None:
+	# Every worker scores its own chunk, so the model must not spread over all cores in each of them
+	model = _context["model"]
+	if hasattr(model, "get_params") and "n_jobs" in model.get_params():
+		model.set_params(n_jobs=1)
+
+
+def _score_chunk(chunk: Tuple[np.ndarray, np.ndarray]) -> Tuple[int, str]:
+	"""
+	Scores the users of a chunk of test orders and formats the chunk's submission lines.
+	"""
+	order_ids, user_ids = chunk
+	recommender: Recommender = _context["recommender"]
+	row_user_ids, product_ids, probabilities = recommender.score(_context["model"], user_ids)
+
+	# Rows are grouped by user in chunk order, and every test user has exactly one test order
+	sorter = np.argsort(user_ids)
+	row_orders = sorter[np.searchsorted(user_ids, row_user_ids, sorter=sorter)]
+
+	threshold = _context["threshold"]
+	with stage("submission.baskets", rows=len(probabilities)):
+		if threshold is None:
+			selected, add_none = select_baskets(probabilities, np.bincount(row_orders, minlength=len(order_ids)))
+		else:
+			selected, add_none = probabilities > threshold, None
+
+		counts = np.bincount(row_orders[selected], minlength=len(order_ids))
+		return len(order_ids), format_lines(order_ids, counts, product_ids[selected], add_none)
+
+
+def _chunks(orders_test: pd.DataFrame, users_per_chunk: int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+	order_ids = orders_test["order_id"].to_numpy()
+	user_ids = orders_test["user_id"].to_numpy(np.int64)
+	for start in range(0, len(order_ids), users_per_chunk):
+		yield order_ids[start:start + users_per_chunk], user_ids[start:start + users_per_chunk]
+
+
+def write_submission(
+		path: str,
+		recommender: Recommender,
+		model,
+		orders_test: pd.DataFrame,
+		threshold: Optional[float] = None,
+		jobs: int = os.cpu_count() or 1,
+		users_per_chunk: int = USERS_PER_CHUNK
+) -> int:
+	"""
+	Scores all test orders and streams the submission lines to a CSV file, in the order of `orders_test`.
+
+	Args:
+		path (str): Output CSV file.
+		recommender (Recommender): Feature index of all users.
+		model: Fitted classifier with `predict_proba`.
+		orders_test (pd.DataFrame): Test orders with 'order_id' and 'user_id'.
+		threshold (Optional[float]): Products with a reorder probability above it are included.
+			If None, every order gets the basket that maximizes its expected F1 score, see `select_baskets`.
+		jobs (int): Number of worker processes. 1 to score in the current process.
+		users_per_chunk (int): Number of test users scored per task.
+
+	Returns:
+		int: Number of orders written.
+	"""
+	# Process pools need 'fork' to share the model and the feature index with the workers
+	parallel = jobs > 1 and "fork" in multiprocessing.get_all_start_methods()
+
+	_context.update(recommender=recommender, model=model, threshold=threshold)
+	n_written = 0
+	try:
+		with stage("submission.write") as record, open(path, "w") as f:
+			f.write("order_id,products\n")
+			if parallel:
+				context = multiprocessing.get_context("fork")
+				with ProcessPoolExecutor(max_workers=jobs, mp_context=context, initializer=_limit_threads) as pool:
+					for i, (n_orders, lines) in enumerate(
+							pool.map(_score_chunk, _chunks(orders_test, users_per_chunk))
+					):
+						print(f"Writing chunk {i}...")
+						f.write(lines)
+						n_written += n_orders
+			else:
+				for i, chunk in enumerate(_chunks(orders_test, users_per_chunk)):
+					print(f"Writing chunk {i}...")
+					n_orders, lines = _score_chunk(chunk)
+					f.write(lines)
+					n_written += n_orders
+			record.rows = n_written
+	finally:
+		_context.clear()
+
+	return n_written
@@ -3,55 +3,38 @@ import os
 from datetime import datetime
 
 import autorootcwd  # noqa
-import pandas as pd
 
-from config import RAW_DATA_PATH, SUBMIT_PATH
-from scripts.utils import load_features, load_model
+from config import SUBMIT_PATH
+from scripts.raw_data import load_raw
+from scripts.recommender import Recommender
+from scripts.submission import write_submission
+from scripts.tree_ensemble import compile_model
+from scripts.utils import load_model
 
-THRESHOLD = 0.5  # for probability of been reordered
+# Probability of been reordered above which products are included.
+# None to pick the basket with the highest expected F1 score for every order.
+THRESHOLD = None
+JOBS = os.cpu_count() or 1  # worker processes scoring the test users
 
 # Ensure the output directory exists
 os.makedirs(SUBMIT_PATH, exist_ok=True)
 # %%
 print("Loading orders...")
-orders = pd.read_csv(os.path.join(RAW_DATA_PATH, 'orders.csv'))
+orders = load_raw('orders', columns=['order_id', 'user_id', 'eval_set'])
 orders_test = orders[orders.eval_set == 'test']
 # %%
 print("Loading features...")
-df = load_features()
-df = orders_test[['user_id']].merge(
-	df,
-	on='user_id',
-	how='left'
-)
-df.set_index(['user_id', 'product_id'], inplace=True)
+recommender = Recommender.load()
 # %%
 print("Loading model...")
-model = load_model()
-# %%
-print("Predicting proba...")
-y_pred = model.predict_proba(df)
+model = compile_model(load_model())
 # %%
 print("Creating submission file...")
-df['reordered_pred'] = (y_pred[:, 1] > THRESHOLD).astype(int)
-df = df.reset_index()[['product_id', 'user_id', 'reordered_pred']]
-df = df.merge(  # add order_id
-	orders_test[["user_id", "order_id"]], on='user_id', how='left'
-)
-# %%
-df = (
-	df[df.reordered_pred == 1]
-	.groupby('order_id')['product_id']
-	.apply(lambda x: ' '.join(map(str, x)))
-	.to_frame('products')
-	.reset_index()
-)
-df = orders_test[['order_id']].merge(
-	df, on='order_id', how='left'
-)
-df.fillna("None", inplace=True)
-# %%
-assert df.shape[0] == 75_000
 save_path = os.path.join(SUBMIT_PATH, f"submission_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
-df.to_csv(save_path, index=False)
+tmp_path = save_path + ".tmp"
+n_orders = write_submission(tmp_path, recommender, model, orders_test, THRESHOLD, jobs=JOBS)
+# %%
+assert n_orders == 75_000
+os.replace(tmp_path, save_path)
+print(f"Submission saved as {save_path}.")
 # %%
@@ -0,0 +1,182 @@
+"""
+Seeded generator of synthetic raw data in the shape of the Instacart tables.
+
+Every user has 4 to 100 orders (mostly prior, the last one in the train or test set), a basket size, a favourite
+day and hour, and a set of staple products they keep coming back to. Products are drawn from the user's staples
+or from a Zipf-like popularity over the catalogue, so the per-order basket sizes, the reorder ratio (close to 0.6)
+and the popularity skew resemble the real data. Users are generated in chunks that are appended to the CSV files,
+so the memory use does not grow with the number of users.
+"""
+import os
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+# Number of users of the benchmark scales
+SCALES: Dict[str, int] = {
+	"small": 10_000,
+	"medium": 200_000,
+	"large": 2_000_000,
+}
+
+N_INSTACART_PRODUCTS = 49_688
+MAX_ORDERS = 100
+TEST_SHARE = 75_000 / 206_209  # users whose last order is in the test set
+DOW_WEIGHTS = np.array([0.19, 0.17, 0.13, 0.12, 0.12, 0.13, 0.14])
+HOUR_WEIGHTS = np.array([
+	1, 1, 1, 1, 1, 2, 6, 18, 37, 52, 57, 56, 54, 55, 56, 55, 50, 41, 32, 26, 21, 16, 12, 8
+], dtype=np.float64)
+
+
+def default_n_products(n_users: int) -> int:
+	return int(min(N_INSTACART_PRODUCTS, max(2_000, n_users // 4)))
+
+
+def _segment_positions(lengths: np.ndarray) -> np.ndarray:
+	# 0, 1, ..., n - 1 within every segment of consecutive rows
+	starts = np.cumsum(lengths) - lengths
+	return np.arange(lengths.sum()) - np.repeat(starts, lengths)
+
+
+def _sample(rng: np.random.Generator, weights: np.ndarray, size: int) -> np.ndarray:
+	cdf = np.cumsum(weights / weights.sum())
+	return np.minimum(np.searchsorted(cdf, rng.random(size), side="right"), len(weights) - 1)
+
+
+def generate_users(
+		rng: np.random.Generator,
+		first_user_id: int,
+		n_users: int,
+		first_order_id: int,
+		popularity: np.ndarray
+) -> Dict[str, pd.DataFrame]:
+	"""
+	Generates the orders and order products of consecutive users.
+
+	Args:
+		rng (np.random.Generator): Random generator.
+		first_user_id (int): Id of the first user.
+		n_users (int): Number of users.
+		first_order_id (int): Id of the first order.
+		popularity (np.ndarray): Purchase weight of every product, index 0 being product_id 1.
+
+	Returns:
+		Dict[str, pd.DataFrame]: 'orders', 'order_products__prior' and 'order_products__train' tables.
+	"""
+	user_ids = np.arange(first_user_id, first_user_id + n_users, dtype=np.int64)
+
+	# Users: number of orders, basket size, habits and staples
+	n_orders = np.minimum(3 + rng.geometric(1 / 14, n_users), MAX_ORDERS)
+	basket_size = np.exp(rng.normal(2.3, 0.5, n_users))
+	reorder_propensity = rng.beta(5, 2, n_users)
+	mean_gap = rng.uniform(4, 20, n_users)
+	favourite_dow = _sample(rng, DOW_WEIGHTS, n_users)
+	favourite_hour = _sample(rng, HOUR_WEIGHTS, n_users)
+	n_staples = rng.integers(5, 41, n_users)
+	staples = _sample(rng, popularity, int(n_staples.sum())) + 1
+	staple_offsets = np.cumsum(n_staples) - n_staples
+
+	# Orders, sorted by user and order number
+	order_users = np.repeat(np.arange(n_users), n_orders)
+	order_number = _segment_positions(n_orders) + 1
+	is_last = order_number == n_orders[order_users]
+	eval_set = np.where(is_last, np.where(rng.random(len(order_users)) < TEST_SHARE, "test", "train"), "prior")
+	n = len(order_users)
+	dow = np.where(rng.random(n) < 0.4, favourite_dow[order_users], _sample(rng, DOW_WEIGHTS, n))
+	hour = np.where(rng.random(n) < 0.4, favourite_hour[order_users], _sample(rng, HOUR_WEIGHTS, n))
+	gap = np.minimum(np.round(rng.exponential(mean_gap[order_users])), 30).astype(np.float32)
+	gap[order_number == 1] = np.nan
+	orders = pd.DataFrame({
+		"order_id": first_order_id + np.arange(n),
+		"user_id": user_ids[order_users],
+		"eval_set": eval_set,
+		"order_number": order_number,
+		"order_dow": dow,
+		"order_hour_of_day": hour,
+		"days_since_prior_order": gap,
+	})
+
+	# Items of the prior and train orders, from the user's staples or from the whole catalogue
+	with_products = np.flatnonzero(eval_set != "test")
+	sizes = np.clip(rng.poisson(basket_size[order_users[with_products]]), 1, 145)
+	item_orders = np.repeat(with_products, sizes)
+	item_users = order_users[item_orders]
+	from_staples = rng.random(len(item_orders)) < reorder_propensity[item_users]
+	staple_rows = staple_offsets[item_users] + (rng.random(len(item_orders)) * n_staples[item_users]).astype(np.int64)
+	products = np.where(from_staples, staples[staple_rows], _sample(rng, popularity, len(item_orders)) + 1)
+
+	# A product appears once per order, in the cart position of its first draw
+	keys = item_orders.astype(np.int64) * (len(popularity) + 1) + products
+	_, first = np.unique(keys, return_index=True)
+	first.sort()
+	item_orders, products = item_orders[first], products[first]
+	add_to_cart = _segment_positions(np.bincount(item_orders, minlength=n)[with_products]) + 1
+
+	# Reordered: the user bought the product in an earlier order
+	pair_keys = order_users[item_orders].astype(np.int64) * (len(popularity) + 1) + products
+	by_pair = np.lexsort((item_orders, pair_keys))
+	reordered = np.ones(len(item_orders), dtype=bool)
+	reordered[by_pair[np.r_[True, pair_keys[by_pair][1:] != pair_keys[by_pair][:-1]]]] = False
+
+	items = pd.DataFrame({
+		"order_id": first_order_id + item_orders,
+		"product_id": products,
+		"add_to_cart_order": add_to_cart,
+		"reordered": reordered.astype(np.uint8),
+	})
+	in_train = eval_set[item_orders] == "train"
+	return {
+		"orders": orders,
+		"order_products__prior": items[~in_train],
+		"order_products__train": items[in_train],
+	}
+
+
+def generate_raw_data(
+		path: str,
+		n_users: int,
+		n_products: Optional[int] = None,
+		seed: int = 42,
+		users_per_chunk: int = 50_000
+) -> Dict[str, int]:
+	"""
+	Writes 'orders.csv', 'order_products__prior.csv', 'order_products__train.csv' and 'products.csv' to a directory.
+
+	Args:
+		path (str): Output directory.
+		n_users (int): Number of users.
+		n_products (Optional[int]): Number of products. If None, grows with the users up to the Instacart catalogue.
+		seed (int): Seed of the generator. The same seed and sizes give the same files.
+		users_per_chunk (int): Number of users generated and written at once.
+
+	Returns:
+		Dict[str, int]: Number of rows of every table.
+	"""
+	n_products = n_products or default_n_products(n_users)
+	rng = np.random.default_rng(seed)
+	os.makedirs(path, exist_ok=True)
+
+	# Zipf-like popularity over a random order of the products
+	popularity = np.empty(n_products)
+	popularity[rng.permutation(n_products)] = 1 / (np.arange(n_products) + 10) ** 0.9
+	pd.DataFrame({
+		"product_id": np.arange(1, n_products + 1),
+		"product_name": [f"Product {product_id}" for product_id in range(1, n_products + 1)],
+		"aisle_id": rng.integers(1, 135, n_products),
+		"department_id": rng.integers(1, 22, n_products),
+	}).to_csv(os.path.join(path, "products.csv"), index=False)
+
+	rows = {"orders": 0, "order_products__prior": 0, "order_products__train": 0, "products": n_products}
+	next_order_id = 1
+	for first_user in range(0, n_users, users_per_chunk):
+		tables = generate_users(
+			rng, first_user + 1, min(users_per_chunk, n_users - first_user), next_order_id, popularity
+		)
+		first_chunk = first_user == 0
+		for table, df in tables.items():
+			df.to_csv(os.path.join(path, f"{table}.csv"), index=False, mode="w" if first_chunk else "a", header=first_chunk)
+			rows[table] += len(df)
+		next_order_id += len(tables["orders"])
+		print(f"Generated {min(first_user + users_per_chunk, n_users)} / {n_users} users")
+	return rows
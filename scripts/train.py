@@ -0,0 +1,50 @@
+import argparse
+
+import autorootcwd  # noqa
+
+import scripts.features  # noqa: registers the features
+from config import NEGATIVE_SAMPLE_RATE, TUNING_N_JOBS, TUNING_TIME_BUDGET_S
+from scripts.feature_registry import feature_names
+from scripts.instrumentation import configure
+from scripts.training import TRAINERS, train_models
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Tune, evaluate and export models from one cached training split.")
+	parser.add_argument(
+		"--models", nargs="+", metavar="MODEL_TYPE", choices=list(TRAINERS), default=list(TRAINERS),
+		help=f"Model families to train, one after the other. Defaults to all: {', '.join(TRAINERS)}."
+	)
+	parser.add_argument(
+		"--features", nargs="+", metavar="FEATURE", choices=feature_names(),
+		help="Train on these features only. Defaults to all features."
+	)
+	parser.add_argument(
+		"--negative-rate", type=float, default=NEGATIVE_SAMPLE_RATE,
+		help="Fraction of the negative rows of every training user to keep, weighted up to stand for all of them."
+	)
+	parser.add_argument(
+		"--refresh", action="store_true", help="Rebuild the cached training split even if it is up to date."
+	)
+	parser.add_argument(
+		"--jobs", type=int, default=TUNING_N_JOBS, help="Threads of every model, -1 to use all cores."
+	)
+	parser.add_argument(
+		"--time-budget-s", type=float, default=TUNING_TIME_BUDGET_S,
+		help="Wall-clock budget of the hyperparameter search of every family, in seconds."
+	)
+	parser.add_argument("--metrics-log", metavar="PATH", help="Append the metrics of every stage to this JSON lines file.")
+	parser.add_argument(
+		"--profile", nargs="+", metavar="STAGE",
+		help="Profile these stages with cProfile, e.g. 'training.*'. The profiles are saved to PROFILE_PATH."
+	)
+	args = parser.parse_args()
+	configure(log_path=args.metrics_log, profile=args.profile)
+
+	train_models(
+		args.models,
+		columns=args.features,
+		negative_rate=args.negative_rate,
+		refresh=args.refresh,
+		n_jobs=args.jobs,
+		time_budget_s=args.time_budget_s,
+	)
@@ -0,0 +1,478 @@
+"""
+Shared training driver of the model families.
+
+The train / validation / test split is assembled once and cached as memory-mapped float32 arrays in
+TRAINING_CACHE_PATH, until the features or the train orders change. Validation and test rows are those of held-out
+users, and the training rows keep a weighted sample of the negatives (see scripts/sampling.py). The training rows
+are binned once per cache: the LightGBM Dataset binaries are written next to the arrays, and the XGBoost
+QuantileDMatrix of the training rows lends its quantile cuts to every other matrix. Every family is tuned by
+successive halving on the training rows, scored on the validation rows and evaluated on the test rows, one model at a
+time with all the threads. LightGBM and XGBoost boosters are saved inside a scikit-learn style BoosterClassifier.
+"""
+import abc
+import glob
+import json
+import os
+import shutil
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import joblib
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import f1_score, precision_score, recall_score
+from threadpoolctl import threadpool_limits
+
+from config import (
+	FEATURE_STORE_PATH, FEATURES_PATH, MODELS_PATH, NEGATIVE_SAMPLE_RATE, RAW_DATA_PATH, TRAINING_CACHE_PATH,
+	TUNING_N_JOBS, TUNING_TIME_BUDGET_S
+)
+from scripts.boosters import BoosterClassifier
+from scripts.feature_store import MANIFEST_FILE, store_exists
+from scripts.instrumentation import stage, timed
+from scripts.model_artifact import ARTIFACT_EXTENSION, export_model
+from scripts.sampling import class_weights, sample_negatives, user_fold_ids
+from scripts.tuning import SuccessiveHalvingSearch
+from scripts.utils import build_train_matrix
+
+CACHE_VERSION = 2
+SPLITS = ("train", "valid", "test")
+TEST_FOLDS = 5  # one fold of the users is held out for the reported metrics
+VALID_FOLDS = 5  # one fold of the remaining users, for early stopping and tuning scores
+RANDOM_STATE = 42
+LIGHTGBM_DATASET_PARAMS = {"max_bin": 255, "verbose": -1}
+
+
+def _sources() -> Dict[str, dict]:
+	"""
+	Sizes and modification times of the files the training matrix is built from.
+	"""
+	paths = [os.path.join(RAW_DATA_PATH, f"{table}.csv") for table in ("orders", "order_products__train")]
+	if store_exists():
+		paths.append(os.path.join(FEATURE_STORE_PATH, MANIFEST_FILE))
+	else:
+		paths.extend(sorted(glob.glob(os.path.join(FEATURES_PATH, "*.csv"))))
+
+	sources = {}
+	for path in paths:
+		stat = os.stat(path)
+		sources[path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+	return sources
+
+
+def _split_rows(
+		user_ids: np.ndarray,
+		y: np.ndarray,
+		negative_rate: float
+) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+	"""
+	Splits the rows by user, and samples the negatives of the training rows.
+
+	Returns:
+		Tuple[Dict[str, np.ndarray], np.ndarray]: Sorted row indices of every split and the training row weights.
+	"""
+	test_folds = user_fold_ids(user_ids, TEST_FOLDS, RANDOM_STATE)
+	rest = np.flatnonzero(test_folds != 0)
+	valid_folds = user_fold_ids(user_ids[rest], VALID_FOLDS, RANDOM_STATE + 1)
+	train = rest[valid_folds != 0]
+	kept, weights = sample_negatives(user_ids[train], y[train], negative_rate, RANDOM_STATE)
+	return {"train": train[kept], "valid": rest[valid_folds == 0], "test": np.flatnonzero(test_folds == 0)}, weights
+
+
+class TrainingData:
+	"""
+	The cached train / validation / test split.
+	Feature matrices are row-major float32, labels uint8, user ids uint32 and training row weights float32,
+	all memory-mapped read-only.
+	"""
+
+	def __init__(self, path: str = TRAINING_CACHE_PATH):
+		with open(os.path.join(path, "meta.json")) as f:
+			self.meta = json.load(f)
+		self.path = path
+		self.feature_names: List[str] = self.meta["feature_names"]
+		self._lightgbm = {}
+		self._xgboost = {}
+
+	def X(self, split: str) -> np.ndarray:
+		return np.load(os.path.join(self.path, f"X_{split}.npy"), mmap_mode="r")
+
+	def y(self, split: str) -> np.ndarray:
+		return np.load(os.path.join(self.path, f"y_{split}.npy"), mmap_mode="r")
+
+	def users(self, split: str) -> np.ndarray:
+		"""
+		Returns the user id of every row of a split, e.g. for `scripts.sampling.user_folds`.
+		"""
+		return np.load(os.path.join(self.path, f"users_{split}.npy"), mmap_mode="r")
+
+	def weights(self, split: str) -> Optional[np.ndarray]:
+		"""
+		Returns the row weights of a split, None if its rows are not weighted.
+		"""
+		path = os.path.join(self.path, f"w_{split}.npy")
+		return np.load(path, mmap_mode="r") if os.path.exists(path) else None
+
+	def frame(self, split: str, rows: Optional[np.ndarray] = None) -> pd.DataFrame:
+		"""
+		Returns the features of a split, or of some of its rows, as a DataFrame with the feature names.
+		"""
+		X = self.X(split)
+		return pd.DataFrame(X if rows is None else X[rows], columns=self.feature_names, copy=False)
+
+	def lightgbm_dataset(self, split: str) -> lgb.Dataset:
+		"""
+		Returns the constructed LightGBM Dataset of a split, binned with the bins of the training rows.
+		The binned data is saved to the cache on first use and loaded from it afterwards.
+		"""
+		if split not in self._lightgbm:
+			reference = None if split == "train" else self.lightgbm_dataset("train")
+			binary_path = os.path.join(self.path, f"lightgbm_{split}.bin")
+			if not os.path.exists(binary_path):
+				print(f"Binning the {split} rows for LightGBM...")
+				dataset = lgb.Dataset(
+					self.X(split),
+					label=self.y(split),
+					weight=self.weights(split),
+					feature_name=self.feature_names,
+					reference=reference,
+					params=LIGHTGBM_DATASET_PARAMS,
+				)
+				dataset.save_binary(binary_path + ".tmp")
+				os.replace(binary_path + ".tmp", binary_path)
+			self._lightgbm[split] = lgb.Dataset(
+				binary_path, reference=reference, params=LIGHTGBM_DATASET_PARAMS
+			).construct()
+		return self._lightgbm[split]
+
+	def xgboost_matrix(self, split: str, rows: Optional[np.ndarray] = None) -> xgb.QuantileDMatrix:
+		"""
+		Returns the XGBoost QuantileDMatrix of a split, or of some of its training rows.
+		Only the matrix of all training rows sketches quantiles, every other one reuses its cuts.
+		QuantileDMatrix cannot be saved, so the matrices are kept for the lifetime of the object.
+		"""
+		if rows is None and split in self._xgboost:
+			return self._xgboost[split]
+
+		reference = None if split == "train" and rows is None else self.xgboost_matrix("train")
+		X, y, weights = self.X(split), self.y(split), self.weights(split)
+		if rows is not None:
+			X, y = X[rows], y[rows]
+			weights = None if weights is None else weights[rows]
+		matrix = xgb.QuantileDMatrix(X, label=y, weight=weights, feature_names=self.feature_names, ref=reference)
+		if rows is None:
+			self._xgboost[split] = matrix
+		return matrix
+
+
+@timed("training.prepare")
+def prepare_training_data(
+		columns: Optional[List[str]] = None,
+		negative_rate: float = NEGATIVE_SAMPLE_RATE,
+		refresh: bool = False,
+		path: str = TRAINING_CACHE_PATH
+) -> TrainingData:
+	"""
+	Opens the cached train / validation / test split, building it first if the sources or the settings changed.
+
+	Args:
+		columns (Optional[List[str]]): Features to train on. If None, use all features.
+		negative_rate (float): Fraction of the negatives of every training user to keep, 1 to keep all rows.
+		refresh (bool): Rebuild the cache even if it is up to date.
+		path (str): Directory of the cache.
+
+	Returns:
+		TrainingData: The split.
+	"""
+	settings = {
+		"version": CACHE_VERSION,
+		"columns": columns,
+		"test_folds": TEST_FOLDS,
+		"valid_folds": VALID_FOLDS,
+		"negative_rate": negative_rate,
+		"random_state": RANDOM_STATE,
+		"sources": _sources(),
+	}
+	meta_path = os.path.join(path, "meta.json")
+	if not refresh and os.path.exists(meta_path):
+		with open(meta_path) as f:
+			if json.load(f)["settings"] == settings:
+				return TrainingData(path)
+
+	print("Building the training split...")
+	user_ids, _, X, y, feature_names = build_train_matrix(columns)
+
+	# Build the cache next to its final location and swap it in, so readers never see a partial cache
+	tmp_path = path.rstrip("/") + ".tmp"
+	shutil.rmtree(tmp_path, ignore_errors=True)
+	os.makedirs(tmp_path)
+
+	split_rows_by_split, train_weights = _split_rows(user_ids, y, negative_rate)
+	np.save(os.path.join(tmp_path, "w_train.npy"), train_weights)
+
+	rows = {}
+	for split, split_rows in split_rows_by_split.items():
+		X_split = np.lib.format.open_memmap(
+			os.path.join(tmp_path, f"X_{split}.npy"), mode="w+", dtype=np.float32, shape=(len(split_rows), X.shape[1])
+		)
+		np.take(X, split_rows, axis=0, out=X_split)
+		X_split.flush()
+		del X_split
+		np.save(os.path.join(tmp_path, f"y_{split}.npy"), y[split_rows])
+		np.save(os.path.join(tmp_path, f"users_{split}.npy"), user_ids[split_rows])
+		rows[split] = len(split_rows)
+
+	with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+		json.dump({"settings": settings, "feature_names": feature_names, "rows": rows}, f, indent=2)
+
+	shutil.rmtree(path, ignore_errors=True)
+	os.replace(tmp_path, path)
+	print(f"Training split cached in {path}: {rows}")
+	return TrainingData(path)
+
+
+class Trainer(abc.ABC):
+	"""
+	Trains the models of one family on the training rows of a TrainingData.
+	A model is trained by `fit(params, sample(rows))`, so the rows are prepared once for all parameters.
+	"""
+	model_type: str = None
+	param_grid: Dict[str, list] = {}
+
+	def __init__(self, data: TrainingData, n_jobs: int):
+		self.data = data
+		self.n_jobs = n_jobs
+
+	@property
+	def n_rows(self) -> int:
+		return len(self.data.y("train"))
+
+	@abc.abstractmethod
+	def sample(self, rows: Optional[np.ndarray] = None):
+		"""
+		Prepares training rows, sorted, or all of them if None.
+		"""
+
+	@abc.abstractmethod
+	def fit(self, params: dict, sample):
+		"""
+		Fits a model with the given parameters on prepared training rows.
+		"""
+
+	@abc.abstractmethod
+	def predict_proba(self, model, X: np.ndarray) -> np.ndarray:
+		"""
+		Returns the positive class probabilities of feature rows.
+		"""
+
+	@abc.abstractmethod
+	def n_trees(self, model) -> int:
+		"""
+		Returns the number of trees of a fitted model.
+		"""
+
+	def estimator(self, model):
+		"""
+		Returns a fitted model as it is saved: a scikit-learn style classifier.
+		"""
+		return model
+
+
+class RandomForestTrainer(Trainer):
+	model_type = "random_forest"
+	param_grid = {
+		'n_estimators': [50, 100],
+		'max_depth': [5, 7],
+		'class_weight': ['balanced'],
+		'min_samples_split': [2, 5],
+		'min_samples_leaf': [1, 2, 5],
+	}
+
+	def sample(self, rows: Optional[np.ndarray] = None):
+		y, weights = np.asarray(self.data.y("train")), self.data.weights("train")
+		if rows is not None:
+			y, weights = y[rows], None if weights is None else weights[rows]
+		return self.data.frame("train", rows), y, weights
+
+	def fit(self, params: dict, sample) -> RandomForestClassifier:
+		X, y, weights = sample
+		params = dict(params)
+		# class_weight is applied on top of the sampling weights here, so "balanced" balances the weighted classes
+		weights = class_weights(y, params.pop("class_weight", None), weights)
+		model = RandomForestClassifier(random_state=RANDOM_STATE, n_jobs=self.n_jobs, **params)
+		return model.fit(X, y, sample_weight=weights)
+
+	def predict_proba(self, model, X: np.ndarray) -> np.ndarray:
+		return model.predict_proba(pd.DataFrame(X, columns=self.data.feature_names, copy=False))[:, 1]
+
+	def n_trees(self, model) -> int:
+		return len(model.estimators_)
+
+
+class LightGBMTrainer(Trainer):
+	model_type = "lightgbm"
+	param_grid = {
+		'learning_rate': [0.05, 0.1],
+		'max_depth': [4, 6, 8],
+		'class_weight': ['balanced'],
+	}
+	params = {"objective": "binary", "seed": RANDOM_STATE, "verbose": -1}
+	n_estimators = 500
+	early_stopping_rounds = 20  # stop adding trees when the validation loss stops improving
+
+	def sample(self, rows: Optional[np.ndarray] = None):
+		# Subsets keep the bins of the training rows, so they are not binned again
+		rows = np.arange(self.n_rows) if rows is None else rows
+		return self.data.lightgbm_dataset("train").subset(rows).construct(), rows
+
+	def fit(self, params: dict, sample) -> lgb.Booster:
+		dataset, rows = sample
+		params = dict(params)
+		# Same per-row weights as the class_weight of LGBMClassifier, on top of the sampling weights
+		class_weight = params.pop("class_weight", None)
+		if class_weight is not None:
+			weights = self.data.weights("train")
+			dataset.set_weight(class_weights(
+				np.asarray(self.data.y("train")[rows]), class_weight, None if weights is None else weights[rows]
+			))
+		return lgb.train(
+			{**self.params, **params, "num_threads": self.n_jobs},
+			dataset,
+			num_boost_round=self.n_estimators,
+			valid_sets=[self.data.lightgbm_dataset("valid")],
+			callbacks=[lgb.early_stopping(self.early_stopping_rounds, verbose=False)],
+		)
+
+	def predict_proba(self, model, X: np.ndarray) -> np.ndarray:
+		return model.predict(X, num_threads=self.n_jobs)
+
+	def n_trees(self, model) -> int:
+		return model.best_iteration or model.num_trees()
+
+	def estimator(self, model) -> BoosterClassifier:
+		return BoosterClassifier(model)
+
+
+class XGBoostTrainer(Trainer):
+	model_type = "xgboost"
+	param_grid = {
+		'scale_pos_weight': [10, 20, 25],
+		'learning_rate': [0.05, 0.1],
+		'max_depth': [5, 7],
+	}
+	params = {"objective": "binary:logistic", "eval_metric": "logloss", "tree_method": "hist", "seed": RANDOM_STATE}
+	n_estimators = 500
+	early_stopping_rounds = 20  # stop adding trees when the validation loss stops improving
+
+	def sample(self, rows: Optional[np.ndarray] = None):
+		return self.data.xgboost_matrix("train", rows)
+
+	def fit(self, params: dict, sample) -> xgb.Booster:
+		booster = xgb.train(
+			{**self.params, **params, "nthread": self.n_jobs},
+			sample,
+			num_boost_round=self.n_estimators,
+			evals=[(self.data.xgboost_matrix("valid"), "valid")],
+			early_stopping_rounds=self.early_stopping_rounds,
+			verbose_eval=False,
+		)
+		# Keep the trees up to the best iteration only, as XGBClassifier predicts with
+		return booster[:booster.best_iteration + 1]
+
+	def predict_proba(self, model, X: np.ndarray) -> np.ndarray:
+		return model.inplace_predict(X)
+
+	def n_trees(self, model) -> int:
+		return model.num_boosted_rounds()
+
+	def estimator(self, model) -> BoosterClassifier:
+		return BoosterClassifier(model)
+
+
+TRAINERS = {trainer.model_type: trainer for trainer in (RandomForestTrainer, LightGBMTrainer, XGBoostTrainer)}
+
+
+def _train_family(data: TrainingData, model_type: str, n_jobs: int, time_budget_s: Optional[float]) -> str:
+	trainer = TRAINERS[model_type](data, n_jobs)
+	search = SuccessiveHalvingSearch(
+		trainer, trainer.param_grid, time_budget_s=time_budget_s, random_state=RANDOM_STATE
+	)
+	with stage(f"training.{model_type}.search", rows=trainer.n_rows):
+		model = search.fit()
+	print(f"Best Hyperparameters: {search.best_params_}")
+
+	print("Evaluating best model...")
+	y_test = data.y("test")
+	with stage(f"training.{model_type}.evaluate", rows=len(y_test)):
+		y_pred = trainer.predict_proba(model, data.X("test")) > 0.5
+	metrics = {
+		"f1": f1_score(y_test, y_pred),
+		"precision": precision_score(y_test, y_pred),
+		"recall": recall_score(y_test, y_pred),
+	}
+	print(f"F1 Score: {metrics['f1']:.4f}")
+	print(f"Precision: {metrics['precision']:.4f}")
+	print(f"Recall: {metrics['recall']:.4f}")
+
+	print("Saving model...")
+	models_dir = os.path.join(MODELS_PATH, model_type)
+	os.makedirs(models_dir, exist_ok=True)
+	timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+	save_path = os.path.join(models_dir, f"model_{timestamp}.pkl")
+	joblib.dump(trainer.estimator(model), save_path)
+	print(f"Model saved as {save_path}.")
+
+	artifact_path = os.path.join(models_dir, f"model_{timestamp}{ARTIFACT_EXTENSION}")
+	with stage(f"training.{model_type}.export"):
+		export_model(model, artifact_path, model_type=model_type, metadata={
+			"params": search.best_params_,
+			"tuning": {"seconds": search.elapsed_s_, "validation_f1": search.best_score_, "history": search.history_},
+			"metrics": metrics,
+			"n_train": trainer.n_rows,
+			"negative_rate": data.meta["settings"]["negative_rate"],
+			"n_valid": len(data.y("valid")),
+			"n_test": len(y_test),
+		})
+	print(f"Model artifact exported as {artifact_path}.")
+	return artifact_path
+
+
+def train_models(
+		model_types: List[str],
+		columns: Optional[List[str]] = None,
+		negative_rate: float = NEGATIVE_SAMPLE_RATE,
+		refresh: bool = False,
+		n_jobs: Optional[int] = TUNING_N_JOBS,
+		time_budget_s: Optional[float] = TUNING_TIME_BUDGET_S
+) -> Dict[str, str]:
+	"""
+	Tunes, evaluates and exports models of several families from one cached training split.
+
+	Args:
+		model_types (List[str]): Families to train: "random_forest", "lightgbm" and / or "xgboost".
+		columns (Optional[List[str]]): Features to train on. If None, use all features.
+		negative_rate (float): Fraction of the negatives of every training user to keep, 1 to keep all rows.
+		refresh (bool): Rebuild the cached split even if it is up to date.
+		n_jobs (Optional[int]): Threads of every model. Models are trained one at a time and every other thread
+			pool is capped to the same size, so the cores are not oversubscribed. -1 to use all cores.
+		time_budget_s (Optional[float]): Wall-clock budget of the search of every family. None for no limit.
+
+	Returns:
+		Dict[str, str]: Path of the exported artifact of every family.
+	"""
+	unknown = [model_type for model_type in model_types if model_type not in TRAINERS]
+	if unknown:
+		raise KeyError(f"Unknown model types: {unknown}. Known model types: {list(TRAINERS)}")
+
+	n_jobs = (os.cpu_count() or 1) if n_jobs in (None, -1) else n_jobs
+	data = prepare_training_data(columns, negative_rate=negative_rate, refresh=refresh)
+
+	artifacts = {}
+	with threadpool_limits(limits=n_jobs):
+		for model_type in model_types:
+			print(f"Training {model_type}...")
+			artifacts[model_type] = _train_family(data, model_type, n_jobs, time_budget_s)
+	return artifacts
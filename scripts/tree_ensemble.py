@@ -0,0 +1,417 @@
+"""
+Library-independent representation of the tree ensembles trained by the scripts/train_*.py scripts.
+
+The trees of a RandomForest, LightGBM or XGBoost classifier are flattened into node arrays. Every internal node
+splits on one feature against a threshold, with a default direction for missing values, and every leaf holds
+a value. The prediction is the mean of the leaf values (RandomForest) or the sigmoid of their sum (boosting).
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from scripts.boosters import BoosterClassifier, is_lightgbm
+
+# How internal nodes compare a feature value x with their threshold to go to the left child
+DECISIONS = ("le", "lt")  # x <= threshold (sklearn, LightGBM), x < threshold (XGBoost)
+
+# Missing value handling of a node
+MISSING_AS_ZERO = 0  # NaN is compared as 0
+MISSING_DEFAULT = 1  # NaN goes to the default child
+ZERO_DEFAULT = 2  # NaN and 0 go to the default child (LightGBM zero_as_missing)
+# LightGBM treats values within this distance of 0 as 0 (kZeroThreshold)
+ZERO_THRESHOLD = np.float32(1e-35)
+
+NODE_ARRAYS = ("feature", "threshold", "left", "right", "value", "default_left", "missing")
+
+# (row, tree) pairs evaluated together: the node ids of a block stay in cache while it walks down the trees
+BLOCK_PAIRS = 1 << 16
+
+# Largest difference between the probabilities of an ensemble and of the model it was flattened from
+PARITY_TOLERANCE = 1e-5
+
+# Models that compile_model flattens, by class name and by model type. The native predictors of the LightGBM and
+# XGBoost boosters are faster than the flattened trees at every batch size (see the 'engines' benchmark stage), so
+# they keep them. Random forests are flattened: skipping the DataFrame input of scikit-learn makes single-user batches
+# several times faster, for a slower scoring of large batches.
+FLATTENED_MODELS = ("RandomForestClassifier",)
+FLATTENED_MODEL_TYPES = ("random_forest",)
+
+
+class TreeEnsemble:
+	"""
+	Flattened tree ensemble with a `predict_proba` compatible with the scikit-learn classifiers.
+
+	Node arrays are indexed by global node id, trees are [tree_offsets[t], tree_offsets[t + 1]) ranges of node ids
+	with their root first, and leaves point to themselves. Rows are evaluated in blocks of float32 features,
+	all trees at once, with the blocks spread over a thread pool.
+	"""
+
+	def __init__(
+			self,
+			feature: np.ndarray,
+			threshold: np.ndarray,
+			left: np.ndarray,
+			right: np.ndarray,
+			value: np.ndarray,
+			default_left: np.ndarray,
+			missing: np.ndarray,
+			tree_offsets: np.ndarray,
+			feature_names: List[str],
+			decision: str,
+			aggregation: str,
+			base_score: float = 0.0,
+			sigmoid_scale: float = 1.0,
+			max_depth: Optional[int] = None,
+			model_type: Optional[str] = None,
+			n_jobs: Optional[int] = None,
+	):
+		if decision not in DECISIONS:
+			raise ValueError(f"Unknown decision '{decision}'. Supported: {DECISIONS}")
+		if aggregation not in ("mean", "logistic"):
+			raise ValueError(f"Unknown aggregation '{aggregation}'. Supported: 'mean', 'logistic'")
+
+		self.feature = feature
+		self.threshold = threshold
+		self.left = left
+		self.right = right
+		self.value = value
+		self.default_left = default_left
+		self.missing = missing
+		self.tree_offsets = tree_offsets
+		self.feature_names_in_ = np.array(feature_names, dtype=object)
+		self.n_features_in_ = len(feature_names)
+		self.classes_ = np.array([0, 1])
+		self.decision = decision
+		self.aggregation = aggregation
+		self.base_score = base_score
+		self.sigmoid_scale = sigmoid_scale
+		self.max_depth = _max_depth(left, right, tree_offsets) if max_depth is None else max_depth
+		self.model_type = model_type
+
+		self.n_jobs = n_jobs
+		self._executor: Optional[ThreadPoolExecutor] = None
+		self._executor_pid: Optional[int] = None
+
+		# Evaluation arrays: every decision becomes x <= t on float32 values, and the children of node i
+		# are at 2i (right) and 2i + 1 (left), so the next node is one gather indexed by the decision
+		self._is_leaf = feature < 0
+		self._split_feature = np.maximum(feature, 0).astype(np.intp)
+		self._threshold32 = _float32_thresholds(threshold, decision)
+		self._children = np.column_stack([right, left]).astype(np.intp).ravel()
+		self._roots = np.asarray(tree_offsets[:-1], dtype=np.intp)
+		self._zero_default = bool((missing == ZERO_DEFAULT).any())
+
+	@property
+	def n_trees(self) -> int:
+		return len(self.tree_offsets) - 1
+
+	def arrays(self) -> Dict[str, np.ndarray]:
+		return {name: getattr(self, name) for name in NODE_ARRAYS + ("tree_offsets",)}
+
+	def params(self) -> dict:
+		return {
+			"feature_names": list(self.feature_names_in_),
+			"decision": self.decision,
+			"aggregation": self.aggregation,
+			"base_score": self.base_score,
+			"sigmoid_scale": self.sigmoid_scale,
+			"max_depth": self.max_depth,
+		}
+
+	def get_params(self, deep: bool = True) -> dict:
+		return {"n_jobs": self.n_jobs}
+
+	def set_params(self, **params) -> "TreeEnsemble":
+		for name, value in params.items():
+			if name != "n_jobs":
+				raise ValueError(f"Unknown parameter '{name}'.")
+			self.n_jobs = value
+		return self
+
+	def _features(self, X) -> np.ndarray:
+		if isinstance(X, pd.DataFrame):
+			if list(X.columns) != list(self.feature_names_in_):
+				X = X[list(self.feature_names_in_)]
+			X = X.to_numpy(dtype=np.float32)
+		X = np.ascontiguousarray(X, dtype=np.float32)
+		if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+			raise ValueError(f"Expected a matrix with {self.n_features_in_} features, got shape {X.shape}.")
+		return X
+
+	def _leaves_block(self, X: np.ndarray) -> np.ndarray:
+		"""
+		Walks a block of rows down all trees at once, one level per step.
+		(row, tree) pairs that reached a leaf are dropped once they are a sizeable part of the active ones,
+		so deep, unbalanced trees do not keep the whole block busy until their deepest leaf.
+		"""
+		n_rows, n_trees = len(X), self.n_trees
+		flat = X.ravel()
+		leaves = np.empty(n_rows * n_trees, dtype=np.intp)
+		positions = np.arange(n_rows * n_trees)
+		nodes = np.tile(self._roots, n_rows)
+		row_starts = np.repeat(np.arange(n_rows, dtype=np.intp) * X.shape[1], n_trees)
+		check_missing = self._zero_default or bool(np.isnan(flat).any())
+
+		while len(nodes):
+			# Leaves split on feature 0 and have themselves as both children, so pairs that reached them stay there
+			x = flat[row_starts + self._split_feature[nodes]]
+			go_left = x <= self._threshold32[nodes]
+
+			if check_missing:
+				missing = self.missing[nodes]
+				is_nan = np.isnan(x)
+				as_zero = is_nan & (missing == MISSING_AS_ZERO)
+				go_left[as_zero] = 0 <= self._threshold32[nodes[as_zero]]
+				use_default = (is_nan & (missing != MISSING_AS_ZERO)) | (
+					(np.abs(x) <= ZERO_THRESHOLD) & (missing == ZERO_DEFAULT)
+				)
+				go_left[use_default] = self.default_left[nodes[use_default]]
+
+			nodes = self._children[2 * nodes + go_left]
+			done = self._is_leaf[nodes]
+			if 4 * np.count_nonzero(done) >= len(nodes):
+				leaves[positions[done]] = nodes[done]
+				active = ~done
+				nodes, row_starts, positions = nodes[active], row_starts[active], positions[active]
+
+		return leaves.reshape(n_rows, n_trees)
+
+	def _scores_block(self, X: np.ndarray) -> np.ndarray:
+		leaf_values = self.value[self._leaves_block(X)]
+		if self.aggregation == "mean":
+			return leaf_values.mean(axis=1)
+		return self.base_score + leaf_values.sum(axis=1)
+
+	def _map_blocks(self, func, X: np.ndarray) -> List[np.ndarray]:
+		block_rows = max(1, BLOCK_PAIRS // max(1, self.n_trees))
+		starts = range(0, len(X), block_rows)
+		n_jobs = (os.cpu_count() or 1) if self.n_jobs in (None, -1) else self.n_jobs
+		if n_jobs <= 1 or len(starts) <= 1:
+			return [func(X[start:start + block_rows]) for start in starts]
+
+		# numpy releases the GIL in the gathers and comparisons, so blocks are evaluated by threads.
+		# The pool is recreated in forked processes, where the threads of the parent do not exist.
+		if self._executor is None or self._executor_pid != os.getpid():
+			self._executor = ThreadPoolExecutor(max_workers=n_jobs)
+			self._executor_pid = os.getpid()
+		return list(self._executor.map(lambda start: func(X[start:start + block_rows]), starts))
+
+	def leaves(self, X) -> np.ndarray:
+		"""
+		Finds the leaf of every row in every tree.
+
+		Returns:
+			np.ndarray: (rows, trees) global ids of the leaves.
+		"""
+		X = self._features(X)
+		if not len(X):
+			return np.empty((0, self.n_trees), dtype=self._children.dtype)
+		return np.concatenate(self._map_blocks(self._leaves_block, X))
+
+	def decision_function(self, X) -> np.ndarray:
+		"""
+		Raw score of every row: the mean leaf value, or the margin (base score plus the sum of leaf values).
+		"""
+		X = self._features(X)
+		if not len(X):
+			return np.empty(0)
+		return np.concatenate(self._map_blocks(self._scores_block, X))
+
+	def predict_proba(self, X) -> np.ndarray:
+		scores = self.decision_function(X)
+		if self.aggregation == "logistic":
+			scores = 1 / (1 + np.exp(-self.sigmoid_scale * scores))
+		return np.column_stack([1 - scores, scores])
+
+	def predict(self, X) -> np.ndarray:
+		return (self.predict_proba(X)[:, 1] > 0.5).astype(np.int64)
+
+	@classmethod
+	def from_model(cls, model) -> "TreeEnsemble":
+		"""
+		Flattens a fitted RandomForestClassifier, LGBMClassifier, XGBClassifier or LightGBM / XGBoost Booster,
+		possibly inside a BoosterClassifier.
+		"""
+		kind = type(model).__name__
+		if kind not in SUPPORTED_MODELS:
+			raise TypeError(f"Unsupported model type: {kind}")
+		return SUPPORTED_MODELS[kind](model)
+
+
+def _float32_thresholds(threshold: np.ndarray, decision: str) -> np.ndarray:
+	"""
+	Converts thresholds to float32 ones that give the same decisions for float32 values x as `x <= t32`:
+	the largest float32 <= t for "le", and the largest float32 < t for "lt".
+	"""
+	with np.errstate(over="ignore"):
+		threshold32 = np.asarray(threshold).astype(np.float32)
+	above = threshold32.astype(np.float64) > threshold if decision == "le" else threshold32 >= threshold
+	threshold32[above] = np.nextafter(threshold32[above], np.float32(-np.inf))
+	return threshold32
+
+
+def compile_model(model):
+	"""
+	Prepares a loaded model for scoring: the FLATTENED_MODELS are flattened into a TreeEnsemble, and native
+	LightGBM / XGBoost Boosters of old pickles are wrapped in a BoosterClassifier.
+	Other models are returned as they are.
+	"""
+	kind = type(model).__name__
+	if kind == "Booster":
+		return BoosterClassifier(model)
+	if kind in FLATTENED_MODELS:
+		return TreeEnsemble.from_model(model)
+	return model
+
+
+def _max_depth(left: np.ndarray, right: np.ndarray, tree_offsets: np.ndarray) -> int:
+	# Walk all trees level by level from their roots until every node is a leaf
+	nodes = np.asarray(tree_offsets[:-1], dtype=np.int64)
+	depth = 0
+	while len(nodes):
+		internal = nodes[left[nodes] != nodes]
+		if not len(internal):
+			break
+		nodes = np.concatenate([left[internal], right[internal]])
+		depth += 1
+	return depth
+
+
+def _concat_trees(trees: List[Dict[str, np.ndarray]], **params) -> TreeEnsemble:
+	"""
+	Builds an ensemble from per-tree node arrays with local child ids (-1 for leaves).
+	"""
+	sizes = np.array([len(tree["feature"]) for tree in trees], dtype=np.int64)
+	tree_offsets = np.zeros(len(trees) + 1, dtype=np.int64)
+	np.cumsum(sizes, out=tree_offsets[1:])
+
+	arrays = {name: np.concatenate([tree[name] for tree in trees]) for name in ("left", "right", "feature")}
+	node_ids = np.arange(tree_offsets[-1])
+	shift = np.repeat(tree_offsets[:-1], sizes)
+	is_leaf = arrays["left"] < 0
+
+	return TreeEnsemble(
+		feature=np.where(is_leaf, -1, arrays["feature"]).astype(np.int32),
+		threshold=np.concatenate([tree["threshold"] for tree in trees]).astype(np.float64),
+		left=np.where(is_leaf, node_ids, arrays["left"] + shift).astype(np.int32),
+		right=np.where(is_leaf, node_ids, arrays["right"] + shift).astype(np.int32),
+		value=np.where(is_leaf, np.concatenate([tree["value"] for tree in trees]), 0).astype(np.float64),
+		default_left=np.concatenate([tree["default_left"] for tree in trees]).astype(bool),
+		missing=np.concatenate([tree["missing"] for tree in trees]).astype(np.uint8),
+		tree_offsets=tree_offsets,
+		**params
+	)
+
+
+def _from_random_forest(model) -> TreeEnsemble:
+	positive = int(np.flatnonzero(model.classes_ == 1)[0]) if 1 in model.classes_ else len(model.classes_) - 1
+	trees = []
+	for estimator in model.estimators_:
+		tree = estimator.tree_
+		value = tree.value[:, 0, :]
+		trees.append({
+			"feature": tree.feature,
+			"threshold": tree.threshold,
+			"left": tree.children_left,
+			"right": tree.children_right,
+			"value": value[:, positive] / value.sum(axis=1),
+			"default_left": getattr(tree, "missing_go_to_left", np.zeros(tree.node_count, dtype=np.uint8)),
+			"missing": np.full(tree.node_count, MISSING_DEFAULT),
+		})
+	return _concat_trees(trees, feature_names=list(model.feature_names_in_), decision="le", aggregation="mean")
+
+
+def _from_lightgbm(model) -> TreeEnsemble:
+	dump = getattr(model, "booster_", model).dump_model()
+	missing_types = {"None": MISSING_AS_ZERO, "NaN": MISSING_DEFAULT, "Zero": ZERO_DEFAULT}
+
+	trees = []
+	for info in dump["tree_info"]:
+		# Number the nodes in breadth-first order, so the root comes first
+		nodes = [info["tree_structure"]]
+		columns = {name: [] for name in ("feature", "threshold", "left", "right", "value", "default_left", "missing")}
+		i = 0
+		while i < len(nodes):
+			node = nodes[i]
+			if "leaf_value" in node:
+				for name, default in (("feature", -1), ("threshold", 0), ("left", -1), ("right", -1)):
+					columns[name].append(default)
+				columns["value"].append(node["leaf_value"])
+				columns["default_left"].append(False)
+				columns["missing"].append(MISSING_AS_ZERO)
+			else:
+				if node["decision_type"] != "<=":
+					raise ValueError(f"Unsupported LightGBM split: {node['decision_type']}")
+				columns["feature"].append(node["split_feature"])
+				columns["threshold"].append(node["threshold"])
+				columns["left"].append(len(nodes))
+				columns["right"].append(len(nodes) + 1)
+				columns["value"].append(0)
+				columns["default_left"].append(node["default_left"])
+				columns["missing"].append(missing_types[node["missing_type"]])
+				nodes.extend([node["left_child"], node["right_child"]])
+			i += 1
+		trees.append({name: np.array(values) for name, values in columns.items()})
+
+	objective = dump.get("objective", "binary sigmoid:1").split()
+	sigmoid_scale = next((float(part.split(":")[1]) for part in objective if part.startswith("sigmoid:")), 1.0)
+	return _concat_trees(
+		trees, feature_names=dump["feature_names"], decision="le", aggregation="logistic", sigmoid_scale=sigmoid_scale
+	)
+
+
+def _from_xgboost(model) -> TreeEnsemble:
+	booster = model.get_booster() if hasattr(model, "get_booster") else model
+	learner = json.loads(booster.save_raw("json"))["learner"]
+	if learner["objective"]["name"] != "binary:logistic":
+		raise ValueError(f"Unsupported XGBoost objective: {learner['objective']['name']}")
+
+	trees_json = learner["gradient_booster"]["model"]["trees"]
+	try:
+		# Predictions of a model trained with early stopping only use the trees up to the best iteration
+		trees_json = trees_json[:model.best_iteration + 1]
+	except AttributeError:
+		pass
+
+	trees = []
+	for tree in trees_json:
+		left = np.array(tree["left_children"])
+		is_leaf = left < 0
+		split_conditions = np.array(tree["split_conditions"], dtype=np.float32)
+		trees.append({
+			"feature": np.array(tree["split_indices"]),
+			"threshold": np.where(is_leaf, 0, split_conditions),
+			"left": left,
+			"right": np.array(tree["right_children"]),
+			"value": np.where(is_leaf, split_conditions, 0),
+			"default_left": np.array(tree["default_left"], dtype=bool),
+			"missing": np.full(len(left), MISSING_DEFAULT),
+		})
+
+	base_score = float(learner["learner_model_param"]["base_score"].strip("[]"))
+	return _concat_trees(
+		trees,
+		feature_names=list(booster.feature_names or getattr(model, "feature_names_in_", [])),
+		decision="lt",
+		aggregation="logistic",
+		base_score=float(np.log(base_score / (1 - base_score))),
+	)
+
+
+def _from_booster(model) -> TreeEnsemble:
+	if is_lightgbm(model):
+		return _from_lightgbm(model)
+	return _from_xgboost(model)
+
+
+SUPPORTED_MODELS = {
+	"RandomForestClassifier": _from_random_forest,
+	"LGBMClassifier": _from_lightgbm,
+	"XGBClassifier": _from_xgboost,
+	"Booster": _from_booster,
+	"BoosterClassifier": lambda model: _from_booster(model.booster_),
+}
@@ -0,0 +1,150 @@
+"""
+Budgeted hyperparameter tuning with successive halving.
+
+All configurations of a grid are first trained on a small sample of the training rows. Only the best 1/factor of them
+move on to the next rung, which trains on factor times more rows, until the last rung trains on all of them.
+Boosting models stop adding trees when the validation rows stop improving, so the tree count is tuned by
+early stopping instead of being a grid dimension. A wall-clock budget cuts the search short if needed.
+"""
+import math
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sklearn.metrics import f1_score
+from sklearn.model_selection import ParameterGrid
+
+from scripts.instrumentation import stage
+
+
+class SuccessiveHalvingSearch:
+	"""
+	Successive halving over a parameter grid, scored by the F1 score on the validation rows.
+
+	Attributes set by `fit`:
+		best_estimator_: The best model of the last rung, trained on all training rows.
+		best_params_ (dict): Its parameters.
+		best_score_ (float): Its validation F1 score.
+		history_ (List[dict]): One record per trained configuration: rung, rows, params, score, trees and seconds.
+	"""
+
+	def __init__(
+			self,
+			trainer,
+			param_grid: Dict[str, list],
+			factor: int = 3,
+			min_rows: int = 20_000,
+			time_budget_s: Optional[float] = None,
+			random_state: int = 42,
+			verbose: bool = True,
+	):
+		"""
+		Args:
+			trainer (scripts.training.Trainer): Trains the models of one family on the cached training rows,
+				with early stopping on the validation rows for boosting models.
+			param_grid (Dict[str, list]): Values of the tuned parameters.
+			factor (int): Only the best 1/factor configurations of a rung move on, with factor times more rows.
+			min_rows (int): Smallest number of rows a configuration is trained on.
+			time_budget_s (Optional[float]): Wall-clock budget. Once spent, the current rung stops and the best
+				configuration scored so far goes straight to the last rung. None for no limit.
+			random_state (int): Seed of the row samples.
+			verbose (bool): Print the progress.
+		"""
+		self.trainer = trainer
+		self.param_grid = param_grid
+		self.factor = factor
+		self.min_rows = min_rows
+		self.time_budget_s = time_budget_s
+		self.random_state = random_state
+		self.verbose = verbose
+
+	def _rungs(self, n_rows: int, n_candidates: int) -> List[Tuple[int, int]]:
+		"""
+		Rows of every rung, and how many times the configurations are cut down to 1/factor after it.
+		Consecutive rungs that `min_rows` clamps to the same rows are merged, with all their cuts: training the same
+		configurations on the same rows again would only repeat the same ranking.
+		"""
+		# Enough rungs to get down to one configuration, with the last rung on all rows
+		n_rungs = max(1, math.ceil(math.log(n_candidates, self.factor)) + 1) if n_candidates > 1 else 1
+		rungs = []
+		for rung in range(n_rungs):
+			rows = min(n_rows, max(self.min_rows, n_rows // self.factor ** (n_rungs - 1 - rung)))
+			if rungs and rungs[-1][0] == rows:
+				rungs[-1] = (rows, rungs[-1][1] + 1)
+			else:
+				rungs.append((rows, 1))
+		return rungs
+
+	def _over_budget(self, start: float) -> bool:
+		return self.time_budget_s is not None and time.perf_counter() - start > self.time_budget_s
+
+	def fit(self):
+		"""
+		Runs the search.
+
+		Returns:
+			The best model, trained on all training rows.
+		"""
+		start = time.perf_counter()
+		trainer = self.trainer
+		X_valid, y_valid = trainer.data.X("valid"), trainer.data.y("valid")
+
+		# Rungs train on growing prefixes of one shuffled order, so every sample contains the previous ones
+		n_train = trainer.n_rows
+		order = np.random.default_rng(self.random_state).permutation(n_train)
+
+		candidates = list(ParameterGrid(self.param_grid))
+		rungs = self._rungs(n_train, len(candidates))
+		last_rung = len(rungs) - 1
+		self.history_ = []
+
+		rung = 0
+		while True:
+			n_rows, cuts = rungs[rung]
+			if self.verbose:
+				print(f"Rung {rung}: {len(candidates)} configurations on {n_rows} rows...")
+			# The rows are prepared once for all configurations of the rung
+			sample = trainer.sample(None if n_rows == n_train else np.sort(order[:n_rows]))
+
+			results = []
+			for params in candidates:
+				# Stop the rung once the budget is spent, as long as there is a configuration to promote:
+				# the candidates of a later rung are ordered by their previous score, so the first one will do
+				if self._over_budget(start) and (results or 0 < rung < last_rung):
+					break
+				fit_start = time.perf_counter()
+				with stage("tuning.fit", rows=n_rows) as record:
+					record.set(trainer=type(trainer).__name__, rung=rung)
+					model = trainer.fit(params, sample)
+				score = f1_score(y_valid, trainer.predict_proba(model, X_valid) > 0.5)
+				results.append((score, model, params))
+				self.history_.append({
+					"rung": rung,
+					"rows": n_rows,
+					"params": params,
+					"score": score,
+					"trees": trainer.n_trees(model),
+					"seconds": time.perf_counter() - fit_start,
+				})
+				if self.verbose:
+					print(f"  {params}: F1 {score:.4f}, {trainer.n_trees(model)} trees")
+
+			results.sort(key=lambda result: -result[0])
+			if rung == last_rung:
+				break
+
+			if self._over_budget(start):
+				if self.verbose:
+					print("Time budget spent, training the best configuration on all rows...")
+				candidates = [results[0][2] if results else candidates[0]]
+				rung = last_rung
+			else:
+				n_kept = len(candidates)
+				for _ in range(cuts):
+					n_kept = max(1, math.ceil(n_kept / self.factor))
+				candidates = [params for _, _, params in results[:n_kept]]
+				rung += 1
+
+		self.best_score_, self.best_estimator_, self.best_params_ = results[0]
+		self.elapsed_s_ = time.perf_counter() - start
+		return self.best_estimator_
@@ -1,15 +1,67 @@
 import os
-from typing import List, Union, Optional
+from typing import Dict, List, Optional, Tuple, Union
 
 import joblib
+import numpy as np
 import pandas as pd
 
-from config import MODELS_PATH, FEATURES_PATH, RAW_DATA_PATH
+from config import MODELS_PATH, FEATURES_PATH
+from scripts.feature_store import GRAIN_KEYS, feature_grain, read_arrays, read_table, store_exists
+from scripts.instrumentation import timed
+from scripts.model_artifact import ARTIFACT_EXTENSION, load_artifact
+from scripts.raw_data import load_raw
+from scripts.tree_ensemble import FLATTENED_MODEL_TYPES
+
+
+def load_model_file(model_path: str):
+	"""
+	Loads a model file: a model artifact, memory-mapped, or a joblib pickle.
+
+	Args:
+		model_path (str): Path to a 'model_*.trees' artifact or a 'model_*.pkl' pickle.
+
+	Returns:
+		Loaded model object.
+	"""
+	if model_path.endswith(ARTIFACT_EXTENSION):
+		return load_artifact(model_path)
+	return joblib.load(model_path)
+
+
+def model_files(model_type: str = "lightgbm", models_path: str = MODELS_PATH) -> List[str]:
+	"""
+	Lists the model files of a model type, oldest first. The files are ordered by the timestamp in their name. Within a
+	training run, the file that scores faster sorts last: the model artifact ('model_*.trees') for FLATTENED_MODEL_TYPES,
+	the pickle ('model_*.pkl') for the others, whose native predictor is faster.
+
+	Args:
+		model_type (str): Supported model types: "random_forest", "lightgbm", "xgboost". Defaults to "lightgbm".
+		models_path (str): Directory with one subdirectory of models per type.
+
+	Returns:
+		List[str]: Paths of the model files.
+	"""
+	models_dir = os.path.join(models_path, model_type)
+	if not os.path.isdir(models_dir):
+		return []
+
+	if model_type in FLATTENED_MODEL_TYPES:
+		extensions = {".pkl": 0, ARTIFACT_EXTENSION: 1}
+	else:
+		extensions = {ARTIFACT_EXTENSION: 0, ".pkl": 1}
+	files = [
+		(f[len("model_"):-len(ext)], extensions[ext], f)
+		for f in os.listdir(models_dir)
+		for ext in extensions
+		if f.startswith("model_") and f.endswith(ext)
+	]
+	return [os.path.join(models_dir, f) for _, _, f in sorted(files)]
 
 
 def load_model(model_name: Optional[str] = None, model_type: str = "lightgbm"):
 	"""
 	Load a model from MODELS_PATH. If model_name is None, load the latest model.
+	Of the files of the same training run, the one that scores faster is loaded, see `model_files`.
 
 	Args:
 		model_name (Optional[str]): Name of the model file to load. If None, load the latest model.
@@ -19,43 +71,46 @@ def load_model(model_name: Optional[str] = None, model_type: str = "lightgbm"):
 		Loaded model object.
 	"""
 
-	models_dir = os.path.join(MODELS_PATH, model_type)
-
 	if model_name:
 		# Load the specified model
-		model_path = os.path.join(models_dir, model_name)
+		model_path = os.path.join(MODELS_PATH, model_type, model_name)
 	else:
-		# Get all model files in the directory
-		model_files = [
-			f.replace("model_", "").replace(".pkl", "")
-			for f in os.listdir(models_dir)
-			if f.startswith("model_") and f.endswith(".pkl")
-		]
-
-		if not model_files:
+		files = model_files(model_type)
+		if not files:
 			raise FileNotFoundError("No models found in the specified directory.")
 
 		# Pick the latest model
-		model_path = os.path.join(models_dir, f"model_{sorted(model_files)[-1]}.pkl")
+		model_path = files[-1]
 
 	# Load the model
-	return joblib.load(model_path)
+	return load_model_file(model_path)
 
 
-def load_features_with_prefix(prefix: str, merge_on: Union[List[str], str]) -> pd.DataFrame:
+def load_features_with_prefix(
+		prefix: str,
+		merge_on: Union[List[str], str],
+		columns: Optional[List[str]] = None
+) -> pd.DataFrame:
 	"""
-	Loads and merges all feature files with a given prefix.
+	Loads and merges all features with a given prefix.
+	Features are read from the feature store if it exists, otherwise from the per-feature CSV files.
 
 	Parameters:
 		prefix (str): The prefix of the files to load (e.g., 'up', 'u', 'p').
 		merge_on (Union[List[str], str]): The column(s) to merge on.
+		columns (Optional[List[str]]): Features to load. If None, load all features with the prefix.
 
 	Returns:
 		pd.DataFrame: A merged DataFrame for the given prefix.
 	"""
+	if store_exists():
+		return read_table(prefix.rstrip('_'), columns=columns)
+
 	merged_df = None
 	for file in os.listdir(FEATURES_PATH):
 		if file.startswith(prefix) and file.endswith('.csv'):
+			if columns is not None and file[:-len('.csv')] not in columns:
+				continue
 			file_path = os.path.join(FEATURES_PATH, file)
 			feature_df = pd.read_csv(file_path)
 
@@ -67,19 +122,28 @@ def load_features_with_prefix(prefix: str, merge_on: Union[List[str], str]) -> p
 	return merged_df
 
 
-def load_features() -> pd.DataFrame:
+@timed("load_features", count_rows=True)
+def load_features(columns: Optional[List[str]] = None) -> pd.DataFrame:
 	"""
 	Loads and merges all features (user-product, user, and product) into a single DataFrame.
 
+	Args:
+		columns (Optional[List[str]]): Features to load. If None, load all features.
+
 	Returns:
 		pd.DataFrame: A merged DataFrame containing all features.
 	"""
+	def grain_columns(grain: str) -> Optional[List[str]]:
+		if columns is None:
+			return None
+		return [name for name in columns if feature_grain(name) == grain]
+
 	# Load user-product features
-	up_features = load_features_with_prefix('up_', merge_on=['user_id', 'product_id'])
+	up_features = load_features_with_prefix('up_', merge_on=['user_id', 'product_id'], columns=grain_columns('up'))
 	# Load user features
-	u_features = load_features_with_prefix('u_', merge_on='user_id')
+	u_features = load_features_with_prefix('u_', merge_on='user_id', columns=grain_columns('u'))
 	# Load product features
-	p_features = load_features_with_prefix('p_', merge_on='product_id')
+	p_features = load_features_with_prefix('p_', merge_on='product_id', columns=grain_columns('p'))
 
 	# Merge user and product features into user-product features
 	features = up_features.merge(
@@ -93,24 +157,122 @@ def load_features() -> pd.DataFrame:
 	return features
 
 
-def load_train_dataset() -> pd.DataFrame:
-	orders = pd.read_csv(os.path.join(RAW_DATA_PATH, 'orders.csv'))
-	order_products_train = pd.read_csv(os.path.join(RAW_DATA_PATH, 'order_products__train.csv'))
+def _grain_arrays(grain: str, columns: Optional[List[str]] = None) -> Tuple[Dict[str, np.ndarray], List[str]]:
+	"""
+	Opens the key and feature columns of a grain as arrays, memory-mapped from the feature store if it exists.
 
-	df = load_features()
+	Returns:
+		Tuple[Dict[str, np.ndarray], List[str]]: Arrays by column name and the names of the feature columns.
+	"""
+	keys = GRAIN_KEYS[grain]
+	if store_exists():
+		arrays = read_arrays(grain, columns=columns)
+	else:
+		df = load_features_with_prefix(f'{grain}_', merge_on=keys, columns=columns or None)
+		arrays = {c: df[c].to_numpy() for c in df.columns}
+
+	names = [c for c in arrays if c not in keys] if columns is None else list(columns)
+	return {c: arrays[c] for c in keys + names}, names
+
+
+def _gather_into(out: np.ndarray, ids: np.ndarray, values: np.ndarray, size: int, row_ids: np.ndarray) -> None:
+	"""
+	Writes the values of per-id features at `row_ids` into `out`, with 0 for ids without a value.
+	"""
+	dense = np.zeros(size, dtype=np.float32)
+	dense[ids] = values
+	np.take(dense, row_ids, out=out, mode='clip')
+
+
+def build_train_matrix(
+		columns: Optional[List[str]] = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, List[str]]:
+	"""
+	Assembles the training matrix straight from the feature columns, without DataFrame merges.
+	User and product features are gathered from dense arrays addressed by id, and the labels are joined
+	on sorted (user_id, product_id) keys. Every user-product pair is a row; pairs that are not in the user's
+	train order, including all pairs of test users, get label 0.
+
+	Args:
+		columns (Optional[List[str]]): Features to load. If None, load all features.
+
+	Returns:
+		Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, List[str]]: User id and product id of every row,
+		the float32 feature matrix (column-major, missing values as 0), the uint8 'reordered' labels,
+		and the feature names in column order.
+	"""
+	def grain_columns(grain: str) -> Optional[List[str]]:
+		if columns is None:
+			return None
+		return [name for name in columns if feature_grain(name) == grain]
+
+	up, up_names = _grain_arrays('up', grain_columns('up'))
+	u, u_names = _grain_arrays('u', grain_columns('u'))
+	p, p_names = _grain_arrays('p', grain_columns('p'))
+
+	user_ids = np.asarray(up['user_id'], dtype=np.uint32)
+	product_ids = np.asarray(up['product_id'], dtype=np.uint32)
+	n_users = int(max(user_ids.max(initial=0), np.max(u['user_id'], initial=0))) + 1
+	n_products = int(max(product_ids.max(initial=0), np.max(p['product_id'], initial=0))) + 1
+
+	# Column-major, so every feature is written contiguously and the DataFrame built on top of it needs no copy
+	feature_names = up_names + u_names + p_names
+	X = np.empty((len(user_ids), len(feature_names)), dtype=np.float32, order='F')
+	for j, name in enumerate(up_names):
+		X[:, j] = up[name]
+	for j, name in enumerate(u_names, start=len(up_names)):
+		_gather_into(X[:, j], u['user_id'], u[name], n_users, user_ids)
+	for j, name in enumerate(p_names, start=len(up_names) + len(u_names)):
+		_gather_into(X[:, j], p['product_id'], p[name], n_products, product_ids)
+	for j in range(X.shape[1]):
+		column = X[:, j]
+		column[np.isnan(column)] = 0
 
-	df = df.merge(
-		orders[orders.eval_set == 'train'][['user_id', 'order_id']],
-		on='user_id',
-		how='left'
+	# Label of every pair: look up its (user, product) key among the sorted keys of the train order products
+	orders = load_raw('orders', columns=['order_id', 'user_id', 'eval_set'])
+	orders = orders[orders.eval_set == 'train']
+	train_orders = orders.order_id.to_numpy()
+	order_users = np.zeros(int(train_orders.max(initial=0)) + 1, dtype=np.uint64)
+	order_users[train_orders] = orders.user_id.to_numpy()
+
+	order_products_train = load_raw('order_products__train', columns=['order_id', 'product_id', 'reordered'])
+	train_order_ids = order_products_train.order_id.to_numpy()
+	in_train_order = train_order_ids < len(order_users)
+	train_keys = (
+			(order_users[train_order_ids[in_train_order]] << np.uint64(32))
+			| order_products_train.product_id.to_numpy()[in_train_order]
 	)
+	train_labels = order_products_train.reordered.to_numpy(np.uint8)[in_train_order]
+	order = np.argsort(train_keys)
+	train_keys, train_labels = train_keys[order], train_labels[order]
+
+	keys = (user_ids.astype(np.uint64) << np.uint64(32)) | product_ids
+	positions = np.minimum(np.searchsorted(train_keys, keys), max(len(train_keys) - 1, 0))
+	y = np.zeros(len(keys), dtype=np.uint8)
+	if len(train_keys):
+		found = train_keys[positions] == keys
+		y[found] = train_labels[positions[found]]
+
+	return user_ids, product_ids, X, y, feature_names
 
-	df = df.merge(
-		order_products_train[['product_id', 'order_id', 'reordered']],
-		on=['product_id', 'order_id'],
-		how='left'
+
+@timed("load_train_dataset", count_rows=True)
+def load_train_dataset(columns: Optional[List[str]] = None) -> pd.DataFrame:
+	"""
+	Builds the training dataset: all features with the 'reordered' label of the user's train order.
+
+	Args:
+		columns (Optional[List[str]]): Features to load. If None, load all features.
+
+	Returns:
+		pd.DataFrame: float32 features and the 'reordered' label, indexed by ('user_id', 'product_id').
+	"""
+	user_ids, product_ids, X, y, feature_names = build_train_matrix(columns)
+	df = pd.DataFrame(
+		X,
+		columns=feature_names,
+		index=pd.MultiIndex.from_arrays([user_ids, product_ids], names=['user_id', 'product_id']),
+		copy=False
 	)
-	df['reordered'] = df['reordered'].fillna(0)
-	df.drop(['order_id'], axis=1, inplace=True)
-	df.set_index(['user_id', 'product_id'], inplace=True)
+	df['reordered'] = y
 	return df
@@ -0,0 +1,341 @@
+"""
+Pre-forked pool of scoring worker processes.
+
+The recommender and the model are loaded once in the parent process and the workers are forked afterwards, so they
+attach to the same tables without copying them: the serving snapshot and model artifacts are read-only memory maps
+backed by the OS page cache, and arrays built in the parent are shared copy-on-write. Every worker scores batches of
+user ids received over a pipe and sends back the scored rows, in its own interpreter, so concurrent batches are scored
+in parallel instead of taking turns on the GIL of the server process. The router hands every batch to an idle worker,
+the one that has been idle the longest first. A batch can also name a model file, e.g. a model swapped in by the
+model registry after the fork. `preload` loads such a model in every worker and scores warm-up users with it before
+the registry swaps it in, and a worker that replaces a dead one loads the preloaded models again before it gets
+batches. Workers keep the recently used models, and load a model file that was not preloaded on first use.
+
+The workers are not forked by the server itself: once it runs, its event loop, executors and watcher threads may
+hold locks that a forked child would inherit held. A supervisor process is forked when the pool is created, while
+the server is still single-threaded, and forks every worker, at startup and to replace a worker that died. It sends
+the server end of the worker's pipe back as a file descriptor.
+"""
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from collections import OrderedDict, deque
+from multiprocessing import reduction
+from multiprocessing.connection import Connection
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+import numpy as np
+
+from config import MODELS_CACHE_MB, MODELS_CACHE_SIZE
+from scripts.cache import LRUCache
+from scripts.recommender import Recommender
+from scripts.tree_ensemble import compile_model
+from scripts.utils import load_model_file
+
+# Seconds the supervisor waits for the workers to exit when the pool is closed, before killing them
+SHUTDOWN_TIMEOUT_S = 5
+
+
+def _single_threaded(model):
+	# Workers score in parallel, so a model must not spread over all cores in each of them
+	if hasattr(model, "get_params") and "n_jobs" in model.get_params():
+		model.set_params(n_jobs=1)
+	return model
+
+
+def _worker_main(connection: Connection, recommender: Recommender, model, preloaded: Dict[str, object]) -> None:
+	if model is not None:
+		_single_threaded(model)
+	# model path -> model, weighted by the size of the model file
+	models = LRUCache(max_items=MODELS_CACHE_SIZE, max_bytes=MODELS_CACHE_MB * 1024 ** 2)
+	for path, preloaded_model in preloaded.items():
+		models.put(path, _single_threaded(preloaded_model), size=os.path.getsize(path))
+	while True:
+		try:
+			request = connection.recv()
+		except EOFError:
+			return
+		if request is None:
+			return
+		command, model_path, user_ids = request
+		try:
+			batch_model = model
+			if model_path is not None:
+				batch_model = models.get_or_compute(
+					model_path, lambda: _single_threaded(compile_model(load_model_file(model_path))),
+					size=os.path.getsize(model_path)
+				)
+			rows = recommender.score(batch_model, user_ids)
+			# A preload scores the warm-up users and only reports that it succeeded
+			connection.send(("ok", rows if command == "score" else None))
+		except Exception as e:
+			connection.send(("error", f"{type(e).__name__}: {e}"))
+
+
+def _fork_worker(
+		control: Connection,
+		recommender: Recommender,
+		model,
+		preloaded: Dict[str, object]
+) -> Tuple[int, Connection]:
+	parent_connection, child_connection = multiprocessing.Pipe()
+	pid = os.fork()
+	if pid == 0:
+		try:
+			# Only the worker's own end stays open, so it sees the server closing the pipe
+			control.close()
+			parent_connection.close()
+			_worker_main(child_connection, recommender, model, preloaded)
+		finally:
+			os._exit(0)
+	child_connection.close()
+	return pid, parent_connection
+
+
+def _reap(pids: Set[int]) -> Set[int]:
+	running = set()
+	for pid in pids:
+		try:
+			if os.waitpid(pid, os.WNOHANG)[0] == 0:
+				running.add(pid)
+		except ChildProcessError:
+			pass
+	return running
+
+
+def _supervisor_main(control: Connection, recommender: Recommender, model, preloaded: Dict[str, object]) -> None:
+	# Single-threaded, so forking a worker is safe at any time
+	pids: Set[int] = set()
+	while True:
+		try:
+			request = control.recv()
+		except EOFError:
+			break
+		if request is None:
+			break
+		pid, connection = _fork_worker(control, recommender, model, preloaded)
+		pids.add(pid)
+		control.send(pid)
+		reduction.send_handle(control, connection.fileno(), os.getppid())
+		connection.close()
+		pids = _reap(pids)
+
+	deadline = time.monotonic() + SHUTDOWN_TIMEOUT_S
+	while pids and time.monotonic() < deadline:
+		time.sleep(0.05)
+		pids = _reap(pids)
+	for pid in pids:
+		os.kill(pid, signal.SIGKILL)
+	_reap(pids)
+
+
+class ScoringPool:
+	"""
+	Scores batches of users in pre-forked worker processes. `score` can be called from several threads at once:
+	every call waits for an idle worker and blocks until it has scored the batch.
+	"""
+
+	def __init__(
+			self,
+			recommender: Recommender,
+			model=None,
+			n_workers: Optional[int] = None,
+			models: Optional[Dict[str, object]] = None
+	):
+		"""
+		Args:
+			recommender (Recommender): Feature index and product names, loaded before the workers are forked.
+			model: Fitted classifier with `predict_proba`, used by the batches without a model file.
+			n_workers (Optional[int]): Number of worker processes. Defaults to the number of cores.
+			models (Optional[Dict[str, object]]): Models already loaded in this process, by model file, shared with
+				the workers instead of being loaded again.
+		"""
+		if "fork" not in multiprocessing.get_all_start_methods():
+			raise RuntimeError("The scoring pool needs the 'fork' start method to share the tables with its workers.")
+		self.recommender = recommender
+		self.model = model
+		self.models = dict(models or {})
+		self.n_workers = n_workers or os.cpu_count() or 1
+
+		context = multiprocessing.get_context("fork")
+		self._control, supervisor_control = context.Pipe()
+		self._supervisor = context.Process(
+			target=_supervisor_main, args=(supervisor_control, recommender, model, self.models),
+			name="scoring-supervisor", daemon=True
+		)
+		self._supervisor.start()
+		supervisor_control.close()
+		self._supervisor_lock = threading.Lock()
+
+		self._pids: List[Optional[int]] = [None] * self.n_workers
+		self._connections: List[Optional[Connection]] = [None] * self.n_workers
+		self._idle = deque()  # idle workers, the one idle the longest first
+		self._lock = threading.Lock()
+		self._idle_changed = threading.Condition(self._lock)
+		self._stats = [{"batches": 0, "users": 0, "busy_seconds": 0.0, "restarts": 0} for _ in range(self.n_workers)]
+		# Model file -> warm-up users of the preloaded models, loaded again by the workers that replace dead ones
+		self._preloaded: "OrderedDict[str, np.ndarray]" = OrderedDict()
+		for worker in range(self.n_workers):
+			self._spawn(worker)
+			self._idle.append(worker)
+
+	def _spawn(self, worker: int) -> None:
+		with self._supervisor_lock:
+			self._control.send(worker)
+			pid = self._control.recv()
+			connection = Connection(reduction.recv_handle(self._control))
+		self._pids[worker] = pid
+		self._connections[worker] = connection
+
+	def _restart(self, worker: int) -> None:
+		with self._lock:
+			if self._connections[worker] is not None:
+				self._connections[worker].close()
+				self._connections[worker] = None
+				self._pids[worker] = None
+			self._stats[worker]["restarts"] += 1
+		try:
+			self._spawn(worker)
+		except (EOFError, OSError) as e:
+			# Without the supervisor, the worker stays down and its batches fail
+			raise RuntimeError(f"Scoring worker {worker} could not be restarted, the supervisor is gone.") from e
+
+		with self._lock:
+			preloaded = list(self._preloaded.items())
+		for model_path, user_ids in preloaded:
+			try:
+				status, payload = self._send(worker, ("preload", model_path, user_ids))
+			except (EOFError, OSError) as e:
+				status, payload = "error", f"{type(e).__name__}: {e}"
+			if status != "ok":
+				print(f"Scoring worker {worker} could not preload {model_path}, it will load it on first use: {payload}")
+
+	def _send(self, worker: int, request: tuple) -> Tuple[str, object]:
+		connection = self._connections[worker]
+		connection.send(request)
+		return connection.recv()
+
+	def _request(self, worker: int, command: str, model_path: Optional[str], user_ids: np.ndarray):
+		"""
+		Sends a request to a worker taken by the calling thread and returns the worker's answer.
+		A worker found dead is replaced first; a worker that dies during the request is replaced and the request fails.
+		"""
+		try:
+			connection = self._connections[worker]
+			# An idle worker never writes, so a readable pipe means it is closed: the worker died while idle
+			if connection is None or connection.poll():
+				self._restart(worker)
+			status, payload = self._send(worker, (command, model_path, user_ids))
+		except (EOFError, OSError) as e:
+			self._restart(worker)
+			raise RuntimeError(f"Scoring worker {worker} died.") from e
+		if status != "ok":
+			raise RuntimeError(f"Scoring worker {worker} failed: {payload}")
+		return payload
+
+	def _take(self, worker: Optional[int] = None) -> int:
+		"""
+		Waits until a worker, or the given worker, is idle and takes it.
+		"""
+		with self._idle_changed:
+			while not (self._idle if worker is None else worker in self._idle):
+				self._idle_changed.wait()
+			if worker is None:
+				return self._idle.popleft()
+			self._idle.remove(worker)
+			return worker
+
+	def _release(self, worker: int) -> None:
+		with self._idle_changed:
+			self._idle.append(worker)
+			self._idle_changed.notify_all()
+
+	def score(
+			self,
+			user_ids: Union[List[int], np.ndarray],
+			model_path: Optional[str] = None
+	) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+		"""
+		Scores the candidates of users in an idle worker, see `Recommender.score`.
+
+		Args:
+			user_ids (Union[List[int], np.ndarray]): Users to score.
+			model_path (Optional[str]): Model file to score with instead of the model of the pool.
+		"""
+		worker = self._take()
+		started = time.perf_counter()
+		try:
+			return self._request(worker, "score", model_path, np.asarray(user_ids, dtype=np.int64))
+		finally:
+			with self._lock:
+				stats = self._stats[worker]
+				stats["batches"] += 1
+				stats["users"] += len(user_ids)
+				stats["busy_seconds"] += time.perf_counter() - started
+			self._release(worker)
+
+	def preload(self, model_path: str, user_ids: Union[List[int], np.ndarray]) -> None:
+		"""
+		Loads a model file in every worker and scores warm-up users with it, so that no batch waits for the load.
+		The workers are taken one at a time while the others keep scoring.
+
+		Args:
+			model_path (str): Model file, as later passed to `score`.
+			user_ids (Union[List[int], np.ndarray]): Warm-up users. Their scores are discarded.
+
+		Raises:
+			RuntimeError: If a worker could not load the model or score the users with it.
+		"""
+		user_ids = np.asarray(user_ids, dtype=np.int64)
+		# Registered first, so a worker restarted meanwhile loads it too
+		with self._lock:
+			self._preloaded[model_path] = user_ids
+			self._preloaded.move_to_end(model_path)
+			while len(self._preloaded) > MODELS_CACHE_SIZE:
+				self._preloaded.popitem(last=False)
+		try:
+			for worker in range(self.n_workers):
+				self._take(worker)
+				try:
+					self._request(worker, "preload", model_path, user_ids)
+				finally:
+					self._release(worker)
+		except RuntimeError:
+			with self._lock:
+				self._preloaded.pop(model_path, None)
+			raise
+
+	def metrics(self) -> Dict[str, object]:
+		with self._lock:
+			return {
+				"workers": self.n_workers,
+				"idle_workers": len(self._idle),
+				"supervisor_alive": self._supervisor.is_alive(),
+				"per_worker": [dict(stats, pid=pid) for stats, pid in zip(self._stats, self._pids)],
+			}
+
+	def close(self) -> None:
+		for connection in self._connections:
+			if connection is None:
+				continue
+			try:
+				connection.send(None)
+			except OSError:
+				pass
+			connection.close()
+		try:
+			self._control.send(None)
+		except OSError:
+			pass
+		self._supervisor.join(timeout=SHUTDOWN_TIMEOUT_S + 1)
+		if self._supervisor.is_alive():
+			self._supervisor.terminate()
+		self._control.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
@@ -0,0 +1,207 @@
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+
+from config import MODEL_POLL_S
+from scripts.batching import MicroBatcher, split_by_user
+from scripts.instrumentation import render_prometheus
+from scripts.model_registry import ModelRegistry
+from scripts.recommender import Recommender
+from scripts.worker_pool import ScoringPool
+
+
+class BatchRequest(BaseModel):
+	user_ids: List[int]
+	top_k: Optional[int] = None
+	threshold: Optional[float] = None
+
+
+class SplitRequest(BaseModel):
+	split: Dict[str, float]
+
+
+def select_products(
+		recommender: Recommender,
+		product_ids: np.ndarray,
+		probabilities: np.ndarray,
+		top_k: Optional[int],
+		threshold: Optional[float]
+) -> List[dict]:
+	"""
+	Picks the products to return for one user, sorted by descending probability.
+	"""
+	order = np.argsort(-probabilities, kind="stable")
+	if threshold is not None:
+		order = order[probabilities[order] >= threshold]
+	if top_k is not None:
+		order = order[:top_k]
+
+	names = recommender.names_of(product_ids[order])
+	return [
+		{"product_id": int(product_id), "product_name": name, "probability": float(probability)}
+		for product_id, name, probability in zip(product_ids[order], names, probabilities[order])
+	]
+
+
+def create_app(
+		recommender: Recommender,
+		registry: ModelRegistry,
+		max_batch_size: int = 256,
+		max_wait_ms: float = 5.0,
+		workers: int = 1,
+		poll_seconds: float = MODEL_POLL_S
+) -> FastAPI:
+	"""
+	Creates the scoring service. Single-user requests are micro-batched into one `predict_proba` call per model.
+
+	Args:
+		recommender (Recommender): Feature index and product names used for scoring.
+		registry (ModelRegistry): Models serving the users, split by variant.
+		max_batch_size (int): Maximum number of users scored together.
+		max_wait_ms (float): Maximum time a request waits for other requests to join its batch.
+		workers (int): Number of pre-forked scoring processes. With 1, batches are scored in the server process.
+		poll_seconds (float): Seconds between two scans for new models, 0 to serve the loaded models only.
+
+	Returns:
+		FastAPI: The application.
+	"""
+	registry.refresh()
+	pool = None
+	executor = None
+	if workers > 1:
+		# Fork before the event loop and its threads start, the workers share the loaded tables and models
+		pool = ScoringPool(
+			recommender, n_workers=workers,
+			models={version.path: version.model for version in registry.versions().values()}
+		)
+		registry.scorer = lambda version, user_ids: pool.score(user_ids, version.path)
+		# New models are loaded and warmed up in every worker before they get traffic
+		registry.preloader = lambda version, user_ids: pool.preload(version.path, user_ids)
+		executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scoring-router")
+
+	def score(user_ids: List[int]):
+		# Every user gets the variant it was actually scored by, even if the split changes before the response
+		row_user_ids, product_ids, probabilities, variants = registry.score(user_ids)
+		return split_by_user(row_user_ids, product_ids, probabilities, variants)
+
+	batcher = MicroBatcher(
+		score, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, executor=executor,
+		max_concurrent_batches=workers
+	)
+
+	@asynccontextmanager
+	async def lifespan(_: FastAPI):
+		registry.start(poll_seconds)
+		batcher.start()
+		yield
+		await batcher.stop()
+		registry.stop()
+		if pool is not None:
+			executor.shutdown()
+			pool.close()
+
+	app = FastAPI(title="Instacart Product Recommendation Service", lifespan=lifespan)
+
+	@app.get("/health")
+	async def health():
+		return {"status": "ok"}
+
+	@app.get("/recommend")
+	async def recommend(user_id: int, top_k: Optional[int] = None, threshold: Optional[float] = 0.5):
+		product_ids, probabilities, variant = await batcher.submit(user_id)
+		return {
+			"user_id": user_id,
+			"model": variant,
+			"products": select_products(recommender, product_ids, probabilities, top_k, threshold),
+		}
+
+	@app.post("/recommend/batch")
+	async def recommend_batch(request: BatchRequest):
+		scores = await batcher.submit_many(request.user_ids)
+		responses = []
+		for user_id in request.user_ids:
+			product_ids, probabilities, variant = scores[user_id]
+			responses.append({
+				"user_id": user_id,
+				"model": variant,
+				"products": select_products(recommender, product_ids, probabilities, request.top_k, request.threshold),
+			})
+		return responses
+
+	@app.get("/models")
+	async def models():
+		return registry.metrics()
+
+	@app.post("/models/split")
+	async def set_split(request: SplitRequest):
+		try:
+			registry.set_split(request.split)
+		except ValueError as e:
+			raise HTTPException(status_code=400, detail=str(e))
+		# Load the models of new variants off the event loop
+		await asyncio.get_running_loop().run_in_executor(None, registry.refresh)
+		return registry.metrics()
+
+	@app.get("/metrics")
+	async def metrics():
+		if pool is None:
+			return {**batcher.metrics(), "models": registry.metrics()}
+		return {**batcher.metrics(), "models": registry.metrics(), "workers": pool.metrics()}
+
+	@app.get("/metrics/prometheus")
+	async def prometheus_metrics():
+		return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
+
+	return app
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Serve product recommendations over HTTP.")
+	parser.add_argument("--model-type", default=None, help="random_forest, lightgbm or xgboost.")
+	parser.add_argument("--model-name", default=None, help="Model file name. Defaults to the latest model.")
+	parser.add_argument(
+		"--models", nargs="+", default=None, metavar="VARIANT=WEIGHT",
+		help="Traffic split of model types or files, e.g. 'lightgbm=0.9 xgboost=0.1'. Default: MODEL_TRAFFIC_SPLIT."
+	)
+	parser.add_argument(
+		"--poll-s", type=float, default=MODEL_POLL_S, help="Seconds between two scans for new models, 0 to disable."
+	)
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=8000)
+	parser.add_argument("--max-batch-size", type=int, default=256)
+	parser.add_argument("--max-wait-ms", type=float, default=5.0)
+	parser.add_argument(
+		"--workers", type=int, default=1,
+		help="Pre-forked scoring processes sharing the memory-mapped features and model. 1 scores in the server."
+	)
+	args = parser.parse_args()
+
+	if args.models:
+		split = {}
+		for variant in args.models:
+			name, _, weight = variant.rpartition("=")
+			split[name or weight] = float(weight) if name else 1.0
+	elif args.model_type or args.model_name:
+		model_type = args.model_type or "lightgbm"
+		split = {f"{model_type}/{args.model_name}" if args.model_name else model_type: 1.0}
+	else:
+		split = None
+
+	recommender = Recommender.load()
+	app = create_app(
+		recommender,
+		ModelRegistry(recommender, split),
+		max_batch_size=args.max_batch_size,
+		max_wait_ms=args.max_wait_ms,
+		workers=args.workers,
+		poll_seconds=args.poll_s,
+	)
+	uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,135 @@
+"""
+Parity of the flattened tree ensembles with the models they are flattened from.
+
+Every model is trained on small synthetic data with missing values and integer-valued features, whose values land
+exactly on split thresholds. The probabilities are compared on random rows and on rows that hit every threshold
+exactly and right next to it, with and without missing values.
+"""
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+import pytest
+import xgboost as xgb
+from sklearn.ensemble import RandomForestClassifier
+
+from scripts.boosters import BoosterClassifier
+from scripts.tree_ensemble import PARITY_TOLERANCE, TreeEnsemble, compile_model
+
+FEATURES = ["ratio", "count", "always_present", "mostly_zero"]
+N_ROWS = 4000
+
+
+@pytest.fixture(scope="module")
+def data():
+	rng = np.random.default_rng(0)
+	X = np.column_stack([
+		rng.normal(size=N_ROWS),
+		rng.integers(0, 10, size=N_ROWS),  # integer values: the splits fall on values that occur in the rows
+		rng.uniform(-1, 1, size=N_ROWS),
+		np.where(rng.random(N_ROWS) < 0.7, 0, rng.integers(1, 5, size=N_ROWS)),
+	]).astype(np.float32)
+	y = (X[:, 0] + 0.3 * X[:, 1] - X[:, 2] + 0.5 * X[:, 3] + rng.normal(size=N_ROWS) > 1.5).astype(np.int64)
+	# Missing values in all features but 'always_present', which sees its first ones at prediction time
+	for column in (0, 1, 3):
+		X[rng.random(N_ROWS) < 0.1, column] = np.nan
+	return X, y
+
+
+def _threshold_rows(ensemble: TreeEnsemble, X: np.ndarray) -> np.ndarray:
+	"""
+	Rows of X with one feature set to a split threshold of the ensemble, or to the float32 just below or above it.
+	"""
+	# scikit-learn splits that only separate the missing values have an infinite threshold
+	internal = (ensemble.feature >= 0) & np.isfinite(ensemble.threshold)
+	thresholds = ensemble.threshold[internal].astype(np.float32)
+	values = np.concatenate([
+		thresholds,
+		np.nextafter(thresholds, np.float32(-np.inf)),
+		np.nextafter(thresholds, np.float32(np.inf)),
+	])
+	features = np.tile(ensemble.feature[internal], 3)
+	rows = X[np.arange(len(values)) % len(X)].copy()
+	rows[np.arange(len(values)), features] = values
+	return rows
+
+
+def _evaluation_rows(ensemble: TreeEnsemble, X: np.ndarray) -> np.ndarray:
+	rows = np.concatenate([X, _threshold_rows(ensemble, X), _threshold_rows(ensemble, np.nan_to_num(X))])
+	# NaN in 'always_present' goes through the missing value handling of splits that never saw one
+	unseen = rows[:500].copy()
+	unseen[:, FEATURES.index("always_present")] = np.nan
+	return np.concatenate([rows, unseen])
+
+
+def _random_forest(X, y):
+	model = RandomForestClassifier(n_estimators=20, max_depth=8, random_state=0)
+	return model.fit(pd.DataFrame(X, columns=FEATURES), y)
+
+
+def _lightgbm(X, y, **params):
+	dataset = lgb.Dataset(X, y, feature_name=FEATURES, params={"verbose": -1})
+	return lgb.train({"objective": "binary", "num_leaves": 15, "seed": 0, "verbose": -1, **params}, dataset, 30)
+
+
+def _xgboost(X, y):
+	matrix = xgb.DMatrix(X, y, feature_names=FEATURES)
+	return xgb.train({"objective": "binary:logistic", "max_depth": 4, "seed": 0}, matrix, 30)
+
+
+MODELS = {
+	"random_forest": _random_forest,
+	"lightgbm": _lightgbm,
+	"lightgbm_zero_as_missing": lambda X, y: _lightgbm(X, y, zero_as_missing=True),
+	"lightgbm_classifier": lambda X, y: lgb.LGBMClassifier(n_estimators=30, num_leaves=15, verbose=-1).fit(
+		pd.DataFrame(X, columns=FEATURES), y
+	),
+	"xgboost": _xgboost,
+	"xgboost_classifier": lambda X, y: xgb.XGBClassifier(n_estimators=30, max_depth=4).fit(
+		pd.DataFrame(X, columns=FEATURES), y
+	),
+}
+
+
+def _native_proba(model, X: np.ndarray) -> np.ndarray:
+	if type(model).__name__ == "Booster":
+		model = BoosterClassifier(model)
+	return model.predict_proba(pd.DataFrame(X, columns=FEATURES))[:, 1]
+
+
+@pytest.mark.parametrize("name", list(MODELS))
+def test_parity(name, data):
+	X, y = data
+	model = MODELS[name](X, y)
+	ensemble = TreeEnsemble.from_model(model)
+	rows = _evaluation_rows(ensemble, X)
+
+	expected = _native_proba(model, rows)
+	np.testing.assert_allclose(ensemble.predict_proba(rows)[:, 1], expected, rtol=0, atol=PARITY_TOLERANCE)
+	# Blocks scored by threads give the same probabilities
+	np.testing.assert_array_equal(ensemble.set_params(n_jobs=4).predict_proba(rows), ensemble.predict_proba(rows))
+
+
+def test_xgboost_strict_split(data):
+	# XGBoost sends a value equal to the threshold to the right child, unlike scikit-learn and LightGBM
+	X, y = data
+	model = _xgboost(X, y)
+	ensemble = TreeEnsemble.from_model(model)
+	root = ensemble.tree_offsets[0]
+	feature, threshold = ensemble.feature[root], np.float32(ensemble.threshold[root])
+
+	rows = np.repeat(np.nan_to_num(X[:1]), 2, axis=0)
+	rows[:, feature] = [threshold, np.nextafter(threshold, np.float32(-np.inf))]
+	leaves = ensemble.leaves(rows)[:, 0]
+	assert leaves[0] != leaves[1]
+	np.testing.assert_allclose(ensemble.predict_proba(rows)[:, 1], _native_proba(model, rows), atol=PARITY_TOLERANCE)
+
+
+def test_compile_model(data):
+	X, y = data
+	assert isinstance(compile_model(_random_forest(X, y)), TreeEnsemble)
+	booster = _lightgbm(X, y)
+	# Boosters keep their native predictor, bare ones from old pickles get the scikit-learn interface
+	compiled = compile_model(booster)
+	assert isinstance(compiled, BoosterClassifier)
+	assert compile_model(compiled) is compiled
+	np.testing.assert_allclose(compiled.predict_proba(X)[:, 1], booster.predict(X), atol=PARITY_TOLERANCE)